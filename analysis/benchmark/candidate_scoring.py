@@ -0,0 +1,56 @@
+import tyro
+
+from soar_benchmark.pipeline import GenerationConfig
+from analysis.benchmark.common import (
+    annotation_task,
+    contents,
+    count_new_tokens,
+    load_pipeline,
+    prepare_prompts,
+    report,
+    timed,
+)
+
+
+def benchmark(
+    model_name: str,
+    json_path: str,
+    prompter: str = "zero_shot",
+    num_samples: int = 64,
+    batch_size: int = 8,
+    max_new_tokens: int = 256,
+    torch_dtype: str = "bfloat16",
+    device_map: str = "auto",
+    output_folder: str = "outputs/benchmark/candidate_scoring",
+):
+    """Compare free-form generation against ranking the dataset labels by log-likelihood."""
+    pipeline = load_pipeline(model_name, batch_size, torch_dtype, device_map, engine="continuous")
+    task = annotation_task(pipeline, prompter, output_folder, json_path=json_path)
+    task.candidate_labels = task.prepare_candidate_labels(task.prepare_dataset())
+    samples, messages = prepare_prompts(task, num_samples)
+
+    generated, generation_seconds = timed(
+        lambda: pipeline(messages, GenerationConfig(max_new_tokens=max_new_tokens, do_sample=False))
+    )
+    generation_hits = sum(
+        sample["label"].lower() in content.lower() for sample, content in zip(samples, contents(generated))
+    )
+    (responses, _), scoring_seconds = timed(lambda: task.rank_candidates(pipeline, messages))
+    scoring_hits = sum(sample["label"] == answer for sample, answer in zip(samples, contents(responses)))
+
+    report(
+        "generation",
+        f"{generation_seconds:.3f}s",
+        f"{count_new_tokens(pipeline, generated) / len(samples):.1f} new tokens per sample",
+        f"label mentioned {generation_hits}/{len(samples)}",
+    )
+    report(
+        f"scoring ({len(task.candidate_labels)} candidates)",
+        f"{scoring_seconds:.3f}s",
+        f"top label correct {scoring_hits}/{len(samples)}",
+        f"speedup {generation_seconds / scoring_seconds:.2f}x",
+    )
+
+
+if __name__ == "__main__":
+    tyro.cli(benchmark)
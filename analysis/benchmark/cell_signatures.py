@@ -0,0 +1,103 @@
+import h5py
+import tyro
+import tempfile
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+
+from pathlib import Path
+
+from soar_benchmark.dataset import H5ADCellDataset, H5ADCellDatasetConfig
+from analysis.benchmark.common import megabytes, report, timed, write_h5ad_skeleton
+
+
+def write_synthetic_atlas(
+    path: Path,
+    num_cells: int,
+    num_genes: int,
+    num_cell_types: int,
+    program_genes: int,
+    background_genes: int,
+    chunk_size: int,
+):
+    """Write a CSR count matrix chunk by chunk, where every cell type expresses its own program of genes at decreasing
+    levels over sparse background noise."""
+    rng = np.random.default_rng(0)
+    cell_types = rng.integers(num_cell_types, size=num_cells)
+    program_rates = 64 * 0.7 ** np.arange(program_genes)
+    with h5py.File(path, "w") as f:
+        obs = pd.DataFrame(
+            {"cell_type": pd.Categorical.from_codes(cell_types, [f"cell type {k}" for k in range(num_cell_types)])},
+            index=[f"cell{i}" for i in range(num_cells)],
+        )
+        X = write_h5ad_skeleton(f, obs, [f"GENE{j}" for j in range(num_genes)], (num_cells, num_genes))
+        data = X.create_dataset("data", shape=(0,), maxshape=(None,), dtype=np.float32)
+        indices = X.create_dataset("indices", shape=(0,), maxshape=(None,), dtype=np.int64)
+        indptr = [np.zeros(1, dtype=np.int64)]
+        for start in range(0, num_cells, chunk_size):
+            end = min(start + chunk_size, num_cells)
+            rows = np.arange(end - start)
+            program = rng.poisson(program_rates, size=(len(rows), program_genes))
+            program_columns = cell_types[start:end, None] * program_genes + np.arange(program_genes)
+            background_columns = rng.integers(num_genes, size=(len(rows), background_genes))
+            chunk = sp.csr_matrix(
+                (
+                    np.concatenate([program.ravel(), rng.poisson(1.0, size=background_columns.size) + 1]),
+                    (
+                        np.concatenate([np.repeat(rows, program_genes), np.repeat(rows, background_genes)]),
+                        np.concatenate([program_columns.ravel(), background_columns.ravel()]),
+                    ),
+                ),
+                shape=(len(rows), num_genes),
+                dtype=np.float32,
+            )
+            chunk.sum_duplicates()
+            chunk.eliminate_zeros()
+            offset = data.shape[0]
+            data.resize((offset + chunk.nnz,))
+            indices.resize((offset + chunk.nnz,))
+            data[offset:] = chunk.data
+            indices[offset:] = chunk.indices
+            indptr.append(chunk.indptr[1:].astype(np.int64) + offset)
+        X.create_dataset("indptr", data=np.concatenate(indptr))
+
+
+def benchmark(
+    num_cells: int = 1_000_000,
+    num_genes: int = 20_000,
+    num_cell_types: int = 50,
+    program_genes: int = 30,
+    background_genes: int = 200,
+    gene_nums: tuple[int, ...] = (3, 5, 10),
+    chunk_size: int = 10_000,
+):
+    """Count the prompts left after collapsing the cells of a synthetic atlas by their top expressed genes."""
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = Path(tmp_dir) / "atlas.h5ad"
+        _, seconds = timed(
+            lambda: write_synthetic_atlas(
+                path, num_cells, num_genes, num_cell_types, program_genes, background_genes, chunk_size
+            )
+        )
+        print(f"{megabytes(path.stat().st_size)} atlas of {num_cells} cells written in {seconds:.1f}s")
+
+        for gene_num, unordered_signatures in [(n, unordered) for n in gene_nums for unordered in [False, True]]:
+            config = H5ADCellDatasetConfig(
+                h5ad_path=str(path),
+                gene_num=gene_num,
+                label_key="cell_type",
+                unordered_signatures=unordered_signatures,
+                chunk_size=chunk_size,
+            )
+            dataset, build_seconds = timed(lambda: H5ADCellDataset(config))
+            _, load_seconds = timed(lambda: H5ADCellDataset(config))
+            report(
+                f"top {gene_num} genes{' (unordered)' if unordered_signatures else ''}",
+                f"{len(dataset)} prompts for {num_cells} cells ({num_cells / len(dataset):.0f}x fewer LLM calls)",
+                f"index built in {build_seconds:.1f}s",
+                f"{megabytes(dataset.sidecar_path.stat().st_size)} sidecar loaded in {load_seconds:.2f}s",
+            )
+
+
+if __name__ == "__main__":
+    tyro.cli(benchmark)
@@ -0,0 +1,85 @@
+import json
+import tyro
+import tempfile
+import numpy as np
+
+from pathlib import Path
+
+from soar_benchmark.dataset import ColumnarDataset, ColumnarDatasetConfig, JSONDataset, JSONDatasetConfig
+from analysis.benchmark.common import in_forked_process, megabytes, random_indices, report, timed
+
+
+def write_synthetic_dataset(path: Path, num_rows: int, num_genes: int, genes_per_row: int, seed: int):
+    rng = np.random.default_rng(seed)
+    genes = [f"GENE{i}" for i in range(num_genes)]
+    cell_types = [f"cell type {i}" for i in range(100)]
+    with open(path.with_suffix(".json"), "w") as json_file, open(path.with_suffix(".jsonl"), "w") as jsonl_file:
+        json_file.write("[")
+        for i in range(num_rows):
+            cell_type = cell_types[rng.integers(len(cell_types))]
+            row = {
+                "subset": f"dataset {rng.integers(20)}",
+                "tissue": f"tissue {rng.integers(30)}",
+                "gene list": ", ".join(genes[j] for j in rng.choice(num_genes, genes_per_row, replace=False)),
+                "annotation": cell_type,
+                "cl_name": cell_type,
+                "cl_id": f"CL:{cell_types.index(cell_type):07d}",
+                "broadtype": f"broadtype {rng.integers(10)}",
+            }
+            json_file.write(("," if i else "") + json.dumps(row))
+            jsonl_file.write(json.dumps(row) + "\n")
+        json_file.write("]")
+
+
+def measure(name: str, make_dataset, num_reads: int, seed: int):
+    def run():
+        dataset, load_seconds = timed(make_dataset)
+        indices = random_indices(seed, len(dataset), num_reads)
+
+        def read():
+            # samples are dropped right away, like a DataLoader would
+            for index in indices:
+                dataset[index]
+
+        _, read_seconds = timed(read)
+        return load_seconds, read_seconds
+
+    load_seconds, read_seconds, rss, _ = in_forked_process(run)
+    report(
+        name,
+        f"load {load_seconds:.2f}s",
+        f"peak RSS growth {megabytes(rss)}",
+        f"{num_reads / read_seconds:.0f} random reads/s",
+    )
+
+
+def benchmark(
+    num_rows: int = 200_000,
+    num_genes: int = 20_000,
+    genes_per_row: int = 50,
+    num_reads: int = 100_000,
+    chunk_size: int = 8192,
+    seed: int = 0,
+):
+    """Compare loading and random access of `JSONDataset` with `ColumnarDataset` on a synthetic dataset."""
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = Path(tmp_dir) / "synthetic"
+        write_synthetic_dataset(path, num_rows, num_genes, genes_per_row, seed)
+        cache_dir = str(Path(tmp_dir) / "columns")
+
+        json_path, jsonl_path = str(path.with_suffix(".json")), str(path.with_suffix(".jsonl"))
+        measure("JSONDataset (.json)", lambda: JSONDataset(JSONDatasetConfig(json_path=json_path)), num_reads, seed)
+        measure(
+            "ColumnarDataset (.json, in memory)",
+            lambda: ColumnarDataset(ColumnarDatasetConfig(path=json_path)),
+            num_reads,
+            seed,
+        )
+        config = ColumnarDatasetConfig(path=jsonl_path, cache_dir=cache_dir, chunk_size=chunk_size)
+        # the first run parses the file into the cache, the second memory-maps the cached columns
+        for name in ["ColumnarDataset (.jsonl, parse to cache)", "ColumnarDataset (.jsonl, memory-mapped)"]:
+            measure(name, lambda: ColumnarDataset(config), num_reads, seed)
+
+
+if __name__ == "__main__":
+    tyro.cli(benchmark)
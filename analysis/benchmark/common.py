@@ -0,0 +1,178 @@
+import time
+import resource
+import threading
+import multiprocessing
+import numpy as np
+import pandas as pd
+
+from typing import Any, Callable
+from anndata.experimental import write_elem
+
+
+def timed(run: Callable[[], Any]) -> tuple[Any, float]:
+    start = time.perf_counter()
+    result = run()
+    return result, time.perf_counter() - start
+
+
+def in_forked_process(run: Callable[[], tuple]) -> tuple:
+    """The results of ``run`` called in a forked process, so every measurement starts from the same baseline, followed
+    by the peak RSS growth of the process and the largest peak RSS of its own workers, in bytes."""
+
+    def target(queue):
+        with open("/proc/self/statm") as f:
+            baseline = int(f.read().split()[1]) * resource.getpagesize()
+        try:
+            results = run()
+        except BaseException as e:
+            queue.put(e)
+            raise
+        queue.put(
+            (
+                *results,
+                max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024 - baseline, 0),
+                resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * 1024,
+            )
+        )
+
+    context = multiprocessing.get_context("fork")
+    queue = context.Queue()
+    process = context.Process(target=target, args=(queue,))
+    process.start()
+    results = queue.get()
+    process.join()
+    if isinstance(results, BaseException):
+        raise results
+    return results
+
+
+def measure(name: str, run: Callable[[], Any], workers: bool = False) -> float:
+    """Time ``run`` in a forked process and report its peak RSS growth, and that of its largest worker."""
+    seconds, rss, worker_rss = in_forked_process(lambda: (timed(run)[1],))
+    report(
+        name,
+        f"{seconds:.3f}s",
+        f"peak RSS growth {megabytes(rss)}",
+        *([f"largest worker peak RSS {megabytes(worker_rss)}"] if workers else []),
+    )
+    return seconds
+
+
+def peak_memory(run: Callable[[], Any], interval: float = 0.005) -> tuple[Any, int]:
+    """The result of ``run`` and the peak memory it allocated, in bytes: on the GPUs when CUDA is available, and as
+    the RSS sampled every ``interval`` seconds above the RSS before the call otherwise."""
+    import torch
+
+    if torch.cuda.is_available():
+        devices = range(torch.cuda.device_count())
+        baseline = sum(torch.cuda.memory_allocated(device) for device in devices)
+        for device in devices:
+            torch.cuda.reset_peak_memory_stats(device)
+        result = run()
+        return result, sum(torch.cuda.max_memory_allocated(device) for device in devices) - baseline
+
+    def rss() -> int:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+
+    baseline, peak, done = rss(), [0], threading.Event()
+
+    def sample():
+        while not done.wait(interval):
+            peak[0] = max(peak[0], rss())
+
+    sampler = threading.Thread(target=sample, daemon=True)
+    sampler.start()
+    try:
+        result = run()
+    finally:
+        done.set()
+        sampler.join()
+    return result, max(peak[0], rss()) - baseline
+
+
+def megabytes(num_bytes: float) -> str:
+    return f"{num_bytes / 2**20:.1f}MB"
+
+
+def report(name: str, *metrics: str):
+    print(f"{name}: {', '.join(metrics)}")
+
+
+def write_h5ad_skeleton(f, obs: pd.DataFrame, genes: list[str], shape: tuple[int, int]):
+    """Write the annotations of an H5AD file and return the empty group of its CSR matrix ``X``, so synthetic atlases
+    larger than memory can be written chunk by chunk."""
+    f.attrs["encoding-type"] = "anndata"
+    f.attrs["encoding-version"] = "0.1.0"
+    write_elem(f, "obs", obs)
+    write_elem(f, "var", pd.DataFrame(index=genes))
+    for key in ["uns", "obsm", "varm", "obsp", "varp", "layers"]:
+        write_elem(f, key, {})
+
+    X = f.create_group("X")
+    X.attrs["encoding-type"] = "csr_matrix"
+    X.attrs["encoding-version"] = "0.1.0"
+    X.attrs["shape"] = shape
+    return X
+
+
+def load_pipeline(
+    model_name: str,
+    batch_size: int,
+    torch_dtype: str,
+    device_map: str,
+    model_and_tokenizer=None,
+    **kwargs,
+):
+    """A pipeline of a benchmarked model, batching like an annotation run, around ``model_and_tokenizer`` when given."""
+    from soar_benchmark.pipeline import CellTypeAnnotationPipeline, PipelineConfig
+
+    return CellTypeAnnotationPipeline(
+        PipelineConfig(
+            model_custom_id="benchmark",
+            model_name=model_name,
+            torch_dtype=torch_dtype,
+            device_map=device_map,
+            tokenizer_kwargs={"padding_side": "left"},
+            batch_size=batch_size,
+            **kwargs,
+        ),
+        model_and_tokenizer,
+    )
+
+
+def annotation_task(pipeline, prompter: str, output_folder: str, **dataset_kwargs):
+    """An annotation task around ``pipeline``, rendering the prompts of a JSON dataset."""
+    from nntool.slurm import SlurmConfig
+    from soar_benchmark.dataset import JSONDatasetConfig
+    from soar_benchmark.task import CellTypeAnnotationTask, CellTypeAnnotationTaskConfig
+
+    return CellTypeAnnotationTask(
+        CellTypeAnnotationTaskConfig(
+            promter_name=prompter,
+            dataset=JSONDatasetConfig(**dataset_kwargs),
+            pipeline=pipeline.config,
+            slurm=SlurmConfig(mode="debug", partition="debug"),
+            output_folder=output_folder,
+        )
+    )
+
+
+def prepare_prompts(task, num_samples: int) -> tuple[list[dict[str, Any]], list[list[dict[str, str]]]]:
+    """The first ``num_samples`` samples of the task's dataset and their prompts."""
+    dataset = task.prepare_dataset()
+    samples = [dataset[i] for i in range(min(num_samples, len(dataset)))]
+    return samples, task.prepare_input(samples)
+
+
+def contents(generated: list[list[dict[str, Any]]]) -> list[str]:
+    # the first answer of every prompt
+    return [outputs[0]["generated_text"][-1]["content"] for outputs in generated]
+
+
+def count_new_tokens(pipeline, generated: list[list[dict[str, Any]]]) -> int:
+    return sum(pipeline.count_completion_tokens(output) for outputs in generated for output in outputs)
+
+
+def random_indices(seed: int, size: int, num: int) -> list[int]:
+    return np.random.default_rng(seed).integers(size, size=num).tolist()
@@ -0,0 +1,55 @@
+import tyro
+
+from soar_benchmark.pipeline import GenerationConfig
+from soar_benchmark.bioontology.trie import read_ontology_labels
+from analysis.benchmark.common import (
+    annotation_task,
+    contents,
+    count_new_tokens,
+    load_pipeline,
+    prepare_prompts,
+    report,
+    timed,
+)
+
+
+def benchmark(
+    model_name: str,
+    json_path: str,
+    ontology_path: str,
+    prompter: str = "zero_shot",
+    num_samples: int = 64,
+    batch_size: int = 8,
+    max_new_tokens: int = 256,
+    torch_dtype: str = "bfloat16",
+    device_map: str = "auto",
+    output_folder: str = "outputs/benchmark/constrained_decoding",
+):
+    """Compare generated tokens and latency of unconstrained and ontology-constrained answers."""
+    pipeline = load_pipeline(
+        model_name,
+        batch_size,
+        torch_dtype,
+        device_map,
+        engine="continuous",
+        ontology_path=ontology_path,
+        ontology_cache_dir=f"{output_folder}/cache",
+    )
+    task = annotation_task(pipeline, prompter, output_folder, json_path=json_path)
+    _, messages = prepare_prompts(task, num_samples)
+    labels = {label.lower() for label in read_ontology_labels(ontology_path)}
+    generation_config = GenerationConfig(max_new_tokens=max_new_tokens, do_sample=False)
+
+    for constrained in [False, True]:
+        generated, seconds = timed(lambda: pipeline(messages, generation_config, constrained=constrained))
+        answers = contents(generated)
+        report(
+            "constrained" if constrained else "unconstrained",
+            f"{seconds:.3f}s",
+            f"{count_new_tokens(pipeline, generated) / len(answers):.1f} new tokens per sample",
+            f"{sum(answer.strip().lower() in labels for answer in answers)}/{len(answers)} answers are ontology labels",
+        )
+
+
+if __name__ == "__main__":
+    tyro.cli(benchmark)
@@ -0,0 +1,61 @@
+import tyro
+
+from soar_benchmark.pipeline import GenerationConfig
+from analysis.benchmark.common import (
+    annotation_task,
+    contents,
+    load_pipeline,
+    megabytes,
+    peak_memory,
+    prepare_prompts,
+    report,
+    timed,
+)
+
+
+def benchmark(
+    model_name: str,
+    json_path: str,
+    prompter: str = "zero_shot",
+    num_samples: int = 256,
+    batch_size: int = 8,
+    engine_queue_size: int = 64,
+    max_new_tokens: int = 256,
+    torch_dtype: str = "bfloat16",
+    device_map: str = "auto",
+    output_folder: str = "outputs/benchmark/continuous_batching",
+):
+    """Compare the throughput and peak memory of the text-generation pipeline and the continuous batching engine on the
+    same prompts, both around the same loaded model."""
+    pipeline = load_pipeline(model_name, batch_size, torch_dtype, device_map)
+    engine_pipeline = load_pipeline(
+        model_name,
+        batch_size,
+        torch_dtype,
+        device_map,
+        model_and_tokenizer=(pipeline.model, pipeline.tokenizer),
+        engine="continuous",
+        engine_queue_size=engine_queue_size,
+    )
+    task = annotation_task(pipeline, prompter, output_folder, json_path=json_path)
+    _, messages = prepare_prompts(task, num_samples)
+    generation_config = GenerationConfig(max_new_tokens=max_new_tokens, do_sample=False)
+
+    answers = {}
+    for name, run_pipeline in [("pipeline", pipeline), ("engine", engine_pipeline)]:
+        (generated, seconds), memory = peak_memory(lambda: timed(lambda: run_pipeline(messages, generation_config)))
+        answers[name] = contents(generated)
+        new_tokens = run_pipeline.stats.get("generation/new_tokens")
+        report(
+            name,
+            f"{seconds:.3f}s",
+            f"{new_tokens / len(messages):.1f} new tokens per sample",
+            f"{new_tokens / seconds:.1f} tokens/s",
+            f"peak memory {megabytes(memory)}",
+        )
+    same = sum(a == b for a, b in zip(answers["pipeline"], answers["engine"]))
+    print(f"{same}/{len(messages)} greedy answers identical")
+
+
+if __name__ == "__main__":
+    tyro.cli(benchmark)
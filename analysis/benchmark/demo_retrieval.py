@@ -0,0 +1,89 @@
+import json
+import tyro
+import tempfile
+import numpy as np
+import scipy.sparse as sp
+
+from pathlib import Path
+
+from soar_benchmark.retrieval import DemoIndex
+from analysis.benchmark.common import megabytes, report, timed
+
+
+def synthetic_gene_sets(
+    rng: np.random.Generator, num_sets: int, num_genes: int, num_programs: int, program_genes: int, set_size: int
+) -> list[list[str]]:
+    """Gene sets drawing most of their genes from one of ``num_programs`` programs and the rest at random."""
+    programs = rng.integers(num_programs, size=num_sets)
+    program_draws = rng.random((num_sets, program_genes)).argsort(axis=1)[:, : set_size - 2]
+    noise = rng.integers(num_genes, size=(num_sets, 2))
+    genes = np.concatenate([programs[:, None] * program_genes + program_draws, noise], axis=1) % num_genes
+    return [[f"GENE{j}" for j in row] for row in genes.tolist()]
+
+
+def benchmark(
+    num_demos: int = 1_000_000,
+    num_genes: int = 20_000,
+    num_programs: int = 2_000,
+    program_genes: int = 20,
+    set_size: int = 10,
+    num_queries: int = 4_096,
+    batch_sizes: tuple[int, ...] = (1, 16, 64),
+    k: int = 3,
+    num_checked: int = 64,
+):
+    """Retrieve the few-shot demos of synthetic marker sets from a synthetic pool, and check them against a brute-force
+    sparse Jaccard matrix."""
+    rng = np.random.default_rng(0)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        pool_path = Path(tmp_dir) / "pool.jsonl"
+        pool = synthetic_gene_sets(rng, num_demos, num_genes, num_programs, program_genes, set_size)
+        with open(pool_path, "w") as f:
+            for i, genes in enumerate(pool):
+                demo = {"gene_names": genes, "tissue": "blood", "reasoning": "...", "cell_type": f"cell type {i}"}
+                f.write(json.dumps(demo) + "\n")
+        print(f"{megabytes(pool_path.stat().st_size)} pool of {num_demos} demos written")
+
+        _, build_seconds = timed(lambda: DemoIndex(str(pool_path), tmp_dir))
+        index, open_seconds = timed(lambda: DemoIndex(str(pool_path), tmp_dir))
+        print(f"index built in {build_seconds:.1f}s, reopened in {open_seconds:.3f}s")
+
+        queries = synthetic_gene_sets(rng, num_queries, num_genes, num_programs, program_genes, set_size)
+        for batch_size in batch_sizes:
+            _, seconds = timed(
+                lambda: [index.retrieve(queries[i : i + batch_size], k) for i in range(0, num_queries, batch_size)]
+            )
+            report(f"batches of {batch_size}", f"{seconds / num_queries * 1e3:.3f}ms per sample")
+
+        # brute force over the whole pool: one sparse (query, demo) intersection matrix
+        def one_hot(gene_sets: list[list[str]]) -> sp.csr_matrix:
+            rows = np.repeat(np.arange(len(gene_sets)), [len(genes) for genes in gene_sets])
+            columns = [int(gene[4:]) for genes in gene_sets for gene in genes]
+            matrix = sp.csr_matrix((np.ones(len(rows)), (rows, columns)), shape=(len(gene_sets), num_genes))
+            matrix.data[:] = 1
+            return matrix
+
+        pool_matrix = one_hot(pool).T.tocsr()
+        checked = queries[:num_checked]
+
+        def brute_force() -> np.ndarray:
+            intersections = (one_hot(checked) @ pool_matrix).toarray()
+            sizes = np.asarray(pool_matrix.sum(axis=0)).ravel()
+            query_sizes = np.array([len(set(genes)) for genes in checked])
+            jaccard = intersections / (query_sizes[:, None] + sizes - intersections)
+            # demos nested with the query are skipped like a sample retrieving itself
+            jaccard[intersections == np.minimum(query_sizes[:, None], sizes)] = 0
+            return jaccard
+
+        jaccard, seconds = timed(brute_force)
+        expected = np.sort(jaccard, axis=1)[:, ::-1][:, :k]
+        found = np.array([[score for _, score in hits] for hits in index.search(checked, k)])
+        report(
+            "brute force",
+            f"{seconds / num_checked * 1e3:.3f}ms per sample",
+            f"top {k} Jaccard similarities match: {np.allclose(found, expected)}",
+        )
+
+
+if __name__ == "__main__":
+    tyro.cli(benchmark)
@@ -0,0 +1,68 @@
+import tyro
+import tempfile
+import multiprocessing
+import numpy as np
+import pandas as pd
+import scanpy as sc
+import anndata as ad
+
+from pathlib import Path
+
+from soar_benchmark.dataset import H5ADDataset, H5ADDatasetConfig
+from analysis.benchmark.common import megabytes, measure
+
+
+def write_synthetic_atlas(path: Path, num_cells: int, num_genes: int, num_cell_types: int, num_ranked_genes: int):
+    rng = np.random.default_rng(0)
+    genes = [f"GENE{i}" for i in range(num_genes)]
+    adata = ad.AnnData(
+        rng.random((num_cells, num_genes), dtype=np.float32),
+        var=pd.DataFrame(index=genes),
+    )
+    # the layout of `sc.tl.rank_genes_groups(..., key_added="gene_list")`
+    cell_types = [f"cell type {i}" for i in range(num_cell_types)]
+    adata.uns["gene_list"] = {
+        "names": np.rec.fromarrays(
+            [np.array(genes, dtype=object)[rng.permutation(num_genes)[:num_ranked_genes]] for _ in cell_types],
+            names=cell_types,
+        )
+    }
+    adata.write_h5ad(path)
+
+
+def benchmark(
+    num_cells: int = 20_000,
+    num_genes: int = 5_000,
+    num_cell_types: int = 50,
+    num_ranked_genes: int = 100,
+):
+    """Compare loading the ranked gene list of an H5AD file with `sc.read_h5ad` against `H5ADDataset`."""
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = Path(tmp_dir) / "atlas.h5ad"
+        # written by a child process, forked processes would otherwise inherit the peak RSS of the expression matrix
+        context = multiprocessing.get_context("fork")
+        process = context.Process(
+            target=write_synthetic_atlas, args=(path, num_cells, num_genes, num_cell_types, num_ranked_genes)
+        )
+        process.start()
+        process.join()
+        print(f"{megabytes(path.stat().st_size)} H5AD file")
+
+        def make_config(**kwargs):
+            return H5ADDatasetConfig(h5ad_path=str(path), gene_num=10, **kwargs)
+
+        measure("sc.read_h5ad", lambda: sc.read_h5ad(path).uns["gene_list"]["names"])
+        measure("H5ADDataset (uns only)", lambda: H5ADDataset(make_config(use_gene_list_cache=False)))
+        # the first run writes the sidecar, the second reads it
+        measure("H5ADDataset (uns only, write sidecar)", lambda: H5ADDataset(make_config()))
+        measure("H5ADDataset (sidecar)", lambda: H5ADDataset(make_config()))
+
+        reference = sc.read_h5ad(path).uns["gene_list"]["names"]
+        dataset = H5ADDataset(make_config())
+        assert all(
+            dataset[i]["genes"] == list(reference[cell_type][:10]) for i, cell_type in enumerate(reference.dtype.names)
+        ), "the datasets return different samples"
+
+
+if __name__ == "__main__":
+    tyro.cli(benchmark)
@@ -0,0 +1,122 @@
+import h5py
+import tyro
+import tempfile
+import numpy as np
+import pandas as pd
+import scanpy as sc
+import anndata as ad
+
+from pathlib import Path
+from dataclasses import replace
+
+from soar_benchmark.markers import MarkerConfig, rank_marker_genes
+from analysis.benchmark.common import megabytes, measure, timed, write_h5ad_skeleton
+
+
+def write_synthetic_atlas(
+    path: Path,
+    num_cells: int,
+    num_genes: int,
+    num_groups: int,
+    nonzeros_per_cell: int,
+    marker_genes: int,
+    chunk_size: int,
+):
+    """Write a CSR count matrix chunk by chunk, where the cells of group k express genes `k * marker_genes` onwards
+    more highly."""
+    rng = np.random.default_rng(0)
+    groups = rng.integers(num_groups, size=num_cells)
+    stratum = num_genes // nonzeros_per_cell
+    with h5py.File(path, "w") as f:
+        obs = pd.DataFrame(
+            {"cell_type": pd.Categorical.from_codes(groups, [f"cell type {k}" for k in range(num_groups)])},
+            index=[f"cell{i}" for i in range(num_cells)],
+        )
+        X = write_h5ad_skeleton(f, obs, [f"GENE{j}" for j in range(num_genes)], (num_cells, num_genes))
+        num_nonzeros = num_cells * nonzeros_per_cell
+        # scipy expects the same dtype for indptr and indices
+        index_dtype = np.int32 if num_nonzeros < 2**31 else np.int64
+        X.create_dataset("indptr", data=np.arange(num_cells + 1, dtype=index_dtype) * nonzeros_per_cell)
+        data = X.create_dataset("data", shape=(num_nonzeros,), dtype=np.float32)
+        indices = X.create_dataset("indices", shape=(num_nonzeros,), dtype=index_dtype)
+        for start in range(0, num_cells, chunk_size):
+            end = min(start + chunk_size, num_cells)
+            # one gene per stratum keeps the columns of a row sorted and distinct
+            columns = np.arange(nonzeros_per_cell) * stratum + rng.integers(
+                stratum, size=(end - start, nonzeros_per_cell)
+            )
+            values = rng.poisson(1.0, size=columns.shape).astype(np.float32) + 1
+            markers = columns // marker_genes == groups[start:end, None]
+            values[markers] *= 5
+            data[start * nonzeros_per_cell : end * nonzeros_per_cell] = values.ravel()
+            indices[start * nonzeros_per_cell : end * nonzeros_per_cell] = columns.ravel()
+
+
+def rank_with_scanpy(h5ad_path: Path, output_path: Path, n_genes: int, method: str):
+    adata = sc.read_h5ad(h5ad_path)
+    sc.pp.normalize_total(adata, target_sum=1e4)
+    sc.pp.log1p(adata)
+    sc.tl.rank_genes_groups(adata, "cell_type", method=method, n_genes=n_genes, key_added="gene_list")
+    ad.AnnData(uns={"gene_list": {"names": adata.uns["gene_list"]["names"]}}).write_h5ad(output_path)
+
+
+def benchmark(
+    num_cells: int = 1_000_000,
+    num_genes: int = 2_000,
+    num_groups: int = 20,
+    nonzeros_per_cell: int = 100,
+    marker_genes: int = 20,
+    n_genes: int = 100,
+    chunk_size: int = 50_000,
+    num_workers: int = 4,
+    scanpy_max_cells: int = 200_000,
+):
+    """Rank the marker genes of a synthetic sparse atlas out of core, and in memory with scanpy for small atlases."""
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = Path(tmp_dir) / "atlas.h5ad"
+        _, seconds = timed(
+            lambda: write_synthetic_atlas(
+                path, num_cells, num_genes, num_groups, nonzeros_per_cell, marker_genes, chunk_size
+            )
+        )
+        print(f"{megabytes(path.stat().st_size)} atlas of {num_cells} cells written in {seconds:.1f}s")
+
+        config = MarkerConfig(
+            h5ad_path=str(path),
+            groupby="cell_type",
+            n_genes=n_genes,
+            normalize_total=1e4,
+            chunk_size=chunk_size,
+        )
+        outputs = {}
+        for method in ["t-test", "wilcoxon"]:
+            for workers in sorted({0, num_workers}):
+                outputs[method, workers] = Path(tmp_dir) / f"{method}_{workers}.h5ad"
+                run_config = replace(
+                    config, method=method, num_workers=workers, output_path=str(outputs[method, workers])
+                )
+                measure(
+                    f"prepare-markers {method}, {workers} workers",
+                    lambda: rank_marker_genes(run_config),
+                    workers=True,
+                )
+
+        if num_cells > scanpy_max_cells:
+            return
+        for method in ["t-test", "wilcoxon"]:
+            scanpy_path = Path(tmp_dir) / f"scanpy_{method}.h5ad"
+            measure(
+                f"sc.tl.rank_genes_groups {method}",
+                lambda: rank_with_scanpy(path, scanpy_path, n_genes, method),
+                workers=True,
+            )
+            expected = sc.read_h5ad(scanpy_path).uns["gene_list"]["names"]
+            names = sc.read_h5ad(outputs[method, 0]).uns["gene_list"]["names"]
+            overlap = np.mean(
+                [len(set(names[group][:10]) & set(expected[group][:10])) / 10 for group in expected.dtype.names]
+            )
+            print(f"{method}: {overlap:.1%} of the scanpy top 10 genes ranked in the top 10")
+
+
+if __name__ == "__main__":
+    tyro.cli(benchmark)
@@ -0,0 +1,54 @@
+import tyro
+
+from typing import List
+from soar_benchmark.pipeline import GenerationConfig
+from analysis.benchmark.common import annotation_task, load_pipeline, prepare_prompts, report, timed
+
+
+def benchmark(
+    model_name: str,
+    json_path: str,
+    demo_path: str = "",
+    prompters: List[str] = ["zero_shot", "zero_shot_cot", "few_shot"],
+    num_samples: int = 256,
+    batch_size: int = 8,
+    torch_dtype: str = "bfloat16",
+    device_map: str = "auto",
+    output_folder: str = "outputs/benchmark/prefix_cache",
+):
+    """Measure the prefill time of every prompter with and without the shared-prefix KV cache."""
+    pipeline = load_pipeline(model_name, batch_size, torch_dtype, device_map, engine="continuous", prefix_caching=True)
+    # a single new token makes the run dominated by prefill
+    generation_config = GenerationConfig(max_new_tokens=1, do_sample=False)
+
+    for prompter_name in prompters:
+        task = annotation_task(
+            pipeline,
+            prompter_name,
+            f"{output_folder}/{prompter_name}",
+            json_path=json_path,
+            demo_path=demo_path,
+            use_demo=prompter_name == "few_shot",
+        )
+        _, messages = prepare_prompts(task, num_samples)
+        list_of_input_ids = [pipeline.encode_messages(message) for message in messages]
+
+        timings = {}
+        for prefix_caching in [False, True]:
+            pipeline.engine.set_prefix([])
+            if prefix_caching:
+                pipeline.prepare_prefix_cache(messages)
+            _, timings[prefix_caching] = timed(lambda: pipeline.engine.generate(list_of_input_ids, generation_config))
+
+        num_prompt_tokens = sum(len(input_ids) for input_ids in list_of_input_ids) / len(list_of_input_ids)
+        report(
+            prompter_name,
+            f"prefix {len(pipeline.engine.prefix_ids)} / {num_prompt_tokens:.1f} tokens",
+            f"full prefill {timings[False]:.3f}s",
+            f"prefix cache {timings[True]:.3f}s",
+            f"speedup {timings[False] / timings[True]:.2f}x",
+        )
+
+
+if __name__ == "__main__":
+    tyro.cli(benchmark)
@@ -0,0 +1,93 @@
+import tyro
+import numpy as np
+
+from soar_benchmark.task import prompter_cls
+from analysis.benchmark.common import report, timed
+
+
+def synthetic_samples(num_samples: int, num_genes: int, genes_per_sample: int, num_demos: int) -> list[dict]:
+    rng = np.random.default_rng(0)
+    demo = [
+        {
+            "gene_names": [f"GENE{j}" for j in rng.integers(num_genes, size=genes_per_sample)],
+            "tissue": "blood",
+            "reasoning": "These markers are expressed by one cell type.\nThe {first} gene marks it best.",
+            "cell_type": f"cell type {k}",
+        }
+        for k in range(num_demos)
+    ]
+    return [
+        {
+            "index": i,
+            "tissue": ["blood", "lung", "brain", "liver"][i % 4],
+            "genes": [f"GENE{j}" for j in genes],
+            "demo": demo,
+        }
+        for i, genes in enumerate(rng.integers(num_genes, size=(num_samples, genes_per_sample)).tolist())
+    ]
+
+
+def render_per_sample(prompter_name: str, batch: list[dict], gene_num_limit: int, reasonings=None):
+    # the rendering of `prepare_input` before `render_batch`: a fresh prompter per batch, formatted sample by sample
+    prompter = prompter_cls[prompter_name]()
+    messages = []
+    for i, sample in enumerate(batch):
+        kwargs = {"demo": sample["demo"]} if prompter_name == "few_shot" else {}
+        if reasonings is not None:
+            kwargs["reasoning"] = reasonings[i]
+        messages.append(prompter.get_messages(sample["tissue"], sample["genes"][:gene_num_limit], **kwargs))
+    return messages
+
+
+def benchmark(
+    num_samples: int = 100_000,
+    num_genes: int = 20_000,
+    genes_per_sample: int = 20,
+    gene_num_limit: int = 10,
+    num_demos: int = 3,
+    batch_size: int = 64,
+):
+    """Render the prompts of synthetic samples with every prompter, sample by sample and with ``render_batch``."""
+    samples = synthetic_samples(num_samples, num_genes, genes_per_sample, num_demos)
+    reasonings = [f"Reasoning {{{i}}} about the markers." for i in range(num_samples)]
+    cases = [(name, None) for name in prompter_cls] + [
+        (f"{name} (answer)", reasonings) for name in ["zero_shot_cot", "zero_shot_cot_scact"]
+    ]
+    for case, case_reasonings in cases:
+        prompter_name = case.split(" ")[0]
+        batches = [
+            (
+                samples[start : start + batch_size],
+                case_reasonings[start : start + batch_size] if case_reasonings is not None else None,
+            )
+            for start in range(0, num_samples, batch_size)
+        ]
+
+        # rendered prompts are dropped right away, keeping 100k of them alive slows the garbage collector down
+        def run(render):
+            for batch, batch_reasonings in batches:
+                render(batch, batch_reasonings)
+
+        _, per_sample_seconds = timed(
+            lambda: run(lambda batch, reasonings: render_per_sample(prompter_name, batch, gene_num_limit, reasonings))
+        )
+        prompter = prompter_cls[prompter_name]()
+        _, batch_seconds = timed(
+            lambda: run(lambda batch, reasonings: prompter.render_batch(batch, gene_num_limit, reasonings=reasonings))
+        )
+
+        identical = all(
+            prompter.render_batch(batch, gene_num_limit, reasonings=batch_reasonings)
+            == render_per_sample(prompter_name, batch, gene_num_limit, batch_reasonings)
+            for batch, batch_reasonings in batches
+        )
+        report(
+            case,
+            f"{per_sample_seconds / num_samples * 1e6:.2f}us per sample one by one",
+            f"{batch_seconds / num_samples * 1e6:.2f}us with render_batch ({per_sample_seconds / batch_seconds:.1f}x)",
+            f"identical prompts: {identical}",
+        )
+
+
+if __name__ == "__main__":
+    tyro.cli(benchmark)
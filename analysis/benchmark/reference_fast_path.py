@@ -0,0 +1,87 @@
+import json
+import tyro
+import tempfile
+import numpy as np
+
+from pathlib import Path
+from dataclasses import replace
+
+from soar_benchmark.reference import ReferenceAtlas, ReferenceAtlasConfig
+from analysis.benchmark.common import report, timed
+
+
+def benchmark(
+    num_cell_types: int = 500,
+    num_genes: int = 20_000,
+    reference_genes: int = 50,
+    family_size: int = 5,
+    shared_fraction: float = 0.5,
+    num_samples: int = 100_000,
+    sample_genes: int = 10,
+    noise_levels: tuple[float, ...] = (0.0, 0.2, 0.4, 0.6, 0.8),
+    thresholds: tuple[float, ...] = (0.6, 0.7, 0.8, 0.9),
+    margin: float = 0.2,
+):
+    """Score synthetic marker lists against synthetic reference signatures, reporting the share of samples the fast
+    path answers and how many of those answers are right for every threshold.
+
+    Cell types come in families of ``family_size`` whose signatures share ``shared_fraction`` of their genes at
+    random ranks. Every sample draws its genes from the top genes of one reference signature, shuffled a little, and
+    replaces each gene by a random one with probability ``noise``.
+    """
+    rng = np.random.default_rng(0)
+    num_shared = int(reference_genes * shared_fraction)
+    num_families = -(-num_cell_types // family_size)
+    genes = rng.permutation(num_genes)
+    family_genes = genes[: num_families * num_shared].reshape(num_families, num_shared)
+    own_genes = genes[num_families * num_shared :][: num_cell_types * (reference_genes - num_shared)]
+    signatures = np.concatenate(
+        [
+            family_genes[np.arange(num_cell_types) // family_size],
+            own_genes.reshape(num_cell_types, reference_genes - num_shared),
+        ],
+        axis=1,
+    )
+    signatures = np.take_along_axis(signatures, rng.random(signatures.shape).argsort(axis=1), axis=1)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = Path(tmp_dir) / "reference.json"
+        with open(path, "w") as f:
+            json.dump(
+                [
+                    {"cell_type": f"cell type {k}", "gene_names": [f"GENE{j}" for j in genes]}
+                    for k, genes in enumerate(signatures.tolist())
+                ],
+                f,
+            )
+        config = ReferenceAtlasConfig(path=str(path), num_genes=reference_genes, margin=margin)
+        atlas = ReferenceAtlas(config)
+
+        for noise in noise_levels:
+            cell_types = rng.integers(num_cell_types, size=num_samples)
+            # nearby ranks swap places
+            ranks = np.argsort(np.arange(sample_genes * 2) + rng.normal(0, 2, (num_samples, sample_genes * 2)), axis=1)
+            genes = np.take_along_axis(signatures[cell_types], ranks[:, :sample_genes], axis=1)
+            replaced = rng.random(genes.shape) < noise
+            genes[replaced] = rng.integers(num_genes, size=replaced.sum())
+            gene_lists = [[f"GENE{j}" for j in row] for row in genes.tolist()]
+
+            _, seconds = timed(
+                lambda: [
+                    atlas.score(gene_lists[i : i + config.batch_size]) for i in range(0, num_samples, config.batch_size)
+                ]
+            )
+            report(f"noise {noise:.1f}", f"scored in {seconds / num_samples * 1e6:.1f}us per sample")
+            for threshold in thresholds:
+                atlas.config = replace(config, threshold=threshold)
+                matches = atlas.match(gene_lists)
+                answered = [(match, k) for match, k in zip(matches, cell_types) if match is not None]
+                correct = sum(match["cell_type"] == f"cell type {k}" for match, k in answered)
+                report(
+                    f"  threshold {threshold:.1f}",
+                    f"{len(answered) / num_samples:.1%} of the model calls saved",
+                    f"{correct / max(len(answered), 1):.2%} of them right",
+                )
+
+
+if __name__ == "__main__":
+    tyro.cli(benchmark)
@@ -0,0 +1,51 @@
+import tyro
+
+from dataclasses import replace
+
+from soar_benchmark.pipeline import GenerationConfig
+from analysis.benchmark.common import annotation_task, load_pipeline, prepare_prompts, report, timed
+
+
+def benchmark(
+    model_name: str,
+    json_path: str,
+    prompter: str = "zero_shot",
+    num_samples: int = 64,
+    num_votes: int = 5,
+    batch_size: int = 8,
+    max_new_tokens: int = 64,
+    torch_dtype: str = "bfloat16",
+    device_map: str = "auto",
+    output_folder: str = "outputs/benchmark/self_consistency",
+):
+    """Compare drawing `num_votes` answers per prompt in one run against `num_votes` single-sample runs."""
+    pipeline = load_pipeline(model_name, batch_size, torch_dtype, device_map, engine="continuous")
+    task = annotation_task(pipeline, prompter, output_folder, json_path=json_path)
+    samples, messages = prepare_prompts(task, num_samples)
+    num_answers = len(samples) * num_votes
+
+    def measure(generation_config: GenerationConfig, num_runs: int) -> float:
+        prefill_tokens = pipeline.stats.get("engine/prefill_tokens")
+
+        def run():
+            for run in range(num_runs):
+                # independent runs only differ in their seeds
+                pipeline(messages, generation_config, seeds=[i * num_votes + run for i in range(len(messages))])
+
+        _, seconds = timed(run)
+        report(
+            f"num_samples={generation_config.num_samples} x {num_runs} runs",
+            f"{seconds:.3f}s",
+            f"{num_answers / seconds:.1f} answers/s",
+            f"{int(pipeline.stats.get('engine/prefill_tokens') - prefill_tokens)} prefill tokens",
+        )
+        return seconds
+
+    generation_config = GenerationConfig(max_new_tokens=max_new_tokens, do_sample=True)
+    independent_seconds = measure(generation_config, num_votes)
+    shared_seconds = measure(replace(generation_config, num_samples=num_votes), 1)
+    print(f"speedup {independent_seconds / shared_seconds:.2f}x")
+
+
+if __name__ == "__main__":
+    tyro.cli(benchmark)
@@ -0,0 +1,60 @@
+import json
+import tyro
+import pandas as pd
+
+from analysis.cell_type_annotation.answer_cleansing import clean_answer
+
+
+def vote(
+    chat_results_path: str,
+    output_path: str = "",
+    instruction_prefix: str = "",
+    instruction_prefix_group_index: int = 0,
+    instruction_model: str = "",
+    model_name: str = "",
+):
+    """Reduce the sampled answers of every record to their majority answer after cleaning.
+
+    The voted results keep the format of the chat results, with the first sampled answer of the winning cell type as
+    `messages[0]`, so the evaluation scripts run on them unchanged. Ties go to the answer sampled first.
+    """
+    with open(chat_results_path) as f:
+        results = json.load(f)
+
+    answers = pd.DataFrame(
+        [
+            (i, j, outputs["generated_text"][-1]["content"])
+            for i, result in enumerate(results)
+            for j, outputs in enumerate(result["messages"])
+        ],
+        columns=["record", "sample", "answer"],
+    )
+    # samples repeat each other, so every distinct answer is cleaned once
+    unique_answers = answers["answer"].unique()
+    cleaned_answers = [
+        clean_answer(answer, instruction_prefix, instruction_prefix_group_index, instruction_model, model_name)
+        for answer in unique_answers
+    ]
+    answers["cleaned"] = answers["answer"].map(dict(zip(unique_answers, cleaned_answers)))
+
+    votes = answers.groupby(["record", "cleaned"], sort=False).agg(votes=("sample", "size"), sample=("sample", "min"))
+    votes = votes.reset_index().sort_values(["record", "votes", "sample"], ascending=[True, False, True])
+    winners = votes.drop_duplicates("record").set_index("record")
+
+    counts = {i: dict(zip(group["cleaned"], group["votes"].tolist())) for i, group in votes.groupby("record")}
+    voted_results = [
+        {**result, "messages": [result["messages"][winners.loc[i, "sample"]]], "votes": counts[i]}
+        for i, result in enumerate(results)
+    ]
+
+    agreement = (winners["votes"] / answers.groupby("record").size()).mean()
+    print(f"{len(results)} records, {len(answers) / len(results):.1f} samples per record, agreement {agreement:.3f}")
+
+    output_path = output_path or chat_results_path.replace(".json", "_voted.json")
+    with open(output_path, "w") as f:
+        json.dump(voted_results, f, indent=4)
+    print(f"Saved the voted results to {output_path}")
+
+
+if __name__ == "__main__":
+    tyro.cli(vote)
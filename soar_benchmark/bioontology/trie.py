@@ -0,0 +1,108 @@
+import os
+import re
+import json
+import pickle
+import hashlib
+
+from pathlib import Path
+
+
+def read_ontology_labels(path: str) -> list[str]:
+    """Read cell type labels from an OBO ontology (term names and exact synonyms), a JSON list or a text file."""
+    path = Path(path)
+    if path.suffix == ".json":
+        with open(path) as f:
+            return json.load(f)
+    if path.suffix != ".obo":
+        with open(path) as f:
+            return [line.strip() for line in f if line.strip()]
+
+    labels = []
+    with open(path) as f:
+        stanzas = f.read().split("\n\n")
+    for stanza in stanzas:
+        lines = stanza.strip().splitlines()
+        if not lines or lines[0] != "[Term]":
+            continue
+        fields = [line.split(": ", 1) for line in lines[1:] if ": " in line]
+        if ["is_obsolete", "true"] in fields or not any(k == "id" and v.startswith("CL:") for k, v in fields):
+            continue
+
+        for key, value in fields:
+            if key == "name":
+                labels.append(value.strip())
+            elif key == "synonym":
+                match = re.match(r'"(.*)" EXACT', value)
+                if match:
+                    labels.append(match.group(1))
+    return labels
+
+
+class LabelTrie:
+    """Prefix trie over the token ids of a label set, used to restrict decoding to complete labels.
+
+    Node 0 is the root. A terminal node also allows the terminators, so a label that is the prefix of a longer label can
+    still be ended; a terminal node without children completes the answer by itself.
+    """
+
+    def __init__(self, list_of_token_ids: list[list[int]], terminator_ids: list[int]):
+        self.children: list[dict[int, int]] = [{}]
+        self.terminal: list[bool] = [False]
+        self.terminator_ids = list(terminator_ids)
+        for token_ids in list_of_token_ids:
+            self.insert(token_ids)
+
+    def insert(self, token_ids: list[int]):
+        node = 0
+        for token_id in token_ids:
+            if token_id not in self.children[node]:
+                self.children[node][token_id] = len(self.children)
+                self.children.append({})
+                self.terminal.append(False)
+            node = self.children[node][token_id]
+        self.terminal[node] = True
+
+    def allowed_tokens(self, node: int) -> list[int]:
+        allowed = list(self.children[node])
+        if self.terminal[node]:
+            allowed.extend(self.terminator_ids)
+        return allowed
+
+    def next(self, node: int, token_id: int) -> int:
+        return self.children[node][token_id]
+
+    def is_complete(self, node: int) -> bool:
+        return self.terminal[node] and not self.children[node]
+
+    def __len__(self):
+        return len(self.children)
+
+    @classmethod
+    def from_labels(cls, labels: list[str], tokenizer, terminator_ids: list[int], cache_dir: str = "") -> "LabelTrie":
+        """Tokenize ``labels`` into a trie, reusing the copy pickled in ``cache_dir`` for the same labels and tokenizer.
+
+        Every label is inserted as it is tokenized at the start of a response and after a space, i.e. when it continues
+        an answer trigger.
+        """
+        labels = sorted(set(labels))
+        key = hashlib.sha256(
+            json.dumps([labels, tokenizer.name_or_path, len(tokenizer), terminator_ids]).encode()
+        ).hexdigest()
+        cache_path = Path(cache_dir) / f"label_trie_{key[:16]}.pkl" if cache_dir else None
+        if cache_path is not None and cache_path.exists():
+            with open(cache_path, "rb") as f:
+                return pickle.load(f)
+
+        variants = labels + [f" {label}" for label in labels]
+        trie = cls(tokenizer(variants, add_special_tokens=False)["input_ids"], terminator_ids)
+        if cache_path is not None:
+            cache_path.parent.mkdir(parents=True, exist_ok=True)
+            # pickle into a file of this process and swap it in, so a concurrent run never unpickles a partial trie
+            tmp_path = cache_path.with_name(f"{cache_path.name}.tmp{os.getpid()}")
+            try:
+                with open(tmp_path, "wb") as f:
+                    pickle.dump(trie, f)
+                tmp_path.replace(cache_path)
+            finally:
+                tmp_path.unlink(missing_ok=True)
+        return trie
@@ -0,0 +1,310 @@
+import json
+import time
+import fcntl
+import sqlite3
+import hashlib
+import numpy as np
+
+from pathlib import Path
+from dataclasses import asdict
+from typing import Any, Optional
+
+from soar_benchmark.pipeline import GenerationConfig, PipelineBase
+from soar_benchmark.utils.digest import file_digest
+from soar_benchmark.utils.stats import RunStats
+
+
+class ResponseCache:
+    """Content-addressed store of pipeline responses in a local SQLite file.
+
+    Entries are evicted in least-recently-used order once the stored responses exceed ``max_bytes``.
+    """
+
+    def __init__(self, path: str, max_bytes: int, stats: Optional[RunStats] = None):
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self.conn = sqlite3.connect(path)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, value TEXT, size INTEGER, accessed REAL)"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)")
+        self.conn.commit()
+        self.max_bytes = max_bytes
+        self.stats = stats if stats is not None else RunStats()
+
+    def get_many(self, keys: list[str]) -> dict[str, Any]:
+        found = {}
+        # stay below the SQLite host parameter limit
+        for start in range(0, len(keys), 500):
+            chunk = keys[start : start + 500]
+            rows = self.conn.execute(
+                f"SELECT key, value FROM responses WHERE key IN ({','.join('?' * len(chunk))})", chunk
+            ).fetchall()
+            found.update({key: json.loads(value) for key, value in rows})
+
+        now = time.time()
+        self.conn.executemany("UPDATE responses SET accessed = ? WHERE key = ?", [(now, key) for key in found])
+        self.conn.commit()
+        return found
+
+    def put_many(self, items: dict[str, Any]):
+        now = time.time()
+        rows = []
+        for key, value in items.items():
+            value = json.dumps(value)
+            rows.append((key, value, len(value.encode()), now))
+        self.conn.executemany("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?)", rows)
+        self.conn.commit()
+        self.evict()
+
+    def evict(self):
+        total = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+
+        evicted = []
+        for key, size in self.conn.execute("SELECT key, size FROM responses ORDER BY accessed"):
+            if total <= self.max_bytes:
+                break
+            evicted.append((key,))
+            total -= size
+        self.conn.executemany("DELETE FROM responses WHERE key = ?", evicted)
+        self.conn.commit()
+        self.stats.add("cache/evictions", len(evicted))
+
+
+class CachedPipeline:
+    """Wrap a pipeline so responses are served from a ``ResponseCache`` when possible.
+
+    Only the cache misses of a batch are sent to the wrapped pipeline, in their original order. Both ``__call__`` and
+    ``generate_cot`` are cached, every other attribute is forwarded to the wrapped pipeline. Sampled calls without
+    per-sample seeds bypass the cache, as repeated prompts would otherwise all get the response of the first one.
+    """
+
+    def __init__(self, pipeline: PipelineBase, cache: ResponseCache):
+        self.pipeline = pipeline
+        self.cache = cache
+        # constrained answers depend on the ontology file, not only on its path
+        ontology_path = pipeline.config.ontology_path
+        self.ontology_digest = file_digest(ontology_path) if ontology_path else None
+        self.pipeline.stats.derive("cache/hit_rate", "cache/hits", "cache/lookups")
+
+    def __getattr__(self, name):
+        return getattr(self.pipeline, name)
+
+    def get_key(
+        self,
+        message: list[dict[str, str]],
+        generation_config: GenerationConfig,
+        seed: Optional[int] = None,
+        call_kwargs: Optional[dict[str, Any]] = None,
+    ) -> str:
+        config = self.pipeline.config
+        content = {
+            "model_name": config.model_name,
+            "local_ckpt_path": config.local_ckpt_path,
+            "local_finetuned_ckpt_path": config.local_finetuned_ckpt_path,
+            "pipeline_class_name": config.pipeline_class_name,
+            # quantization, attention implementation, revision, chat template, ...
+            "model_kwargs": config.model_kwargs,
+            "tokenizer_kwargs": config.tokenizer_kwargs,
+            # settings of the engine that change the decoded tokens
+            "torch_dtype": config.torch_dtype,
+            "engine": config.engine,
+            "draft_model_name": config.draft_model_name,
+            "num_draft_tokens": config.num_draft_tokens if config.draft_model_name else None,
+            "ontology": self.ontology_digest,
+            "messages": message,
+            "generation": asdict(generation_config),
+            # greedy decoding does not depend on the seed
+            "seed": seed if generation_config.do_sample else None,
+        }
+        if call_kwargs:
+            content["call_kwargs"] = call_kwargs
+        return hashlib.sha256(json.dumps(content, sort_keys=True, default=str).encode()).hexdigest()
+
+    def bypass(self, messages: list, generation_config: GenerationConfig, seeds: Optional[list[int]]) -> bool:
+        if generation_config.do_sample and seeds is None:
+            self.pipeline.stats.add("cache/bypassed", len(messages))
+            return True
+        return False
+
+    def __call__(
+        self,
+        messages: list[dict[str, str]],
+        generation_config: GenerationConfig,
+        seeds: Optional[list[int]] = None,
+        **kwargs,
+    ) -> list:
+        if self.bypass(messages, generation_config, seeds):
+            return self.pipeline(messages, generation_config, seeds=seeds, **kwargs)
+
+        sample_seeds = seeds if seeds is not None else [None] * len(messages)
+        keys = [self.get_key(message, generation_config, seed, kwargs) for message, seed in zip(messages, sample_seeds)]
+        cached = self.cache.get_many(keys)
+        misses = [i for i, key in enumerate(keys) if key not in cached]
+        self.pipeline.stats.add("cache/lookups", len(keys))
+        self.pipeline.stats.add("cache/hits", len(keys) - len(misses))
+        self.pipeline.stats.add("cache/misses", len(misses))
+
+        if misses:
+            miss_seeds = [seeds[i] for i in misses] if seeds is not None else None
+            responses = self.pipeline([messages[i] for i in misses], generation_config, seeds=miss_seeds, **kwargs)
+            new_items = {keys[i]: response for i, response in zip(misses, responses)}
+            self.cache.put_many(new_items)
+            cached.update(new_items)
+
+        return [cached[key] for key in keys]
+
+    def generate_cot(
+        self,
+        messages: list[list[dict[str, str]]],
+        answer_triggers: list[str],
+        generation_config: GenerationConfig,
+        seeds: Optional[list[int]] = None,
+        answer_generation_config: Optional[GenerationConfig] = None,
+        **kwargs,
+    ) -> tuple[list[str], list[str]]:
+        if self.bypass(messages, generation_config, seeds):
+            return self.pipeline.generate_cot(
+                messages,
+                answer_triggers,
+                generation_config,
+                seeds=seeds,
+                answer_generation_config=answer_generation_config,
+                **kwargs,
+            )
+
+        # a message is cached with the reasonings and answers of all its samples
+        sample_seeds = seeds if seeds is not None else [None] * len(messages)
+        keys = [
+            self.get_key(
+                message,
+                generation_config,
+                seed,
+                {
+                    "call": "generate_cot",
+                    "answer_trigger": trigger,
+                    "answer_generation": asdict(answer_generation_config or generation_config),
+                    **kwargs,
+                },
+            )
+            for message, trigger, seed in zip(messages, answer_triggers, sample_seeds)
+        ]
+        cached = self.cache.get_many(keys)
+        misses = [i for i, key in enumerate(keys) if key not in cached]
+        self.pipeline.stats.add("cache/lookups", len(keys))
+        self.pipeline.stats.add("cache/hits", len(keys) - len(misses))
+        self.pipeline.stats.add("cache/misses", len(misses))
+
+        if misses:
+            reasonings, answers = self.pipeline.generate_cot(
+                [messages[i] for i in misses],
+                [answer_triggers[i] for i in misses],
+                generation_config,
+                seeds=[seeds[i] for i in misses] if seeds is not None else None,
+                answer_generation_config=answer_generation_config,
+                **kwargs,
+            )
+            k = generation_config.num_samples
+            new_items = {
+                keys[i]: [reasonings[j * k : (j + 1) * k], answers[j * k : (j + 1) * k]] for j, i in enumerate(misses)
+            }
+            self.cache.put_many(new_items)
+            cached.update(new_items)
+
+        reasonings = [reasoning for key in keys for reasoning in cached[key][0]]
+        answers = [answer for key in keys for answer in cached[key][1]]
+        return reasonings, answers
+
+
+class PromptCache:
+    """Token ids of the rendered prompts of a dataset, stored in ``cache_dir`` as one ``.npz`` file per key.
+
+    Prompts are looked up by sample index. Loaded prompts stay in flat arrays and are only turned into lists on lookup.
+    """
+
+    def __init__(self, cache_dir: str, key: str):
+        self.path = Path(cache_dir) / f"prompt_ids_{key[:16]}.npz"
+        self.ids = np.zeros(0, dtype=np.int64)
+        self.offsets: dict[int, tuple[int, int]] = {}
+        self.new_prompt_ids: dict[int, list[int]] = {}
+        if self.path.exists():
+            self.ids, self.offsets = self.read(self.path)
+
+    @staticmethod
+    def read(path: Path) -> tuple[np.ndarray, dict[int, tuple[int, int]]]:
+        with np.load(path) as data:
+            starts = np.concatenate([[0], np.cumsum(data["lengths"])])
+            offsets = {
+                index: (start, end) for index, start, end in zip(data["indices"].tolist(), starts[:-1], starts[1:])
+            }
+            return data["ids"], offsets
+
+    @staticmethod
+    def make_key(
+        dataset_config,
+        prompter_name: str,
+        template_digest: str,
+        gene_num_limit: int,
+        pipeline_class_name: str,
+        tokenizer,
+    ) -> str:
+        dataset = asdict(dataset_config)
+        files = [
+            file_digest(value)
+            for value in dataset.values()
+            if isinstance(value, str) and value and Path(value).is_file()
+        ]
+        content = [
+            dataset,
+            files,
+            prompter_name,
+            template_digest,
+            gene_num_limit,
+            pipeline_class_name,
+            tokenizer.name_or_path,
+            len(tokenizer),
+            tokenizer.chat_template,
+        ]
+        return hashlib.sha256(json.dumps(content, default=str).encode()).hexdigest()
+
+    def __len__(self):
+        return len(self.offsets) + len(self.new_prompt_ids)
+
+    def get(self, index: int) -> Optional[list[int]]:
+        if index in self.offsets:
+            start, end = self.offsets[index]
+            return self.ids[start:end].tolist()
+        return self.new_prompt_ids.get(index)
+
+    def put(self, index: int, input_ids: list[int]):
+        if index not in self.offsets:
+            self.new_prompt_ids[index] = input_ids
+
+    def save(self):
+        if not self.new_prompt_ids:
+            return
+
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        # concurrent runs, e.g. the shards of one run, share the file: under the lock, the prompts another run saved
+        # since this one loaded the file are merged in, instead of being overwritten
+        with open(self.path.with_suffix(".lock"), "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            prompts = {index: self.ids[start:end] for index, (start, end) in self.offsets.items()}
+            if self.path.exists():
+                ids, offsets = self.read(self.path)
+                prompts.update({index: ids[start:end] for index, (start, end) in offsets.items()})
+            for index, input_ids in self.new_prompt_ids.items():
+                prompts.setdefault(index, np.asarray(input_ids, dtype=np.int64))
+
+            # write next to the cache and swap it in, so a concurrent run never reads a partial file
+            tmp_path = self.path.with_suffix(".tmp.npz")
+            np.savez(
+                tmp_path,
+                ids=np.concatenate(list(prompts.values())),
+                lengths=np.array([len(input_ids) for input_ids in prompts.values()], dtype=np.int64),
+                indices=np.array(list(prompts), dtype=np.int64),
+            )
+            tmp_path.replace(self.path)
+            self.ids, self.offsets = self.read(self.path)
+        self.new_prompt_ids = {}
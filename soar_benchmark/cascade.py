@@ -0,0 +1,41 @@
+import math
+
+from collections import Counter
+from dataclasses import dataclass
+from typing import Any, Literal, Optional
+
+from soar_benchmark.pipeline import GenerationConfig, PipelineConfig
+from soar_benchmark.utils.answer_cleansing import clean_answer
+
+
+@dataclass
+class CascadeTierConfig:
+    # the pipeline and generation settings of the task when unset
+    pipeline: Optional[PipelineConfig] = None
+    generation: Optional[GenerationConfig] = None
+    # "log_prob" rates an answer by its geometric mean token probability (decodes with the engine), "agreement" by the
+    # share of the `generation.num_samples` sampled answers agreeing with the majority answer
+    confidence: Literal["log_prob", "agreement"] = "log_prob"
+    # answers rated below the threshold are passed on to the next tier, the last tier answers every sample it gets
+    threshold: float = 0.5
+    # USD per million prompt and completion tokens, to estimate the cost of the tier
+    prompt_token_price: float = 0.0
+    completion_token_price: float = 0.0
+
+
+def answer_confidence(outputs: list[dict[str, Any]], confidence: str) -> tuple[dict[str, Any], Optional[float]]:
+    """Pick the answer among the sampled outputs of a response and rate it between 0 and 1.
+
+    The rating is None for "log_prob" when the pipeline did not record token log-probabilities, which only the engine
+    does.
+    """
+    if confidence == "log_prob":
+        if "mean_log_prob" not in outputs[0]:
+            return outputs[0], None
+        mean_log_prob = outputs[0]["mean_log_prob"]
+        return outputs[0], math.exp(mean_log_prob) if mean_log_prob is not None else 0.0
+
+    # the majority answer after cleaning, ties go to the answer sampled first
+    answers = [clean_answer(output["generated_text"][-1]["content"]).lower() for output in outputs]
+    answer, votes = Counter(answers).most_common(1)[0]
+    return outputs[answers.index(answer)], votes / len(answers) if answer else 0.0
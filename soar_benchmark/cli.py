@@ -1,8 +1,20 @@
+import tyro
+
+from dataclasses import replace
+from typing import Literal, Optional
 from tyro.extras import SubcommandApp
 
-from .run import start_annotation_task
+from .run import (
+    start_annotation_task,
+    start_sharded_annotation_task,
+    merge_annotation_shards,
+    start_sweep,
+    start_server,
+)
+from .markers import MarkerConfig, rank_marker_genes
 from .configs.config_cell_type_annotation import (
     DefinedCellTypeAnnotationTaskConfig,
+    experiments,
 )
 
 app = SubcommandApp()
@@ -10,7 +22,75 @@ app = SubcommandApp()
 
 @app.command
 def annotate(config: DefinedCellTypeAnnotationTaskConfig):
-    start_annotation_task[config.slurm](config)
+    if config.num_shards > 1 and config.shard_index < 0:
+        start_sharded_annotation_task(config)
+    else:
+        start_annotation_task[config.slurm](config)
+
+
+@app.command
+def merge_shards(config: DefinedCellTypeAnnotationTaskConfig):
+    merge_annotation_shards[config.slurm](config)
+
+
+@app.command
+def sweep(
+    experiment_names: tyro.conf.Positional[tuple[str, ...]] = (),
+    mode: Optional[Literal["run", "debug", "local", "slurm"]] = None,
+):
+    """Annotate several experiments (all by default), loading the weights of every model once.
+
+    Args:
+        experiment_names: experiments to annotate, each writes to its own subfolder of the output folder.
+        mode: overrides the slurm mode of every experiment.
+    """
+    experiment_names = experiment_names or tuple(experiments)
+    unknown_names = [name for name in experiment_names if name not in experiments]
+    if unknown_names:
+        raise ValueError(f"Unknown experiments: {', '.join(unknown_names)}")
+
+    selected = {}
+    for name in experiment_names:
+        config = replace(experiments[name], output_folder=f"{experiments[name].output_folder}/{name}")
+        if mode is not None:
+            config = replace(config, slurm=replace(config.slurm, mode=mode))
+        selected[name] = config
+    start_sweep(selected, output_folder=experiments[experiment_names[0]].output_folder)
+
+
+@app.command
+def prepare_markers(config: MarkerConfig):
+    """Rank the marker genes of the cell groups of an H5AD file into the `uns["gene_list"]` read by `H5ADDatasetConfig`."""
+    rank_marker_genes(config)
+
+
+@app.command
+def serve(
+    experiment_names: tyro.conf.Positional[tuple[str, ...]],
+    host: str = "127.0.0.1",
+    port: int = 8000,
+    max_batch_size: int = 64,
+    max_wait_ms: float = 10,
+):
+    """Keep the models of experiments in memory behind a local OpenAI-compatible chat endpoint.
+
+    Args:
+        experiment_names: experiments whose models are served, under their model name and model custom id.
+        max_batch_size: concurrent requests answered together at most.
+        max_wait_ms: time a batch waits for more requests after its first one.
+    """
+    unknown_names = [name for name in experiment_names if name not in experiments]
+    if unknown_names:
+        raise ValueError(f"Unknown experiments: {', '.join(unknown_names)}")
+
+    server = start_server(
+        {name: experiments[name] for name in experiment_names},
+        host=host,
+        port=port,
+        max_batch_size=max_batch_size,
+        max_wait=max_wait_ms / 1000,
+    )
+    server.serve()
 
 
 def main():
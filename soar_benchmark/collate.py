@@ -0,0 +1,48 @@
+import time
+
+from dataclasses import dataclass
+from typing import Any, Callable, Optional
+
+from soar_benchmark.cache import PromptCache
+
+
+@dataclass
+class PromptBatch:
+    samples: list[dict[str, Any]]
+    messages: list[list[dict[str, str]]]
+    # prompt token ids, None when the pipeline tokenizes its prompts itself
+    input_ids: Optional[list[list[int]]] = None
+    num_cached_prompts: int = 0
+    seconds: float = 0.0
+
+
+class PromptCollator:
+    """Render the prompts of a batch and tokenize them, reusing the token ids of a ``PromptCache``.
+
+    Run as the ``collate_fn`` of DataLoader workers, the next batches are prepared while the current one generates.
+    """
+
+    def __init__(
+        self,
+        render: Callable[[list[dict[str, Any]]], list[list[dict[str, str]]]],
+        tokenize: Optional[Callable[[list[dict[str, str]]], list[int]]] = None,
+        prompt_cache: Optional[PromptCache] = None,
+    ):
+        self.render = render
+        self.tokenize = tokenize
+        self.prompt_cache = prompt_cache
+
+    def __call__(self, samples: list[dict[str, Any]]) -> PromptBatch:
+        start = time.perf_counter()
+        batch = PromptBatch(samples, self.render(samples))
+        if self.tokenize is not None:
+            batch.input_ids = []
+            for sample, message in zip(samples, batch.messages):
+                input_ids = self.prompt_cache.get(sample["index"]) if self.prompt_cache is not None else None
+                if input_ids is None:
+                    input_ids = self.tokenize(message)
+                else:
+                    batch.num_cached_prompts += 1
+                batch.input_ids.append(input_ids)
+        batch.seconds = time.perf_counter() - start
+        return batch
@@ -1,5 +1,6 @@
 from soar_benchmark.task import CellTypeAnnotationTaskConfig
 from soar_benchmark.pipeline import PipelineConfig, GenerationConfig
+from soar_benchmark.cascade import CascadeTierConfig
 from .dataset import (
     soar_rna_0shot_dataset,
 )
@@ -301,10 +302,44 @@ experiments = dict(
         slurm=cpu_slurm_config,
         output_folder=output_folder,
     ),
+    soar_rna_with_qwen2_7b_cascade_gpt4_o_zero_shot=CellTypeAnnotationTaskConfig(
+        promter_name="zero_shot",
+        dataset=soar_rna_0shot_dataset,
+        generation=GenerationConfig(),
+        pipeline=PipelineConfig(
+            model_custom_id="qwen2-7b-instruct-cascade-gpt-4o",
+            model_name="Qwen/Qwen2-7B-Instruct",
+            local_ckpt_path=f"{project_path}/datasets/model_cache/Qwen/Qwen2-7B-Instruct",
+            torch_dtype="bfloat16",
+            device_map="auto",
+            tokenizer_kwargs={"padding_side": "left"},
+            batch_size=16,
+            engine="continuous",
+        ),
+        cascade=[
+            CascadeTierConfig(confidence="log_prob", threshold=0.7),
+            CascadeTierConfig(
+                pipeline=PipelineConfig(
+                    model_custom_id="gpt-4o",
+                    model_name="gpt-4o-2024-05-13",
+                    batch_size=4,
+                    api_time_interval=1,
+                    openai_token=openai_token,
+                    pipeline_class_name="ChatGPTCellTypeAnnotationPipeline",
+                ),
+                generation=GenerationConfig(max_new_tokens=1024),
+                prompt_token_price=5.0,
+                completion_token_price=15.0,
+            ),
+        ],
+        slurm=single_gpu_slurm_config,
+        output_folder=output_folder,
+    ),
     soar_rna_with_cell2sent=CellTypeAnnotationTaskConfig(
         promter_name="zero_shot",
         dataset=soar_rna_0shot_dataset,
-        generation=GenerationConfig(max_new_tokens=256),
+        # the sampling settings of the Cell2Sentence model card
+        generation=GenerationConfig(max_new_tokens=256, temperature=1.0, top_p=0.95),
         pipeline=PipelineConfig(
             model_custom_id="pythia-160m-c2s",
             model_name="vandijklab/pythia-160m-c2s",
@@ -1,16 +1,35 @@
+import io
+import os
 import json
-from typing import Union
-import scanpy as sc
+import shutil
+import hashlib
+from typing import Any, Iterator, Optional, Union
+import h5py
+import numpy as np
 import pandas as pd
+import scipy.sparse as sp
 
+from pathlib import Path
 from dataclasses import dataclass
 from torch.utils.data import Dataset
+from anndata.experimental import read_elem
+
+from soar_benchmark.markers import read_chunk
+from soar_benchmark.utils.digest import file_digest
 
 
 @dataclass
 class DatasetBaseConfig:
     demo_path: str = ""
     use_demo: bool = False
+    # few-shot prompts take the demos of this pool (a JSON list like `demo_path`, or JSON lines) whose marker genes
+    # overlap the sample's most instead of the `demo_path` demos; demos whose genes contain the sample's or are
+    # contained in them are skipped, so a pool holding the evaluated samples never hands a sample its own answer
+    demo_pool_path: str = ""
+    # demos retrieved per sample
+    num_retrieved_demos: int = 3
+    # folder of the memory-mapped pool index, `{demo_pool_path}.index` when empty
+    demo_index_dir: str = ""
 
 
 class DatasetBase(Dataset):
@@ -30,6 +49,10 @@ class DatasetBase(Dataset):
     def get_sample(self, index):
         raise NotImplementedError
 
+    def get_labels(self) -> list[Any]:
+        # the label of every sample, datasets override it to skip building the samples
+        return [self.get_sample(i)["label"] for i in range(len(self))]
+
     def __getitem__(self, index):
         sample = self.get_sample(index)
         return sample
@@ -51,6 +74,9 @@ class JSONDataset(DatasetBase):
     def __len__(self):
         return len(self.df)
 
+    def get_labels(self) -> list[Any]:
+        return self.df["annotation"].tolist()
+
     def get_sample(self, index):
         row = self.df.iloc[index]
         dataset = row["subset"]
@@ -79,6 +105,208 @@ class JSONDataset(DatasetBase):
         return sample
 
 
+@dataclass
+class ColumnarDatasetConfig(DatasetBaseConfig):
+    # a JSON array (.json), JSON lines (.jsonl) or Parquet (.parquet) file with the columns read by `JSONDataset`
+    path: str = ""
+    # the parsed columns are written here and memory-mapped on later runs, they are kept in memory when empty
+    cache_dir: str = ""
+    # rows parsed at once from JSON lines and Parquet files
+    chunk_size: int = 8192
+
+
+def read_chunks(path: str, columns: list[str], chunk_size: int) -> Iterator[pd.DataFrame]:
+    suffix = Path(path).suffix
+    if suffix == ".parquet":
+        # pyarrow is only needed for Parquet files
+        try:
+            import pyarrow.parquet as pq
+        except ImportError as e:
+            raise ImportError(
+                f"Reading the Parquet file {path} requires pyarrow, install it with `pip install soar_benchmark[parquet]`"
+            ) from e
+
+        for batch in pq.ParquetFile(path).iter_batches(batch_size=chunk_size, columns=columns):
+            yield batch.to_pandas()
+    elif suffix == ".jsonl":
+        # column types are inferred over the whole file once parsed, see `infer_values`
+        with pd.read_json(path, lines=True, chunksize=chunk_size, dtype=False) as reader:
+            yield from reader
+    else:
+        # a JSON array can only be parsed as a whole
+        yield pd.read_json(path, dtype=False)
+
+
+def to_json_value(value: Any) -> Any:
+    # the JSON value a parsed field was read from, missing values are null whatever the file format
+    if isinstance(value, np.generic):
+        value = value.item()
+    if isinstance(value, float) and np.isnan(value):
+        return None
+    return value
+
+
+def infer_values(column: str, values: list[Any]) -> tuple[list[Any], list[Any]]:
+    """The values ``pd.read_json`` gives for a column holding the JSON ``values``, as `JSONDataset` reads them.
+
+    The column type depends on all of its values (a column without any value is float NaN, integers with missing
+    values are floats), so it is inferred from the vocabulary of the whole file. Returns the values as ``df.iloc``
+    rows hold them and as ``Series.tolist`` does.
+    """
+    if not values:
+        return [], []
+    series = pd.read_json(io.StringIO(json.dumps([{column: value} for value in values])))[column]
+    return list(series.to_numpy()), series.tolist()
+
+
+def intern(values: Union[pd.Series, np.ndarray], vocabulary: dict, normalize=None) -> np.ndarray:
+    # values are only normalized once per distinct value
+    codes, uniques = pd.factorize(values, use_na_sentinel=False)
+    uniques = uniques.tolist() if normalize is None else [normalize(value) for value in uniques.tolist()]
+    ids = np.array([vocabulary.setdefault(value, len(vocabulary)) for value in uniques], dtype=np.int32)
+    return ids[codes]
+
+
+def open_column(path: Path, dtype, length: int) -> np.ndarray:
+    # np.memmap refuses empty files, and a plain array view of the mapping indexes faster than np.memmap
+    return (
+        np.memmap(path, dtype=dtype, mode="r", shape=(length,)).view(np.ndarray) if length else np.zeros(0, dtype=dtype)
+    )
+
+
+class ColumnarDataset(DatasetBase):
+    """The samples of a `JSONDataset` file, parsed once into columns.
+
+    Fields are stored as int32 codes into per-column vocabularies and gene lists as interned gene ids with row offsets,
+    so a lookup only decodes its own row. JSON lines and Parquet files are parsed `chunk_size` rows at a time, and with
+    a `cache_dir` each chunk is appended to the column files on disk, which are memory-mapped once complete.
+    """
+
+    # sample fields and the file columns they are read from
+    fields = {
+        "dataset": "subset",
+        "tissue": "tissue",
+        "label": "annotation",
+        "label_cl": "cl_name",
+        "label_id": "cl_id",
+        "broadtype": "broadtype",
+    }
+
+    def __init__(
+        self,
+        config: ColumnarDatasetConfig,
+    ):
+        super().__init__(config)
+        self.config = config
+        if not config.cache_dir:
+            self.parse()
+            return
+
+        key = hashlib.sha256(json.dumps([file_digest(config.path), self.fields, "json"]).encode()).hexdigest()
+        directory = Path(config.cache_dir) / f"columnar_{key[:16]}"
+        if not (directory / "meta.json").exists():
+            # parse into a private directory first so concurrent shards never read partial columns
+            tmp_directory = directory.with_name(f"{directory.name}.tmp{os.getpid()}")
+            try:
+                tmp_directory.mkdir(parents=True, exist_ok=True)
+                self.parse(tmp_directory)
+                tmp_directory.rename(directory)
+            except OSError:
+                # another process finished first, anything else is raised
+                if not (directory / "meta.json").exists():
+                    raise
+            finally:
+                shutil.rmtree(tmp_directory, ignore_errors=True)
+        self.load(directory)
+
+    def parse(self, directory: Optional[Path] = None):
+        vocabularies = {name: {} for name in [*self.fields, "genes"]}
+        chunks = {name: [] for name in [*self.fields, "gene_ends", "gene_ids"]}
+        files = {name: open(directory / f"{name}.bin", "wb") for name in chunks} if directory is not None else {}
+        num_rows, num_gene_ids = 0, 0
+        try:
+            columns = [*self.fields.values(), "gene list"]
+            for chunk in read_chunks(self.config.path, columns, self.config.chunk_size):
+                arrays = {
+                    name: intern(chunk[column], vocabularies[name], normalize=to_json_value)
+                    for name, column in self.fields.items()
+                }
+                gene_lists = [gene_list.split(",") for gene_list in chunk["gene list"].tolist()]
+                genes = [gene for gene_list in gene_lists for gene in gene_list]
+                arrays["gene_ids"] = intern(np.array(genes, dtype=object), vocabularies["genes"], normalize=str.strip)
+                arrays["gene_ends"] = num_gene_ids + np.cumsum(
+                    [len(gene_list) for gene_list in gene_lists], dtype=np.int64
+                )
+                num_rows += len(chunk)
+                num_gene_ids += len(arrays["gene_ids"])
+                for name, array in arrays.items():
+                    if directory is not None:
+                        files[name].write(array.tobytes())
+                    else:
+                        chunks[name].append(array)
+        finally:
+            for f in files.values():
+                f.close()
+
+        meta = {
+            "num_rows": num_rows,
+            "num_gene_ids": num_gene_ids,
+            "vocabularies": {name: list(vocabulary) for name, vocabulary in vocabularies.items()},
+        }
+        if directory is not None:
+            with open(directory / "meta.json", "w") as f:
+                json.dump(meta, f)
+        else:
+            self.set_vocabularies(meta["vocabularies"])
+            self.columns = {name: np.concatenate(arrays) for name, arrays in chunks.items()}
+
+    def set_vocabularies(self, vocabularies: dict[str, list[Any]]):
+        self.vocabularies = {"genes": vocabularies["genes"]}
+        for name, column in self.fields.items():
+            self.vocabularies[name], values = infer_values(column, vocabularies[name])
+            if name == "label":
+                self.labels = values
+
+    def load(self, directory: Path):
+        with open(directory / "meta.json") as f:
+            meta = json.load(f)
+        self.set_vocabularies(meta["vocabularies"])
+        self.columns = {
+            name: open_column(directory / f"{name}.bin", np.int32, meta["num_rows"]) for name in self.fields
+        }
+        self.columns["gene_ends"] = open_column(directory / "gene_ends.bin", np.int64, meta["num_rows"])
+        self.columns["gene_ids"] = open_column(directory / "gene_ids.bin", np.int32, meta["num_gene_ids"])
+
+    def __len__(self):
+        return len(self.columns["gene_ends"])
+
+    def get_labels(self) -> list[Any]:
+        return [self.labels[i] for i in self.columns["label"].tolist()]
+
+    def get_sample(self, index):
+        gene_ends = self.columns["gene_ends"]
+        start = gene_ends[index - 1] if index > 0 else 0
+        genes = [self.vocabularies["genes"][i] for i in self.columns["gene_ids"][start : gene_ends[index]].tolist()]
+        fields = {name: self.vocabularies[name][self.columns[name][index]] for name in self.fields}
+
+        sample = {
+            "index": index,
+            "dataset": fields["dataset"],
+            "tissue": fields["tissue"],
+            "genes": genes,
+            "label": fields["label"],
+            "label_cl": fields["label_cl"],
+            "label_id": fields["label_id"],
+            "broadtype": fields["broadtype"],
+            "demo": self.demo,
+        }
+        return sample
+
+    def __getitem__(self, index):
+        sample = self.get_sample(index)
+        return sample
+
+
 @dataclass
 class H5ADDatasetConfig(DatasetBaseConfig):
     h5ad_path: str = ""
@@ -86,6 +314,33 @@ class H5ADDatasetConfig(DatasetBaseConfig):
     dataset_name: str = ""
     gene_num: int = 10
     cell_type_to_label: Union[dict[str, str], None] = None
+    # the ranked gene list is cached in a sidecar file here, next to the H5AD file when empty
+    gene_list_cache_dir: str = ""
+    use_gene_list_cache: bool = True
+
+
+def read_ranked_genes(h5ad_path: str) -> tuple[list[str], list[str], np.ndarray]:
+    """Read the cell types, the gene vocabulary and the (rank, cell type) gene ids of ``uns["gene_list"]["names"]``.
+
+    Only that element is read from the HDF5 file, the expression matrix is never loaded.
+    """
+    with h5py.File(h5ad_path, "r") as f:
+        names = read_elem(f["uns/gene_list/names"])
+    cell_types = list(names.dtype.names)
+    columns = np.stack([np.asarray(names[cell_type], dtype=object) for cell_type in cell_types], axis=1)
+    codes, genes = pd.factorize(columns.ravel())
+    return cell_types, genes.tolist(), codes.astype(np.int32).reshape(columns.shape)
+
+
+def save_sidecar(path: Path, **arrays: np.ndarray):
+    """Write ``arrays`` to a temporary file of this process next to ``path`` and swap it in, so concurrent runs never
+    write into the same file or read a partial one."""
+    tmp_path = path.with_name(f"{path.name}.tmp{os.getpid()}.npz")
+    try:
+        np.savez(tmp_path, **arrays)
+        tmp_path.replace(path)
+    finally:
+        tmp_path.unlink(missing_ok=True)
 
 
 class H5ADDataset(DatasetBase):
@@ -95,18 +350,49 @@ class H5ADDataset(DatasetBase):
     ):
         super().__init__(config)
         self.config = config
-        self.adata = sc.read_h5ad(config.h5ad_path)
-        self.sample_list = self.adata.uns["gene_list"]["names"].dtype.names
+        self.sample_list, self.genes, self.gene_ids = self.load_ranked_genes()
+
+    def load_ranked_genes(self) -> tuple[list[str], list[str], np.ndarray]:
+        if not self.config.use_gene_list_cache:
+            return read_ranked_genes(self.config.h5ad_path)
+
+        h5ad_path = Path(self.config.h5ad_path)
+        cache_dir = Path(self.config.gene_list_cache_dir) if self.config.gene_list_cache_dir else h5ad_path.parent
+        sidecar_path = cache_dir / f"{h5ad_path.name}.gene_list.npz"
+        digest = file_digest(self.config.h5ad_path)
+        if sidecar_path.exists():
+            with np.load(sidecar_path) as data:
+                if data["digest"].item() == digest:
+                    return data["cell_types"].tolist(), data["genes"].tolist(), data["gene_ids"]
+
+        cell_types, genes, gene_ids = read_ranked_genes(self.config.h5ad_path)
+        try:
+            cache_dir.mkdir(parents=True, exist_ok=True)
+            save_sidecar(
+                sidecar_path,
+                digest=np.array(digest),
+                cell_types=np.array(cell_types, dtype=str),
+                genes=np.array(genes, dtype=str),
+                gene_ids=gene_ids,
+            )
+        except OSError as e:
+            print(f"Could not write the gene list cache {sidecar_path}: {e}")
+        return cell_types, genes, gene_ids
 
     def __len__(self):
         return len(self.sample_list)
 
+    def get_labels(self) -> list[Any]:
+        if self.config.cell_type_to_label is None:
+            return list(self.sample_list)
+        return [self.config.cell_type_to_label.get(cell_type, cell_type) for cell_type in self.sample_list]
+
     def get_sample(self, index):
         cell_type = self.sample_list[index]
 
         dataset = self.config.dataset_name
         tissue = self.config.tissue
-        genes = list(self.adata.uns["gene_list"]["names"][cell_type][: self.config.gene_num])
+        genes = [self.genes[i] for i in self.gene_ids[: self.config.gene_num, index].tolist()]
         label = (
             cell_type
             if self.config.cell_type_to_label is None
@@ -132,3 +418,191 @@ class H5ADDataset(DatasetBase):
     def __getitem__(self, index):
         sample = self.get_sample(index)
         return sample
+
+
+@dataclass
+class H5ADCellDatasetConfig(DatasetBaseConfig):
+    # AnnData file with one row per cell, every cell is described by its `gene_num` most expressed genes
+    h5ad_path: str = ""
+    tissue: str = ""
+    dataset_name: str = ""
+    gene_num: int = 10
+    # rank the genes of `raw.X` instead of `X`
+    use_raw: bool = False
+    # obs column with known cell labels, a signature is labeled with the most common label of its cells
+    label_key: str = ""
+    # collapse cells by the set of their top genes instead of the ranked list, a signature lists its genes in the order
+    # of its first cell
+    unordered_signatures: bool = False
+    # cells read at once
+    chunk_size: int = 10_000
+    # the cell to signature index is cached in a sidecar file here, next to the H5AD file when empty
+    signature_cache_dir: str = ""
+
+
+def top_expressed_genes(X: sp.csr_matrix, n: int, max_block_size: int = 2**24) -> np.ndarray:
+    """The column indices of the ``n`` largest positive values of every row, largest first and ties by column index.
+
+    Rows are padded to their longest row in blocks of at most ``max_block_size`` values and selected with a row-wise
+    partition. Rows with fewer than ``n`` positive values are padded with -1.
+    """
+    lengths = np.diff(X.indptr)
+    width = max(int(lengths.max(initial=0)), n)
+    block_rows = max(1, max_block_size // width)
+    top = np.full((X.shape[0], n), -1, dtype=np.int32)
+    for start in range(0, X.shape[0], block_rows):
+        block = X[start : start + block_rows]
+        rows, block_lengths = block.shape[0], np.diff(block.indptr)
+        positions = np.arange(block.nnz) - np.repeat(block.indptr[:-1], block_lengths)
+        row_ids = np.repeat(np.arange(rows), block_lengths)
+        values = np.full((rows, width), -np.inf, dtype=np.float32)
+        values[row_ids, positions] = np.where(block.data > 0, block.data, -np.inf)
+        columns = np.full((rows, width), -1, dtype=np.int32)
+        columns[row_ids, positions] = block.indices
+
+        # keep every value above the n-th largest one and the first columns among the values equal to it
+        threshold = np.partition(values, width - n, axis=1)[:, width - n, None]
+        above, equal = values > threshold, values == threshold
+        selected = above | (equal & (np.cumsum(equal, axis=1) <= n - above.sum(axis=1, keepdims=True)))
+        selected_positions = (np.flatnonzero(selected) % width).reshape(rows, n)
+        selected_values = np.take_along_axis(values, selected_positions, axis=1)
+        selected_columns = np.take_along_axis(columns, selected_positions, axis=1)
+
+        order = np.argsort(-selected_values, axis=1, kind="stable")
+        selected_columns = np.take_along_axis(selected_columns, order, axis=1)
+        selected_columns[np.take_along_axis(selected_values, order, axis=1) == -np.inf] = -1
+        top[start : start + rows] = selected_columns
+    return top
+
+
+class H5ADCellDataset(DatasetBase):
+    """One sample per distinct top-``gene_num`` gene signature of the cells of an H5AD file.
+
+    Cells with the same most expressed genes in the same order, or in any order with ``unordered_signatures``, get the
+    same prompt, so they are annotated once and ``fan_out`` passes the answers back to all of them. Cells without any
+    expressed gene have no signature (-1) and are left unanswered. The signatures and the cell to signature index are
+    cached in a ``{file name}.top{gene_num}.cells.npz`` sidecar next to the file.
+    """
+
+    def __init__(
+        self,
+        config: H5ADCellDatasetConfig,
+    ):
+        super().__init__(config)
+        self.config = config
+        h5ad_path = Path(config.h5ad_path)
+        cache_dir = Path(config.signature_cache_dir) if config.signature_cache_dir else h5ad_path.parent
+        variant = f"top{config.gene_num}{'.raw' if config.use_raw else ''}{'.unordered' if config.unordered_signatures else ''}"
+        self.sidecar_path = cache_dir / f"{h5ad_path.name}.{variant}.cells.npz"
+        # the last item changes whenever the sidecar content does, so older sidecars are rebuilt
+        key = json.dumps([file_digest(config.h5ad_path), config.label_key, "skip-empty-cells"])
+        if self.sidecar_path.exists():
+            with np.load(self.sidecar_path) as data:
+                if data["key"].item() == key:
+                    self.load(data)
+                    return
+
+        self.build()
+        try:
+            cache_dir.mkdir(parents=True, exist_ok=True)
+            save_sidecar(
+                self.sidecar_path,
+                key=np.array(key),
+                genes=np.array(self.genes, dtype=str),
+                signature_genes=self.signature_genes,
+                cell_signatures=self.cell_signatures,
+                signature_labels=np.array(self.signature_labels, dtype=str),
+            )
+        except OSError as e:
+            print(f"Could not write the cell signature cache {self.sidecar_path}: {e}")
+
+    def build(self):
+        key = "raw/X" if self.config.use_raw else "X"
+        with h5py.File(self.config.h5ad_path, "r") as f:
+            self.genes = read_elem(f["raw/var" if self.config.use_raw else "var"]).index.tolist()
+            num_cells = f[key].attrs["shape"][0] if isinstance(f[key], h5py.Group) else f[key].shape[0]
+            labels = pd.Categorical(read_elem(f["obs"][self.config.label_key])) if self.config.label_key else None
+
+        signature_ids: dict[bytes, int] = {}
+        signature_genes = []
+        self.cell_signatures = np.full(num_cells, -1, dtype=np.int32)
+        for start in range(0, num_cells, self.config.chunk_size):
+            end = min(start + self.config.chunk_size, num_cells)
+            top = top_expressed_genes(read_chunk(self.config.h5ad_path, key, start, end, 0), self.config.gene_num)
+            # cells without any expressed gene would all share an empty prompt
+            expressed = top[:, 0] >= 0
+            top = top[expressed]
+            keys = np.sort(top, axis=1) if self.config.unordered_signatures else top
+            rows = np.ascontiguousarray(keys).view(np.dtype((np.void, keys.dtype.itemsize * keys.shape[1]))).ravel()
+            unique_rows, first, inverse = np.unique(rows, return_index=True, return_inverse=True)
+            ids = np.empty(len(unique_rows), dtype=np.int32)
+            for i, row in enumerate(unique_rows.tolist()):
+                if row not in signature_ids:
+                    signature_ids[row] = len(signature_ids)
+                    signature_genes.append(top[first[i]])
+                ids[i] = signature_ids[row]
+            self.cell_signatures[start:end][expressed] = ids[inverse.ravel()]
+        self.signature_genes = np.array(signature_genes, dtype=np.int32).reshape(-1, self.config.gene_num)
+
+        self.signature_labels = [""] * len(self.signature_genes)
+        if labels is not None:
+            # the most common label of the cells of every signature
+            labeled = (labels.codes >= 0) & (self.cell_signatures >= 0)
+            counts = sp.coo_matrix(
+                (np.ones(labeled.sum()), (self.cell_signatures[labeled], labels.codes[labeled])),
+                shape=(len(self.signature_genes), len(labels.categories)),
+            ).tocsr()
+            # signatures without any labeled cell stay unlabeled
+            self.signature_labels = [
+                str(labels.categories[label]) if num_labeled else ""
+                for label, num_labeled in zip(np.asarray(counts.argmax(axis=1)).ravel(), counts.getnnz(axis=1))
+            ]
+        num_empty = int((self.cell_signatures < 0).sum())
+        print(
+            f"{num_cells - num_empty} cells share {len(self.signature_genes)} top-{self.config.gene_num} gene "
+            f"signatures, {num_empty} cells without expressed genes are skipped"
+        )
+
+    def load(self, data):
+        self.genes = data["genes"].tolist()
+        self.signature_genes = data["signature_genes"]
+        self.cell_signatures = data["cell_signatures"]
+        self.signature_labels = data["signature_labels"].tolist()
+
+    def fan_out(self, answers: dict[int, str]) -> pd.DataFrame:
+        """The answer of every cell, given the answers of the signatures. Cells without a signature get no answer."""
+        with h5py.File(self.config.h5ad_path, "r") as f:
+            cells = read_elem(f["obs"][f["obs"].attrs["_index"]])
+        # the extra last entry answers the signature -1
+        signature_answers = np.array([answers.get(i) for i in range(len(self))] + [None], dtype=object)
+        return pd.DataFrame(
+            {
+                "cell": cells,
+                "signature": self.cell_signatures,
+                "answer": signature_answers[self.cell_signatures],
+            }
+        )
+
+    def __len__(self):
+        return len(self.signature_genes)
+
+    def get_labels(self) -> list[Any]:
+        return list(self.signature_labels)
+
+    def get_sample(self, index):
+        sample = {
+            "index": index,
+            "dataset": self.config.dataset_name,
+            "tissue": self.config.tissue,
+            "genes": [self.genes[i] for i in self.signature_genes[index].tolist() if i >= 0],
+            "label": self.signature_labels[index],
+            "label_cl": "",
+            "label_id": "",
+            "broadtype": "",
+            "demo": self.demo,
+        }
+        return sample
+
+    def __getitem__(self, index):
+        sample = self.get_sample(index)
+        return sample
@@ -0,0 +1,816 @@
+import copy
+import time
+import torch
+import torch.nn.functional as F
+
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Iterable, Optional
+from transformers import LogitsProcessorList
+
+from soar_benchmark.bioontology.trie import LabelTrie
+from soar_benchmark.stopping import AnswerStopper, StopState
+from soar_benchmark.utils.stats import RunStats
+
+
+@dataclass
+class GenerationRequest:
+    uid: int
+    input_ids: list[int]
+    max_new_tokens: int
+    output_ids: list[int] = field(default_factory=list)
+    # log-probability of every output token under the unwarped model distribution, e.g. to gauge answer confidence
+    output_log_probs: list[float] = field(default_factory=list)
+    finished: bool = False
+    # tokens appended to the finished sequence before decoding resumes on top of its retained cache
+    continuation_ids: Optional[list[int]] = None
+    first_output_ids: list[int] = field(default_factory=list)
+    resume_ids: list[int] = field(default_factory=list)
+    resume_state: Optional["ActiveBatch"] = None
+    # per-sequence random stream, so sampling does not depend on which sequences share the batch
+    generator: Optional[torch.Generator] = None
+    # restrict the output to the labels of a trie, and the answer decoded after `continuation_ids`
+    trie: Optional[LabelTrie] = None
+    trie_node: int = 0
+    continuation_trie: Optional[LabelTrie] = None
+    # end the output at a stop string, line break or sentence end, and the answer decoded after `continuation_ids`
+    # with its own token budget
+    stopper: Optional[AnswerStopper] = None
+    continuation_stopper: Optional[AnswerStopper] = None
+    stop_state: StopState = field(default_factory=StopState)
+    continuation_max_new_tokens: Optional[int] = None
+    # tokens not yet fed to the draft model, the last one is the target's pending token
+    draft_pending_ids: list[int] = field(default_factory=list)
+    # processors of the model's generation config that condition on the sequence so far, e.g. a repetition penalty
+    processors: Optional[LogitsProcessorList] = None
+    # the first output and continuation tokens a resumed sequence continues after its prompt
+    context_ids: list[int] = field(default_factory=list)
+
+    def sequence_ids(self) -> list[int]:
+        # the tokens `generate` would hold in `input_ids` for this sequence
+        return self.input_ids + self.context_ids + self.output_ids
+
+
+def to_legacy_cache(past_key_values):
+    if hasattr(past_key_values, "to_legacy_cache"):
+        return past_key_values.to_legacy_cache()
+    return past_key_values
+
+
+def left_pad_cache(past_key_values, length: int):
+    padded = []
+    for layer in past_key_values:
+        padded.append(tuple(F.pad(x, (0, 0, length - x.size(-2), 0)) for x in layer))
+    return tuple(padded)
+
+
+def select_cache(past_key_values, rows: torch.Tensor):
+    return tuple(tuple(x[rows] for x in layer) for layer in past_key_values)
+
+
+def concat_cache(past_key_values_a, past_key_values_b):
+    return tuple(
+        tuple(torch.cat([a, b], dim=0) for a, b in zip(layer_a, layer_b))
+        for layer_a, layer_b in zip(past_key_values_a, past_key_values_b)
+    )
+
+
+def longest_common_prefix(list_of_input_ids: Iterable[list[int]]) -> list[int]:
+    """Shrink a running prefix prompt by prompt, so prompts can be streamed and are only read until none is shared."""
+    prefix = None
+    for input_ids in list_of_input_ids:
+        # keep at least one token per prompt out of the prefix, its logits seed the first generated token
+        max_length = max(len(input_ids) - 1, 0)
+        if prefix is None:
+            prefix = input_ids[:max_length]
+        else:
+            length = 0
+            while length < min(len(prefix), max_length) and input_ids[length] == prefix[length]:
+                length += 1
+            prefix = prefix[:length]
+        if not prefix:
+            break
+    return list(prefix) if prefix else []
+
+
+@dataclass
+class ActiveBatch:
+    """Decoding state of the sequences currently resident on the model.
+
+    Every row keeps its own key/value cache slice. Padding may sit anywhere in a row and is hidden by
+    ``attention_mask``; ``positions`` holds the position id of the next token fed for each row.
+    """
+
+    requests: list[GenerationRequest]
+    past_key_values: tuple
+    attention_mask: torch.Tensor
+    positions: torch.Tensor
+    next_tokens: Optional[torch.Tensor] = None
+    # the same sequences on the draft model when decoding speculatively
+    draft: Optional["ActiveBatch"] = None
+
+    def __len__(self):
+        return len(self.requests)
+
+    def merge(self, other: "ActiveBatch") -> "ActiveBatch":
+        length = max(self.attention_mask.size(1), other.attention_mask.size(1))
+        past_key_values = concat_cache(
+            left_pad_cache(self.past_key_values, length),
+            left_pad_cache(other.past_key_values, length),
+        )
+        attention_mask = torch.cat(
+            [
+                F.pad(self.attention_mask, (length - self.attention_mask.size(1), 0)),
+                F.pad(other.attention_mask, (length - other.attention_mask.size(1), 0)),
+            ],
+            dim=0,
+        )
+        return ActiveBatch(
+            requests=self.requests + other.requests,
+            past_key_values=past_key_values,
+            attention_mask=attention_mask,
+            positions=torch.cat([self.positions, other.positions]),
+            next_tokens=None if self.next_tokens is None else torch.cat([self.next_tokens, other.next_tokens]),
+            draft=None if self.draft is None else self.draft.merge(other.draft),
+        )
+
+    def select(self, rows: list[int]) -> "ActiveBatch":
+        index = torch.tensor(rows, device=self.attention_mask.device)
+        attention_mask = self.attention_mask[index]
+
+        # drop the leading columns that only hold padding of evicted rows
+        start = int(attention_mask.any(dim=0).nonzero()[0])
+        past_key_values = select_cache(self.past_key_values, index)
+        past_key_values = tuple(tuple(x[..., start:, :] for x in layer) for layer in past_key_values)
+        return ActiveBatch(
+            requests=[self.requests[i] for i in rows],
+            past_key_values=past_key_values,
+            attention_mask=attention_mask[:, start:],
+            positions=self.positions[index],
+            next_tokens=None if self.next_tokens is None else self.next_tokens[index],
+            draft=None if self.draft is None else self.draft.select(rows),
+        )
+
+
+class ContinuousBatchingEngine:
+    """Rolling-batch decoder on top of a HF causal LM.
+
+    At most ``max_active_sequences`` sequences are decoded together. A sequence is evicted as soon as it emits a
+    terminator, meets its stopping criteria or exhausts its token budget, and queued prompts are prefilled into the freed slots mid-flight.
+    """
+
+    def __init__(
+        self,
+        model,
+        max_active_sequences: int,
+        eos_token_ids: list[int],
+        pad_token_id: int = 0,
+        stats: Optional[RunStats] = None,
+        draft_model=None,
+        num_draft_tokens: int = 4,
+    ):
+        self.model = model
+        self.draft_model = draft_model
+        self.num_draft_tokens = num_draft_tokens
+        self.max_active_sequences = max_active_sequences
+        self.eos_token_ids = set(eos_token_ids)
+        self.pad_token_id = pad_token_id
+        self.stats = stats if stats is not None else RunStats()
+        self.stats.derive("engine/tokens_per_second", "engine/new_tokens", "engine/seconds")
+        self.stats.derive("engine/prefix_reuse_ratio", "engine/prefix_reused_tokens", "engine/prompt_tokens")
+        self.stats.derive("engine/acceptance_rate", "engine/accepted_draft_tokens", "engine/draft_tokens")
+        # accepted and drafted tokens, and new tokens and seconds, of every speculatively decoded batch, the run stats
+        # only hold their totals
+        self.batch_acceptance: list[tuple[int, int]] = []
+        self.batch_throughput: list[tuple[int, float]] = []
+
+        self.prefix_ids: list[int] = []
+        self.prefix_key_values = None
+
+    @property
+    def device(self):
+        return self.model.device
+
+    def merge_generation_config(self, generation_config):
+        # the settings of the run override the generation config of the checkpoint, as in `model.generate`
+        kwargs = generation_config.generate_kwargs()
+        if not kwargs["do_sample"]:
+            # greedy decoding ignores them, and the generation config warns about them
+            kwargs.pop("temperature")
+            kwargs.pop("top_p")
+        merged = copy.deepcopy(self.model.generation_config)
+        merged.update(**kwargs)
+        if merged.guidance_scale is not None and merged.guidance_scale != 1:
+            raise ValueError("The engine does not support classifier-free guidance (`guidance_scale`)")
+        return merged
+
+    def prepare_logits_warper(self, generation_config) -> LogitsProcessorList:
+        # the warpers `model.generate` samples with (temperature, top-k, top-p, min-p, typical-p, ...)
+        if not generation_config.do_sample:
+            return LogitsProcessorList()
+        return self.model._get_logits_warper(self.merge_generation_config(generation_config))
+
+    def prepare_logits_processors(self, generation_config, requests: list[GenerationRequest]):
+        # the processors `model.generate` applies before sampling or picking the argmax, built per sequence as some
+        # of them count the new tokens from the prompt length
+        merged = self.merge_generation_config(generation_config)
+        for request in requests:
+            processors = self.model._get_logits_processor(
+                merged,
+                input_ids_seq_length=len(request.input_ids),
+                encoder_input_ids=torch.tensor([request.input_ids], device=self.device),
+                prefix_allowed_tokens_fn=None,
+                logits_processor=LogitsProcessorList(),
+                device=self.device,
+                model_kwargs={"use_cache": True},
+            )
+            request.processors = processors if len(processors) > 0 else None
+
+    def process_logits(
+        self, logits: torch.Tensor, requests: list[GenerationRequest], draft_tokens: Optional[torch.Tensor] = None
+    ) -> torch.Tensor:
+        """Apply the processors of every sequence to its logits, after its ``draft_tokens`` when given."""
+        if all(request.processors is None for request in requests):
+            return logits
+
+        logits = logits.clone()
+        for row, request in enumerate(requests):
+            if request.processors is None:
+                continue
+            sequence_ids = request.sequence_ids()
+            if draft_tokens is not None:
+                sequence_ids = sequence_ids + draft_tokens[row].tolist()
+            input_ids = torch.tensor([sequence_ids], device=logits.device)
+            logits[row : row + 1] = request.processors(input_ids, logits[row : row + 1])
+        return logits
+
+    def sample(
+        self,
+        logits: torch.Tensor,
+        warpers: LogitsProcessorList,
+        generation_config,
+        requests: Optional[list[GenerationRequest]] = None,
+    ) -> torch.Tensor:
+        logits = logits.float()
+        if requests is not None:
+            logits = self.constrain_logits(self.process_logits(logits, requests), requests)
+        scores = warpers(None, logits)
+        if not generation_config.do_sample:
+            return scores.argmax(dim=-1)
+
+        return self.multinomial(F.softmax(scores, dim=-1), requests)
+
+    def multinomial(self, probs: torch.Tensor, requests: Optional[list[GenerationRequest]] = None) -> torch.Tensor:
+        if requests is None or all(request.generator is None for request in requests):
+            return torch.multinomial(probs, num_samples=1).squeeze(1)
+        return torch.cat(
+            [
+                torch.multinomial(probs[i], num_samples=1, generator=request.generator)
+                for i, request in enumerate(requests)
+            ]
+        )
+
+    def uniform(self, size: tuple[int, int], requests: list[GenerationRequest]) -> torch.Tensor:
+        if all(request.generator is None for request in requests):
+            return torch.rand(size, device=self.device)
+        return torch.stack(
+            [torch.rand(size[1:], device=self.device, generator=request.generator) for request in requests]
+        )
+
+    def constrain_logits(self, logits: torch.Tensor, requests: list[GenerationRequest]) -> torch.Tensor:
+        rows = [i for i, request in enumerate(requests) if request.trie is not None]
+        if not rows:
+            return logits
+
+        mask = torch.full((len(rows), logits.size(-1)), float("-inf"), device=logits.device)
+        for k, i in enumerate(rows):
+            mask[k, requests[i].trie.allowed_tokens(requests[i].trie_node)] = 0
+        # the unconstrained logits still give the log-probabilities of the chosen tokens
+        logits = logits.clone()
+        logits[rows] = logits[rows] + mask
+        return logits
+
+    def make_generator(self, seed: int) -> torch.Generator:
+        return torch.Generator(device=self.device).manual_seed(seed)
+
+    def set_prefix(self, prefix_ids: list[int]):
+        """Prefill ``prefix_ids`` once so prompts starting with them only prefill their remaining tokens."""
+        self.prefix_ids, self.prefix_key_values = [], None
+        if not prefix_ids:
+            return
+
+        with torch.inference_mode():
+            outputs = self.model(input_ids=torch.tensor([prefix_ids], device=self.device), use_cache=True)
+        self.prefix_ids = list(prefix_ids)
+        self.prefix_key_values = to_legacy_cache(outputs.past_key_values)
+        self.stats.set("engine/prefix_tokens", len(prefix_ids))
+
+    def has_prefix(self, request: GenerationRequest) -> bool:
+        num_prefix_tokens = len(self.prefix_ids)
+        return (
+            num_prefix_tokens > 0
+            and len(request.input_ids) > num_prefix_tokens
+            and request.input_ids[:num_prefix_tokens] == self.prefix_ids
+        )
+
+    def prefill(self, requests: list[GenerationRequest]) -> tuple[ActiveBatch, torch.Tensor]:
+        with self.stats.timer("engine/prefill_seconds"):
+            resumed = [r for r in requests if r.resume_state is not None]
+            shared = [r for r in requests if r.resume_state is None and self.has_prefix(r)]
+            others = [r for r in requests if r.resume_state is None and not self.has_prefix(r)]
+
+            results = []
+            if resumed:
+                state = resumed[0].resume_state
+                for request in resumed[1:]:
+                    state = state.merge(request.resume_state)
+                results.append(
+                    self.prefill_tokens(
+                        resumed,
+                        [r.resume_ids for r in resumed],
+                        past_key_values=state.past_key_values,
+                        past_attention_mask=state.attention_mask,
+                        past_positions=state.positions,
+                    )
+                )
+                self.stats.add("engine/continuation_reused_tokens", int(state.attention_mask.sum()))
+                for request in resumed:
+                    request.resume_state = None
+            if others:
+                results.append(self.prefill_unique(others, [r.input_ids for r in others]))
+            if shared:
+                num_prefix_tokens = len(self.prefix_ids)
+                past_key_values = tuple(
+                    tuple(x.expand(len(shared), -1, -1, -1) for x in layer) for layer in self.prefix_key_values
+                )
+                results.append(
+                    self.prefill_unique(
+                        shared,
+                        [r.input_ids[num_prefix_tokens:] for r in shared],
+                        past_key_values=past_key_values,
+                        past_attention_mask=torch.ones(
+                            (len(shared), num_prefix_tokens), dtype=torch.long, device=self.device
+                        ),
+                        past_positions=torch.full((len(shared),), num_prefix_tokens, device=self.device),
+                    )
+                )
+                self.stats.add("engine/prefix_reused_tokens", num_prefix_tokens * len(shared))
+
+        batch, logits = results[0]
+        for other_batch, other_logits in results[1:]:
+            batch = batch.merge(other_batch)
+            logits = torch.cat([logits, other_logits])
+        return batch, logits
+
+    def prefill_unique(
+        self,
+        requests: list[GenerationRequest],
+        list_of_input_ids: list[list[int]],
+        past_key_values: Optional[tuple] = None,
+        past_attention_mask: Optional[torch.Tensor] = None,
+        past_positions: Optional[torch.Tensor] = None,
+        draft: bool = False,
+    ) -> tuple[ActiveBatch, torch.Tensor]:
+        """``prefill_tokens`` for rows whose cache only depends on their input ids, e.g. fresh prompts.
+
+        Identical rows, such as the samples drawn for one prompt, are prefilled once and their cache rows are copied.
+        """
+        unique_rows: dict[tuple[int, ...], int] = {}
+        inverse = [unique_rows.setdefault(tuple(input_ids), row) for row, input_ids in enumerate(list_of_input_ids)]
+        if len(unique_rows) == len(list_of_input_ids):
+            return self.prefill_tokens(
+                requests, list_of_input_ids, past_key_values, past_attention_mask, past_positions, draft=draft
+            )
+
+        rows = list(unique_rows.values())
+        if past_key_values is not None:
+            index = torch.tensor(rows, device=past_attention_mask.device)
+            past_key_values = select_cache(past_key_values, index)
+            past_attention_mask, past_positions = past_attention_mask[index], past_positions[index]
+        batch, logits = self.prefill_tokens(
+            [requests[row] for row in rows],
+            [list_of_input_ids[row] for row in rows],
+            past_key_values,
+            past_attention_mask,
+            past_positions,
+            draft=draft,
+        )
+
+        positions = {row: k for k, row in enumerate(rows)}
+        index = torch.tensor([positions[row] for row in inverse], device=batch.attention_mask.device)
+        if not draft:
+            self.stats.add(
+                "engine/deduplicated_prefill_tokens",
+                sum(len(input_ids) for input_ids in list_of_input_ids)
+                - sum(len(list_of_input_ids[row]) for row in rows),
+            )
+        batch = ActiveBatch(
+            requests=requests,
+            past_key_values=select_cache(batch.past_key_values, index),
+            attention_mask=batch.attention_mask[index],
+            positions=batch.positions[index],
+        )
+        return batch, logits[index.to(logits.device)]
+
+    def prefill_tokens(
+        self,
+        requests: list[GenerationRequest],
+        list_of_input_ids: list[list[int]],
+        past_key_values: Optional[tuple] = None,
+        past_attention_mask: Optional[torch.Tensor] = None,
+        past_positions: Optional[torch.Tensor] = None,
+        draft: bool = False,
+    ) -> tuple[ActiveBatch, torch.Tensor]:
+        """Left-pad ``list_of_input_ids`` and run them on top of an optional per-row cache of the target model, or of
+        the draft model with ``draft``."""
+        model = self.draft_model if draft else self.model
+        max_length = max(len(input_ids) for input_ids in list_of_input_ids)
+        input_ids = torch.full((len(requests), max_length), self.pad_token_id, dtype=torch.long)
+        attention_mask = torch.zeros((len(requests), max_length), dtype=torch.long)
+        for i, row in enumerate(list_of_input_ids):
+            input_ids[i, max_length - len(row) :] = torch.tensor(row)
+            attention_mask[i, max_length - len(row) :] = 1
+        input_ids = input_ids.to(model.device)
+        attention_mask = attention_mask.to(model.device)
+
+        position_ids = (attention_mask.cumsum(-1) - 1).clamp(min=0)
+        positions = attention_mask.sum(-1)
+        if past_key_values is not None:
+            position_ids = position_ids + past_positions[:, None]
+            positions = positions + past_positions
+            attention_mask = torch.cat([past_attention_mask, attention_mask], dim=-1)
+
+        outputs = model(
+            input_ids=input_ids,
+            attention_mask=attention_mask,
+            position_ids=position_ids,
+            past_key_values=past_key_values,
+            use_cache=True,
+        )
+        if not draft:
+            self.stats.add("engine/prefill_tokens", sum(len(row) for row in list_of_input_ids))
+            self.stats.add("engine/padded_prefill_tokens", input_ids.numel())
+
+        batch = ActiveBatch(
+            requests=requests,
+            past_key_values=to_legacy_cache(outputs.past_key_values),
+            attention_mask=attention_mask,
+            positions=positions,
+        )
+        return batch, outputs.logits[:, -1, :]
+
+    def decode_step(self, batch: ActiveBatch, draft: bool = False) -> torch.Tensor:
+        model = self.draft_model if draft else self.model
+        attention_mask = F.pad(batch.attention_mask, (0, 1), value=1)
+        outputs = model(
+            input_ids=batch.next_tokens[:, None],
+            attention_mask=attention_mask,
+            position_ids=batch.positions[:, None],
+            past_key_values=batch.past_key_values,
+            use_cache=True,
+        )
+        batch.past_key_values = to_legacy_cache(outputs.past_key_values)
+        batch.attention_mask = attention_mask
+        batch.positions = batch.positions + 1
+        if not draft:
+            self.stats.add("engine/decode_steps")
+            self.stats.add("engine/decode_rows", len(batch))
+        return outputs.logits[:, -1, :]
+
+    def append_tokens(self, batch: ActiveBatch, tokens: torch.Tensor, logits: torch.Tensor):
+        batch.next_tokens = tokens
+        log_probs = F.log_softmax(logits.float(), dim=-1).gather(-1, tokens[:, None]).squeeze(-1)
+        for request, token, log_prob in zip(batch.requests, tokens.tolist(), log_probs.tolist()):
+            self.append_token(request, token, log_prob)
+
+    def append_token(self, request: GenerationRequest, token: int, log_prob: float):
+        if token in self.eos_token_ids:
+            request.finished = True
+            return
+
+        self.stats.add("engine/new_tokens")
+        request.output_ids.append(token)
+        request.output_log_probs.append(log_prob)
+        if len(request.output_ids) >= request.max_new_tokens:
+            request.finished = True
+        elif request.stopper is not None and request.stopper.is_stopped(request.output_ids, request.stop_state):
+            request.finished = True
+
+        if request.trie is not None:
+            request.trie_node = request.trie.next(request.trie_node, token)
+            # stop right after a label no other label extends, instead of decoding its terminator
+            if request.trie.is_complete(request.trie_node):
+                request.finished = True
+                self.stats.add("engine/constrained_early_stops")
+
+    def retain_for_continuation(self, batch: ActiveBatch, row: int):
+        request = batch.requests[row]
+        state = batch.select([row])
+
+        # a token sampled at the budget limit was never fed to the model, a terminator is dropped
+        last_token = int(state.next_tokens[0])
+        pending_ids = [] if last_token in self.eos_token_ids else [last_token]
+
+        request.first_output_ids = request.output_ids
+        request.context_ids = request.output_ids + request.continuation_ids
+        request.output_ids, request.output_log_probs = [], []
+        request.resume_ids = pending_ids + request.continuation_ids
+        request.resume_state = state
+        request.continuation_ids = None
+        request.trie, request.trie_node, request.continuation_trie = request.continuation_trie, 0, None
+        request.stopper, request.continuation_stopper = request.continuation_stopper, None
+        request.stop_state = StopState()
+        if request.continuation_max_new_tokens is not None:
+            request.max_new_tokens = request.continuation_max_new_tokens
+        request.finished = False
+
+    def evict_finished(self, batch: ActiveBatch, queue: deque) -> Optional[ActiveBatch]:
+        for i, request in enumerate(batch.requests):
+            if request.finished and request.continuation_ids is not None:
+                self.retain_for_continuation(batch, i)
+                # resume first so the retained cache is released as soon as possible
+                queue.appendleft(request)
+
+        rows = [i for i, request in enumerate(batch.requests) if not request.finished and request.resume_state is None]
+        if len(rows) == len(batch):
+            return batch
+        if not rows:
+            return None
+        return batch.select(rows)
+
+    def prefill_draft(self, batch: ActiveBatch):
+        """Prefill the draft model with the prompts of a freshly prefilled batch, in the same row order."""
+        batch.draft, _ = self.prefill_unique(
+            batch.requests, [request.input_ids for request in batch.requests], draft=True
+        )
+        for request, token in zip(batch.requests, batch.next_tokens.tolist()):
+            request.draft_pending_ids = [token]
+
+    def draft_tokens(
+        self, batch: ActiveBatch, warpers: LogitsProcessorList, generation_config
+    ) -> tuple[torch.Tensor, torch.Tensor]:
+        """Decode ``num_draft_tokens`` tokens per row with the draft model.
+
+        Returns the draft tokens [rows, k] and their draft probabilities [rows, k, vocab] on the target device.
+        """
+        state, logits = self.prefill_tokens(
+            batch.requests,
+            [request.draft_pending_ids for request in batch.requests],
+            past_key_values=batch.draft.past_key_values,
+            past_attention_mask=batch.draft.attention_mask,
+            past_positions=batch.draft.positions,
+            draft=True,
+        )
+
+        tokens, probs = [], []
+        for i in range(self.num_draft_tokens):
+            logits = self.process_logits(logits.float(), batch.requests, torch.stack(tokens, dim=1) if tokens else None)
+            q = F.softmax(warpers(None, logits), dim=-1).to(self.device)
+            token = self.multinomial(q, batch.requests) if generation_config.do_sample else q.argmax(dim=-1)
+            tokens.append(token)
+            probs.append(q)
+            if i < self.num_draft_tokens - 1:
+                state.next_tokens = token.to(self.draft_model.device)
+                logits = self.decode_step(state, draft=True)
+
+        # the tokens still to feed the draft model are kept per request in `draft_pending_ids`
+        state.next_tokens = None
+        batch.draft = state
+        return torch.stack(tokens, dim=1), torch.stack(probs, dim=1)
+
+    def speculative_step(self, batch: ActiveBatch, warpers: LogitsProcessorList, generation_config):
+        """Draft ``k`` tokens per row, verify them with one target forward pass and keep the accepted prefix.
+
+        Draft tokens are accepted with probability min(1, p / q) and the first rejected one is resampled from the
+        residual max(0, p - q), so the output follows the target distribution (greedy decoding accepts a draft token
+        when it is the target argmax). Rejected tokens stay in the caches but are masked out, every row keeps its own
+        number of accepted tokens.
+        """
+        k = self.num_draft_tokens
+        draft_tokens, q = self.draft_tokens(batch, warpers, generation_config)
+
+        input_ids = torch.cat([batch.next_tokens[:, None], draft_tokens], dim=1)
+        outputs = self.model(
+            input_ids=input_ids,
+            attention_mask=F.pad(batch.attention_mask, (0, k + 1), value=1),
+            position_ids=batch.positions[:, None] + torch.arange(k + 1, device=self.device),
+            past_key_values=batch.past_key_values,
+            use_cache=True,
+        )
+        logits = outputs.logits.float()
+        rows = torch.arange(len(batch), device=self.device)
+        # position j follows the first j draft tokens
+        scores = torch.stack(
+            [self.process_logits(logits[:, j], batch.requests, draft_tokens[:, :j]) for j in range(k + 1)], dim=1
+        )
+
+        if generation_config.do_sample:
+            p = F.softmax(warpers(None, scores.flatten(0, 1)), dim=-1).view(scores.shape)
+            # the draft vocabulary may be padded to a different size, and there is no draft token after the last one
+            q = F.pad(q, (0, p.size(-1) - q.size(-1), 0, 1))[..., : p.size(-1)]
+            p_draft = p[:, :k].gather(-1, draft_tokens[..., None]).squeeze(-1)
+            q_draft = q[:, :k].gather(-1, draft_tokens[..., None]).squeeze(-1)
+            accepted = self.uniform((len(batch), k), batch.requests) * q_draft < p_draft
+            num_accepted = accepted.long().cumprod(dim=1).sum(dim=1)
+
+            residual = (p[rows, num_accepted] - q[rows, num_accepted]).clamp(min=0)
+            # p == q leaves no residual mass, any sample from p is then correct
+            residual = torch.where(residual.sum(-1, keepdim=True) > 0, residual, p[rows, num_accepted])
+            next_tokens = self.multinomial(residual / residual.sum(-1, keepdim=True), batch.requests)
+        else:
+            target_tokens = scores.argmax(dim=-1)
+            num_accepted = (target_tokens[:, :k] == draft_tokens).long().cumprod(dim=1).sum(dim=1)
+            next_tokens = target_tokens[rows, num_accepted]
+
+        # keep the pending token and the accepted draft tokens of every row
+        columns = torch.arange(k + 1, device=self.device)
+        batch.past_key_values = to_legacy_cache(outputs.past_key_values)
+        batch.attention_mask = torch.cat([batch.attention_mask, (columns <= num_accepted[:, None]).long()], dim=1)
+        batch.positions = batch.positions + 1 + num_accepted
+
+        # the draft cache holds the first k - 1 draft tokens, the last one is fed next round if it was accepted
+        draft = batch.draft
+        draft_accepted = num_accepted.clamp(max=k - 1).to(self.draft_model.device)
+        if k > 1:
+            draft_columns = torch.arange(k - 1, device=self.draft_model.device)
+            draft.attention_mask[:, -(k - 1) :] = (draft_columns < draft_accepted[:, None]).long()
+        draft.positions = draft.positions - (k - 1) + draft_accepted
+
+        # the target logits at position j predict the j-th draft token, and the next token after the accepted ones
+        log_probs = F.log_softmax(logits, dim=-1)
+        draft_log_probs = log_probs[:, :k].gather(-1, draft_tokens[..., None]).squeeze(-1)
+        next_log_probs = log_probs[rows, num_accepted].gather(-1, next_tokens[:, None]).squeeze(-1)
+        token_log_probs = torch.cat([draft_log_probs, next_log_probs[:, None]], dim=1).tolist()
+
+        batch.next_tokens = next_tokens
+        for row, request in enumerate(batch.requests):
+            a, next_token = int(num_accepted[row]), int(next_tokens[row])
+            request.draft_pending_ids = [int(draft_tokens[row, k - 1]), next_token] if a == k else [next_token]
+            tokens = draft_tokens[row, :a].tolist() + [next_token]
+            for token, log_prob in zip(tokens, token_log_probs[row][:a] + [token_log_probs[row][k]]):
+                if request.finished:
+                    break
+                self.append_token(request, token, log_prob)
+
+        self.stats.add("engine/decode_steps")
+        self.stats.add("engine/decode_rows", len(batch))
+        self.stats.add("engine/draft_tokens", k * len(batch))
+        self.stats.add("engine/accepted_draft_tokens", int(num_accepted.sum()))
+
+    def score_candidates(
+        self, state: ActiveBatch, first_log_probs: torch.Tensor, list_of_candidate_ids: list[list[int]]
+    ) -> torch.Tensor:
+        """Sum the log-probabilities of right-padded candidates continuing the single sequence held in ``state``."""
+        num_candidates = len(list_of_candidate_ids)
+        max_length = max(len(candidate_ids) for candidate_ids in list_of_candidate_ids)
+        input_ids = torch.full((num_candidates, max_length), self.pad_token_id, dtype=torch.long)
+        candidate_mask = torch.zeros((num_candidates, max_length), dtype=torch.long)
+        for i, row in enumerate(list_of_candidate_ids):
+            input_ids[i, : len(row)] = torch.tensor(row)
+            candidate_mask[i, : len(row)] = 1
+        input_ids = input_ids.to(self.device)
+        candidate_mask = candidate_mask.to(self.device)
+
+        # the first token is predicted by the prompt logits, the rest by feeding all but the last candidate token
+        log_likelihoods = first_log_probs[input_ids[:, 0]]
+        if max_length > 1:
+            past_key_values = tuple(
+                tuple(x.expand(num_candidates, -1, -1, -1) for x in layer) for layer in state.past_key_values
+            )
+            attention_mask = torch.cat(
+                [state.attention_mask.expand(num_candidates, -1), candidate_mask[:, :-1]], dim=-1
+            )
+            position_ids = state.positions[:, None] + torch.arange(max_length - 1, device=self.device)
+            outputs = self.model(
+                input_ids=input_ids[:, :-1],
+                attention_mask=attention_mask,
+                position_ids=position_ids.expand(num_candidates, -1),
+                past_key_values=past_key_values,
+                use_cache=True,
+            )
+            log_probs = F.log_softmax(outputs.logits.float(), dim=-1)
+            token_log_probs = log_probs.gather(-1, input_ids[:, 1:, None]).squeeze(-1)
+            log_likelihoods = log_likelihoods + (token_log_probs * candidate_mask[:, 1:]).sum(-1)
+
+        self.stats.add("engine/candidate_tokens", int(candidate_mask.sum()))
+        return log_likelihoods
+
+    @torch.inference_mode()
+    def score(
+        self,
+        list_of_input_ids: list[list[int]],
+        list_of_candidate_ids: list[list[int]],
+        candidate_batch_size: Optional[int] = None,
+    ) -> torch.Tensor:
+        """Return the log-likelihood of every candidate continuing every prompt, shaped [prompts, candidates].
+
+        Prompts are prefilled ``max_active_sequences`` at a time (on top of the shared prefix cache, if any), then the
+        candidates of each prompt are scored in batches of ``candidate_batch_size`` on top of the prompt's cache.
+        """
+        candidate_batch_size = candidate_batch_size or self.max_active_sequences
+        scores = torch.empty((len(list_of_input_ids), len(list_of_candidate_ids)))
+
+        with self.stats.timer("engine/score_seconds"):
+            for start in range(0, len(list_of_input_ids), self.max_active_sequences):
+                requests = [
+                    GenerationRequest(uid=uid, input_ids=input_ids, max_new_tokens=0)
+                    for uid, input_ids in enumerate(
+                        list_of_input_ids[start : start + self.max_active_sequences], start=start
+                    )
+                ]
+                batch, logits = self.prefill(requests)
+                first_log_probs = F.log_softmax(logits.float(), dim=-1)
+
+                # prefill groups the prompts, so rows are matched back through the request uid
+                for row, request in enumerate(batch.requests):
+                    state = batch.select([row])
+                    for candidate_start in range(0, len(list_of_candidate_ids), candidate_batch_size):
+                        candidate_end = candidate_start + candidate_batch_size
+                        scores[request.uid, candidate_start:candidate_end] = self.score_candidates(
+                            state, first_log_probs[row], list_of_candidate_ids[candidate_start:candidate_end]
+                        ).cpu()
+
+        self.stats.add("engine/scored_prompts", len(list_of_input_ids))
+        return scores
+
+    def generate(
+        self,
+        list_of_input_ids: list[list[int]],
+        generation_config,
+        seeds: Optional[list[int]] = None,
+        trie: Optional[LabelTrie] = None,
+        stopper: Optional[AnswerStopper] = None,
+    ) -> list[GenerationRequest]:
+        requests = [
+            GenerationRequest(
+                uid=i,
+                input_ids=input_ids,
+                max_new_tokens=generation_config.max_new_tokens,
+                generator=self.make_generator(seeds[i]) if seeds is not None else None,
+                trie=trie,
+                stopper=stopper,
+            )
+            for i, input_ids in enumerate(list_of_input_ids)
+        ]
+        return self.generate_requests(requests, generation_config)
+
+    @torch.inference_mode()
+    def generate_requests(self, requests: list[GenerationRequest], generation_config) -> list[GenerationRequest]:
+        warpers = self.prepare_logits_warper(generation_config)
+        self.prepare_logits_processors(generation_config, requests)
+        # the draft model only runs plain generation, continuation and label constraints decode on the target
+        speculative = self.draft_model is not None and all(
+            request.continuation_ids is None and request.trie is None for request in requests
+        )
+        queue = deque(requests)
+        batch: Optional[ActiveBatch] = None
+
+        self.stats.add("engine/prompt_tokens", sum(len(request.input_ids) for request in requests))
+        accepted = self.stats.get("engine/accepted_draft_tokens")
+        drafted = self.stats.get("engine/draft_tokens")
+        new_tokens = self.stats.get("engine/new_tokens")
+
+        start = time.perf_counter()
+        while queue or batch is not None:
+            num_active = len(batch) if batch is not None else 0
+            num_free = self.max_active_sequences - num_active
+            if queue and num_free > 0:
+                admitted = [queue.popleft() for _ in range(min(num_free, len(queue)))]
+                new_batch, logits = self.prefill(admitted)
+                self.append_tokens(
+                    new_batch, self.sample(logits, warpers, generation_config, new_batch.requests), logits
+                )
+                if speculative:
+                    self.prefill_draft(new_batch)
+                batch = new_batch if batch is None else batch.merge(new_batch)
+                self.stats.add("engine/admissions")
+            elif speculative:
+                self.speculative_step(batch, warpers, generation_config)
+            else:
+                logits = self.decode_step(batch)
+                self.append_tokens(batch, self.sample(logits, warpers, generation_config, batch.requests), logits)
+            batch = self.evict_finished(batch, queue)
+
+        seconds = time.perf_counter() - start
+        self.stats.add("engine/seconds", seconds)
+        self.stats.add("engine/sequences", len(requests))
+        if speculative:
+            self.log_batch(
+                int(self.stats.get("engine/accepted_draft_tokens") - accepted),
+                int(self.stats.get("engine/draft_tokens") - drafted),
+                int(self.stats.get("engine/new_tokens") - new_tokens),
+                seconds,
+            )
+        return requests
+
+    def log_batch(self, accepted: int, drafted: int, new_tokens: int, seconds: float):
+        # a batch may drift from the run total, e.g. when its prompts leave the draft model's domain
+        self.batch_acceptance.append((accepted, drafted))
+        self.batch_throughput.append((new_tokens, seconds))
+        if drafted == 0:
+            return
+        total = self.stats.get("engine/accepted_draft_tokens") / max(self.stats.get("engine/draft_tokens"), 1)
+        print(
+            f"Accepted {accepted}/{drafted} draft tokens in this batch ({accepted / drafted:.1%}), {total:.1%} in the run, "
+            f"{new_tokens / max(seconds, 1e-9):.1f} tokens/s"
+        )
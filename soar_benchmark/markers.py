@@ -0,0 +1,277 @@
+import time
+import h5py
+import multiprocessing
+import numpy as np
+import pandas as pd
+import anndata as ad
+import scipy.sparse as sp
+
+from scipy import stats
+from typing import Callable, Literal, Optional
+from contextlib import nullcontext
+from dataclasses import dataclass
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from anndata.experimental import read_elem, sparse_dataset, write_elem
+
+
+@dataclass
+class MarkerConfig:
+    # AnnData file with one row per cell, its matrix is read `chunk_size` rows at a time
+    h5ad_path: str = ""
+    # obs column with the cluster or cell type of every cell
+    groupby: str = ""
+    # H5AD file receiving only the ranked gene list, the ranked gene list is added to `h5ad_path` itself when empty
+    output_path: str = ""
+    # "t-test" is Welch's t-test as in `sc.tl.rank_genes_groups`, "wilcoxon" ranks values binned per gene
+    method: Literal["t-test", "wilcoxon"] = "t-test"
+    # ranked genes kept per group
+    n_genes: int = 100
+    # rank `raw.X` instead of `X`
+    use_raw: bool = False
+    # scale every cell to this many counts and log1p it before ranking, 0 ranks the matrix as is (log-normalized)
+    normalize_total: float = 0.0
+    # cells read at once, memory grows with the chunk size and the number of workers but not with the number of cells
+    chunk_size: int = 50_000
+    # processes reading and reducing chunks, 0 reduces them in the main process
+    num_workers: int = 0
+    # value bins per gene for "wilcoxon", values within a bin share their rank
+    wilcoxon_bins: int = 16
+
+
+def read_chunk(h5ad_path: str, key: str, start: int, end: int, normalize_total: float) -> sp.csr_matrix:
+    with h5py.File(h5ad_path, "r") as f:
+        element = f[key]
+        if isinstance(element, h5py.Dataset):
+            X = sp.csr_matrix(element[start:end])
+        elif element.attrs["encoding-type"] == "csr_matrix":
+            X = sparse_dataset(element)[start:end]
+        else:
+            raise ValueError(f"Reading {key} by rows needs a dense or CSR matrix, got {element.attrs['encoding-type']}")
+
+    X = X.astype(np.float64)
+    if normalize_total > 0:
+        totals = np.asarray(X.sum(axis=1)).ravel()
+        scale = np.divide(normalize_total, totals, out=np.zeros_like(totals), where=totals > 0)
+        X.data *= np.repeat(scale, np.diff(X.indptr))
+        np.log1p(X.data, out=X.data)
+    return X
+
+
+def group_indicator(codes: np.ndarray, n_groups: int) -> sp.csr_matrix:
+    # (group, cell) one-hot matrix, cells without a group are left out
+    cells = np.flatnonzero(codes >= 0)
+    return sp.csr_matrix((np.ones(len(cells)), (codes[cells], cells)), shape=(n_groups, len(codes)))
+
+
+def chunk_statistics(
+    h5ad_path: str, key: str, start: int, end: int, codes: np.ndarray, n_groups: int, normalize_total: float
+) -> dict[str, np.ndarray]:
+    """Per-group sums, sums of squares and nonzero counts of every gene over the cells ``start:end``."""
+    X = read_chunk(h5ad_path, key, start, end, normalize_total)
+    indicator = group_indicator(codes, n_groups)
+    grouped = X[codes >= 0] if (codes < 0).any() else X
+    n_genes = X.shape[1]
+    return {
+        "sums": (indicator @ X).toarray(),
+        "squares": (indicator @ X.multiply(X)).toarray(),
+        "nonzeros": (indicator @ (X != 0).astype(np.float64)).toarray(),
+        "max": grouped.max(axis=0).toarray().ravel() if grouped.shape[0] else np.full(n_genes, -np.inf),
+        "min": grouped.min(axis=0).toarray().ravel() if grouped.shape[0] else np.full(n_genes, np.inf),
+    }
+
+
+def chunk_histogram(
+    h5ad_path: str,
+    key: str,
+    start: int,
+    end: int,
+    codes: np.ndarray,
+    n_groups: int,
+    normalize_total: float,
+    max_values: np.ndarray,
+    bins: int,
+) -> dict[str, np.ndarray]:
+    """Per-group counts of the nonzero values of every gene in ``bins`` equal-width bins up to its maximum."""
+    X = read_chunk(h5ad_path, key, start, end, normalize_total).tocoo()
+    groups = codes[X.row]
+    keep = (groups >= 0) & (X.data != 0)
+    genes, values, groups = X.col[keep], X.data[keep], groups[keep]
+    value_bins = np.minimum((values / max_values[genes] * bins).astype(np.int64), bins - 1)
+    n_genes = X.shape[1]
+    counts = np.bincount((groups * n_genes + genes) * bins + value_bins, minlength=n_groups * n_genes * bins)
+    return {"histogram": counts.reshape(n_groups, n_genes, bins)}
+
+
+def reduce_chunks(
+    fn: Callable[..., dict[str, np.ndarray]],
+    tasks: list[tuple],
+    executor: Optional[ProcessPoolExecutor] = None,
+    num_workers: int = 0,
+) -> dict[str, np.ndarray]:
+    """Sum the statistics of every chunk, keeping at most two chunks per worker of ``executor`` in flight."""
+    totals = {}
+
+    def add(statistics: dict[str, np.ndarray]):
+        for name, value in statistics.items():
+            if name not in totals:
+                totals[name] = value
+            elif name == "max":
+                np.maximum(totals[name], value, out=totals[name])
+            elif name == "min":
+                np.minimum(totals[name], value, out=totals[name])
+            else:
+                totals[name] += value
+
+    if executor is None:
+        for task in tasks:
+            add(fn(*task))
+        return totals
+
+    pending = set()
+    for task in tasks:
+        if len(pending) >= 2 * num_workers:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                add(future.result())
+        pending.add(executor.submit(fn, *task))
+    for future in wait(pending).done:
+        add(future.result())
+    return totals
+
+
+def benjamini_hochberg(pvals: np.ndarray) -> np.ndarray:
+    order = np.argsort(pvals)
+    adjusted = pvals[order] * len(pvals) / np.arange(1, len(pvals) + 1)
+    adjusted = np.minimum.accumulate(adjusted[::-1])[::-1]
+    pvals_adj = np.empty_like(adjusted)
+    pvals_adj[order] = np.minimum(adjusted, 1)
+    return pvals_adj
+
+
+def select_top(scores: np.ndarray, n: int) -> np.ndarray:
+    n = min(n, len(scores))
+    partition = np.argpartition(scores, -n)[-n:]
+    return partition[np.argsort(scores[partition])[::-1]]
+
+
+def rank_marker_genes(config: MarkerConfig) -> dict:
+    """Rank the marker genes of every group of cells and write them to ``uns["gene_list"]`` for ``H5ADDataset``.
+
+    The matrix is streamed in chunks of ``chunk_size`` cells, so memory grows with the number of groups and genes but
+    not with the number of cells. The result follows the layout of ``sc.tl.rank_genes_groups``.
+    """
+    start_time = time.perf_counter()
+    key = "raw/X" if config.use_raw else "X"
+    with h5py.File(config.h5ad_path, "r") as f:
+        groups = pd.Categorical(read_elem(f["obs"][config.groupby]))
+        var_names = read_elem(f["raw/var" if config.use_raw else "var"]).index.to_numpy(dtype=object)
+    codes = groups.codes.astype(np.int64)
+    group_names = [str(name) for name in groups.categories]
+    n_groups, n_cells = len(group_names), len(codes)
+
+    def make_tasks(*args) -> list[tuple]:
+        return [
+            (config.h5ad_path, key, start, min(start + config.chunk_size, n_cells))
+            + (codes[start : start + config.chunk_size], n_groups, config.normalize_total, *args)
+            for start in range(0, n_cells, config.chunk_size)
+        ]
+
+    n_group = np.bincount(codes[codes >= 0], minlength=n_groups).astype(np.float64)[:, None]
+    # every group is compared with the rest of the grouped cells, which a single group leaves empty
+    filled_groups = [name for name, n in zip(group_names, n_group.ravel()) if n > 0]
+    if len(filled_groups) < 2:
+        raise ValueError(
+            f"Ranking needs at least two groups with cells in obs[{config.groupby!r}], got {len(filled_groups)}"
+            + (f" ({', '.join(filled_groups)})" if filled_groups else "")
+        )
+    small_groups = [name for name, n in zip(group_names, n_group.ravel()) if n < 2]
+    if small_groups:
+        raise ValueError(f"Groups need at least two cells to be ranked, got {', '.join(small_groups)}")
+
+    # spawned rather than forked, forked workers can deadlock on locks held by the thread pools of the parent
+    executor = (
+        ProcessPoolExecutor(max_workers=config.num_workers, mp_context=multiprocessing.get_context("spawn"))
+        if config.num_workers > 0
+        else None
+    )
+    with executor or nullcontext():
+        statistics = reduce_chunks(chunk_statistics, make_tasks(), executor, config.num_workers)
+        if config.method == "wilcoxon":
+            if (statistics["min"] < 0).any():
+                raise ValueError("The binned Wilcoxon ranking needs non-negative values")
+            max_values = np.where(statistics["max"] > 0, statistics["max"], 1)
+            tasks = make_tasks(max_values, config.wilcoxon_bins)
+            statistics.update(reduce_chunks(chunk_histogram, tasks, executor, config.num_workers))
+
+    # the rest of a group are all other grouped cells, as with `reference="rest"`; cells without a group (NaN in
+    # `obs[groupby]`) are left out of every statistic
+    n_grouped = int(n_group.sum())
+    n_rest = n_grouped - n_group
+    means = statistics["sums"] / n_group
+    means_rest = (statistics["sums"].sum(axis=0) - statistics["sums"]) / n_rest
+    squares_rest = statistics["squares"].sum(axis=0) - statistics["squares"]
+    variances = np.maximum(statistics["squares"] - n_group * means**2, 0) / (n_group - 1)
+    variances_rest = np.maximum(squares_rest - n_rest * means_rest**2, 0) / (n_rest - 1)
+
+    if config.method == "t-test":
+        with np.errstate(invalid="ignore", divide="ignore"):
+            scores, pvals = stats.ttest_ind_from_stats(
+                means, np.sqrt(variances), n_group, means_rest, np.sqrt(variances_rest), n_rest, equal_var=False
+            )
+    else:
+        histogram = statistics["histogram"]
+        # zeros rank first and every bin shares the mean rank of its values, like ties
+        zeros = n_grouped - statistics["nonzeros"].sum(axis=0)
+        bin_totals = histogram.sum(axis=0)
+        bin_starts = zeros[:, None] + np.cumsum(bin_totals, axis=1) - bin_totals
+        rank_sums = (n_group - statistics["nonzeros"]) * (zeros + 1) / 2
+        rank_sums += (histogram * (bin_starts + (bin_totals + 1) / 2)).sum(axis=2)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            scores = (rank_sums - n_group * (n_grouped + 1) / 2) / np.sqrt(n_group * n_rest * (n_grouped + 1) / 12)
+        pvals = 2 * stats.norm.sf(np.abs(scores))
+    scores[np.isnan(scores)] = 0
+    pvals[np.isnan(pvals)] = 1
+    log_fold_changes = np.log2((np.expm1(means) + 1e-9) / (np.expm1(means_rest) + 1e-9))
+
+    ranked = [select_top(scores[g], config.n_genes) for g in range(n_groups)]
+
+    def ranked_columns(values: np.ndarray, dtype) -> np.recarray:
+        return np.rec.fromarrays(
+            [np.asarray(values[g][indices], dtype=dtype) for g, indices in enumerate(ranked)], names=group_names
+        )
+
+    gene_list = {
+        "params": {
+            "groupby": config.groupby,
+            "reference": "rest",
+            "method": config.method,
+            "use_raw": config.use_raw,
+            "corr_method": "benjamini-hochberg",
+        },
+        "names": ranked_columns(np.broadcast_to(var_names, scores.shape), object),
+        "scores": ranked_columns(scores, np.float32),
+        "logfoldchanges": ranked_columns(log_fold_changes, np.float32),
+        "pvals": ranked_columns(pvals, np.float64),
+        "pvals_adj": ranked_columns(np.stack([benjamini_hochberg(p) for p in pvals]), np.float64),
+        "pts": pd.DataFrame(statistics["nonzeros"].T / n_group.T, index=var_names, columns=group_names),
+    }
+    write_gene_list(config, gene_list)
+    print(
+        f"Ranked {len(var_names)} genes of {n_groups} groups over {n_grouped} grouped cells of {n_cells} with {config.method} in "
+        f"{time.perf_counter() - start_time:.1f}s"
+    )
+    return gene_list
+
+
+def write_gene_list(config: MarkerConfig, gene_list: dict):
+    if config.output_path:
+        ad.AnnData(uns={"gene_list": gene_list}).write_h5ad(config.output_path)
+        return
+
+    # only the uns group of the input file is rewritten, its matrix stays untouched
+    with h5py.File(config.h5ad_path, "r+") as f:
+        if "uns" not in f:
+            write_elem(f, "uns", {})
+        if "gene_list" in f["uns"]:
+            del f["uns"]["gene_list"]
+        write_elem(f["uns"], "gene_list", gene_list)
@@ -0,0 +1,116 @@
+import time
+import random
+import asyncio
+import openai
+
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Optional
+from openai import AsyncOpenAI
+
+from soar_benchmark.utils.stats import RunStats
+
+
+class TokenBucket:
+    """Allow ``capacity`` units per minute, refilled continuously."""
+
+    def __init__(self, capacity: float):
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.capacity / 60)
+        self.updated = now
+
+    async def acquire(self, amount: float):
+        # a single request larger than the whole bucket waits for a full bucket
+        amount = min(amount, self.capacity)
+        while True:
+            self.refill()
+            if self.tokens >= amount:
+                self.tokens -= amount
+                return
+            await asyncio.sleep((amount - self.tokens) * 60 / self.capacity)
+
+
+class AsyncChatCompletionClient:
+    """Run chat completion requests concurrently under requests- and tokens-per-minute budgets.
+
+    Rate limited (429) and server side (5xx) failures are retried with jittered exponential backoff.
+    """
+
+    def __init__(
+        self,
+        api_key: str,
+        base_url: str = "",
+        max_concurrency: int = 8,
+        requests_per_minute: float = 500,
+        tokens_per_minute: float = 200000,
+        max_retries: int = 6,
+        max_backoff: float = 60,
+        stats: Optional[RunStats] = None,
+    ):
+        self.api_key = api_key
+        self.base_url = base_url
+        self.max_concurrency = max_concurrency
+        self.request_bucket = TokenBucket(requests_per_minute)
+        self.token_bucket = TokenBucket(tokens_per_minute)
+        self.max_retries = max_retries
+        self.max_backoff = max_backoff
+        self.stats = stats if stats is not None else RunStats()
+
+    @staticmethod
+    def estimate_tokens(request: dict[str, Any]) -> int:
+        # the API counts `max_tokens` against the budget up front, prompts are roughly 4 characters per token
+        num_prompt_tokens = sum(len(message["content"]) for message in request["messages"]) // 4
+        return num_prompt_tokens + request.get("max_tokens", 0)
+
+    def backoff(self, attempt: int, error: openai.APIStatusError) -> float:
+        retry_after = error.response.headers.get("retry-after")
+        if retry_after is not None:
+            try:
+                return float(retry_after)
+            except ValueError:
+                pass
+        return min(self.max_backoff, 2**attempt) * random.uniform(0.5, 1.5)
+
+    async def create(self, client: AsyncOpenAI, semaphore: asyncio.Semaphore, request: dict[str, Any]):
+        for attempt in range(self.max_retries + 1):
+            await self.request_bucket.acquire(1)
+            await self.token_bucket.acquire(self.estimate_tokens(request))
+
+            async with semaphore:
+                try:
+                    response = await client.chat.completions.create(**request)
+                except (openai.RateLimitError, openai.InternalServerError) as e:
+                    if attempt == self.max_retries:
+                        raise
+                    self.stats.add("openai/retries")
+                    delay = self.backoff(attempt, e)
+                else:
+                    self.stats.add("openai/requests")
+                    if response.usage is not None:
+                        self.stats.add("openai/prompt_tokens", response.usage.prompt_tokens)
+                        self.stats.add("openai/completion_tokens", response.usage.completion_tokens)
+                    return response.choices[0].message
+
+            await asyncio.sleep(delay)
+
+    async def create_all(self, requests: list[dict[str, Any]]) -> list:
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+        async with AsyncOpenAI(api_key=self.api_key, base_url=self.base_url or None, max_retries=0) as client:
+            return await asyncio.gather(*[self.create(client, semaphore, request) for request in requests])
+
+    def complete(self, requests: list[dict[str, Any]]) -> list:
+        """Return the response message of every request, in order.
+
+        Inside a running event loop, e.g. in Jupyter, the requests run on a loop of their own in a worker thread, since
+        ``asyncio.run`` cannot nest. Async code can await ``create_all`` instead.
+        """
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            return asyncio.run(self.create_all(requests))
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            return executor.submit(asyncio.run, self.create_all(requests)).result()
@@ -1,16 +1,23 @@
 import torch
 import re
 import time
+import numpy as np
 import datetime
 
 from pathlib import Path
 from huggingface_hub import login
-from transformers import pipeline
-from transformers import AutoModelForCausalLM, AutoTokenizer
-from dataclasses import asdict, dataclass, field
-from typing import Any, Dict, Literal
+from transformers import pipeline, set_seed
+from transformers import AutoModelForCausalLM, AutoTokenizer, StoppingCriteriaList
+from dataclasses import dataclass, field
+from typing import Any, Dict, Iterable, Literal, Optional
 from openai import OpenAI
 
+from soar_benchmark.openai.client import AsyncChatCompletionClient
+from soar_benchmark.engine import ContinuousBatchingEngine, GenerationRequest, longest_common_prefix
+from soar_benchmark.bioontology.trie import LabelTrie, read_ontology_labels
+from soar_benchmark.stopping import AnswerStopper, AnswerStoppingCriteria
+from soar_benchmark.utils.stats import RunStats
+
 
 @dataclass
 class GenerationConfig:
@@ -18,6 +25,24 @@ class GenerationConfig:
     do_sample: bool = True
     temperature: float = 0.6
     top_p: float = 0.9
+    # end every sequence on its own before the first stop string, or at the first line break / sentence end once the
+    # answer started; the stop string is not part of the response
+    stop_strings: list[str] = field(default_factory=list)
+    stop_at_newline: bool = False
+    stop_at_sentence_end: bool = False
+    # samples drawn per prompt, e.g. for self-consistency voting, returned as the outputs of its response; the engine
+    # prefills a prompt once for all of its samples
+    num_samples: int = 1
+
+    def generate_kwargs(self) -> dict[str, Any]:
+        # the stopping settings are applied by the pipeline, `generate` only takes the sampling settings
+        return {
+            "max_new_tokens": self.max_new_tokens,
+            "do_sample": self.do_sample,
+            "temperature": self.temperature,
+            "top_p": self.top_p,
+            "num_return_sequences": self.num_samples,
+        }
 
 
 @dataclass
@@ -36,6 +61,43 @@ class PipelineConfig:
     openai_token: str = ""
     pipeline_class_name: str = "CellTypeAnnotationPipeline"
     api_time_interval: float = 1
+    # OpenAI-compatible endpoint, e.g. http://127.0.0.1:8000/v1 of a `soar serve` daemon for the served pipeline
+    openai_base_url: str = ""
+    # > 0 sends up to this many API requests in parallel under the per-minute budgets below
+    api_concurrency: int = 0
+    api_requests_per_minute: float = 500
+    api_tokens_per_minute: float = 200000
+    api_max_retries: int = 6
+    # "continuous" decodes with a rolling batch of `batch_size` sequences refilled from `engine_queue_size` prompts
+    engine: Literal["pipeline", "continuous"] = "pipeline"
+    engine_queue_size: int = 64
+    # prefill the prompt prefix shared by the whole run once and reuse its KV cache (decodes with the engine)
+    prefix_caching: bool = False
+    # restrict answers to the Cell Ontology labels and exact synonyms of this OBO file (or a JSON / text label list),
+    # the label trie is cached in `ontology_cache_dir` (decodes with the engine)
+    ontology_path: str = ""
+    ontology_cache_dir: str = "outputs/cache/ontology"
+    # speculative decoding with a small draft model sharing the tokenizer, e.g. Qwen/Qwen2-0.5B-Instruct for Qwen2-72B
+    # (decodes with the engine)
+    draft_model_name: str = ""
+    # local copy of the draft model, used like `local_ckpt_path`
+    draft_local_ckpt_path: str = ""
+    num_draft_tokens: int = 4
+
+
+def message_key(message: list[dict[str, str]]) -> tuple:
+    return tuple((m["role"], m["content"]) for m in message)
+
+
+def expand_seeds(seeds: Optional[list[int]], num_samples: int) -> Optional[list[int]]:
+    """Derive a seed for every sample of every message, the first sample keeps the seed of its message."""
+    if seeds is None or num_samples == 1:
+        return seeds
+    return [
+        seed if j == 0 else int(np.random.SeedSequence([seed, j]).generate_state(1)[0])
+        for seed in seeds
+        for j in range(num_samples)
+    ]
 
 
 torch_dtype_map = {
@@ -74,11 +136,31 @@ class PipelineBase:
     print(response[0]["generated_text"][-1]["content"])
     """
 
-    def __init__(self, config: PipelineConfig):
+    def __init__(
+        self,
+        config: PipelineConfig,
+        model_and_tokenizer: Optional[tuple[Any, Any]] = None,
+        draft_model=None,
+        label_trie: Optional[LabelTrie] = None,
+    ):
         self.config = config
-
-        self.model, self.tokenizer = self.prepare_model_and_tokenizer(config)
+        self.stats = RunStats()
+        self.stats.derive("generation/tokens_per_second", "generation/new_tokens", "generation/seconds")
+        self.stats.derive("stopping/stop_rate", "stopping/stopped_sequences", "stopping/sequences")
+
+        # a sweep hands the resident model and tokenizer, draft model and label trie to the pipelines of its later
+        # experiments
+        if model_and_tokenizer is None:
+            model_and_tokenizer = self.prepare_model_and_tokenizer(config)
+        self.model, self.tokenizer = model_and_tokenizer
         self.pipe = self.prepare_pipeline(config, self.model, self.tokenizer)
+        self.label_trie = label_trie if label_trie is not None else self.prepare_label_trie(config)
+        # loaded with the first engine, and shared by the scoring engine
+        self.draft_model = draft_model
+        self.engine = self.prepare_engine(config, self.model, self.tokenizer)
+        self.scoring_engine = None
+        # token ids of prompts tokenized ahead of time, e.g. by DataLoader workers, keyed by `message_key`
+        self.prompt_ids: dict[tuple, list[int]] = {}
 
     def prepare_pipeline(self, config: PipelineConfig, model, tokenizer):
         pipeline_kwargs = {}
@@ -100,14 +182,19 @@ class PipelineBase:
         return pipe
 
     def prepare_model_and_tokenizer(self, config: PipelineConfig):
+        return self.load_pretrained(config, config.model_name, config.local_ckpt_path)
+
+    def load_pretrained(
+        self, config: PipelineConfig, model_name: str, local_ckpt_path: str, load_tokenizer: bool = True
+    ) -> tuple[Any, Any]:
         if config.huggingface_token:
             login(token=config.huggingface_token)
 
         # dispatch loading model and tokenizer
-        load_from_str = config.model_name
-        local_path = Path(config.local_ckpt_path)
+        load_from_str = model_name
+        local_path = Path(local_ckpt_path)
         save_after_init = False
-        if config.local_ckpt_path:
+        if local_ckpt_path:
             if local_path.exists():
                 load_from_str = str(local_path)
             else:
@@ -119,38 +206,315 @@ class PipelineBase:
             device_map=config.device_map,
             **config.model_kwargs,
         )
-        tokenizer = AutoTokenizer.from_pretrained(load_from_str, **config.tokenizer_kwargs)
+        tokenizer = AutoTokenizer.from_pretrained(load_from_str, **config.tokenizer_kwargs) if load_tokenizer else None
 
         if save_after_init:
             model.save_pretrained(local_path)
-            tokenizer.save_pretrained(local_path)
+            if tokenizer is not None:
+                tokenizer.save_pretrained(local_path)
         return model, tokenizer
 
-    def __call__(self, messages: list[dict[str, str]], generation_config: GenerationConfig) -> dict:
-        # additional kwargs
-        pipeline_kwargs = {}
+    def prepare_engine(self, config: PipelineConfig, model, tokenizer):
+        if (
+            config.engine != "continuous"
+            and not config.prefix_caching
+            and self.label_trie is None
+            and not config.draft_model_name
+        ):
+            return None
+        return self.build_engine(config, model, tokenizer)
+
+    def build_engine(self, config: PipelineConfig, model, tokenizer) -> ContinuousBatchingEngine:
+        if self.draft_model is None:
+            self.draft_model = self.prepare_draft_model(config)
+        eos_token_ids = self.get_terminators()
+        pad_token_id = tokenizer.pad_token_id if tokenizer.pad_token_id is not None else eos_token_ids[0]
+        return ContinuousBatchingEngine(
+            model,
+            max_active_sequences=config.batch_size,
+            eos_token_ids=eos_token_ids,
+            pad_token_id=pad_token_id,
+            stats=self.stats,
+            draft_model=self.draft_model,
+            num_draft_tokens=config.num_draft_tokens,
+        )
+
+    def prepare_draft_model(self, config: PipelineConfig):
+        if not config.draft_model_name:
+            return None
+
+        # loaded like the target model, with its token, dtype, device map and `model_kwargs` (e.g. attn_implementation)
+        draft_model, _ = self.load_pretrained(
+            config, config.draft_model_name, config.draft_local_ckpt_path, load_tokenizer=False
+        )
+        return draft_model
+
+    def prepare_label_trie(self, config: PipelineConfig) -> Optional[LabelTrie]:
+        if not config.ontology_path:
+            return None
+
+        start = time.perf_counter()
+        labels = read_ontology_labels(config.ontology_path)
+        trie = LabelTrie.from_labels(labels, self.tokenizer, self.get_terminators(), config.ontology_cache_dir)
+        print(
+            f"Label trie with {len(trie)} nodes over {len(labels)} labels ready in {time.perf_counter() - start:.2f}s"
+        )
+        return trie
+
+    def prepare_prefix_cache(self, messages: Iterable[list[dict[str, str]]]):
+        if self.engine is None or not self.config.prefix_caching:
+            return
+
+        # messages are tokenized one at a time, so they can be streamed from the dataset
+        prefix_ids = longest_common_prefix(self.encode_messages(message) for message in messages)
+        self.engine.set_prefix(prefix_ids)
+
+    def get_terminators(self) -> list[int]:
+        terminators = [self.tokenizer.eos_token_id]
         if "Meta-Llama-3" in self.config.model_name:
             # ref: https://huggingface.co/meta-llama/Meta-Llama-3-8B-Instruct/discussions/56
-            terminators = [
-                self.tokenizer.eos_token_id,
-                self.tokenizer.convert_tokens_to_ids("<|eot_id|>"),
-            ]
-            pipeline_kwargs["eos_token_id"] = terminators
-        else:
-            pass
+            terminators.append(self.tokenizer.convert_tokens_to_ids("<|eot_id|>"))
+        return terminators
 
-        return self.pipe(
-            messages,
-            **asdict(generation_config),
-            **pipeline_kwargs,
-            batch_size=self.config.batch_size,
+    def encode_messages(self, message: list[dict[str, str]]) -> list[int]:
+        input_ids = self.prompt_ids.get(message_key(message))
+        return input_ids if input_ids is not None else self.tokenize_messages(message)
+
+    def tokenize_messages(self, message: list[dict[str, str]]) -> list[int]:
+        # same prompt tokens as the text-generation pipeline builds for chat inputs
+        return self.tokenizer.apply_chat_template(message, add_generation_prompt=True)
+
+    def count_prompt_tokens(self, message: list[dict[str, str]]) -> int:
+        return len(self.encode_messages(message))
+
+    def count_completion_tokens(self, output: dict[str, Any]) -> int:
+        # the engine reports the decoded token ids of every sample, the text-generation pipeline only their text
+        if "num_tokens" in output:
+            return output["num_tokens"]
+        return len(self.tokenizer(output["generated_text"][-1]["content"], add_special_tokens=False)["input_ids"])
+
+    def to_response(self, message: list[dict[str, str]], content: str) -> list[dict[str, Any]]:
+        outputs = [{"generated_text": message.copy()}]
+        outputs[0]["generated_text"].append({"role": "assistant", "content": content})
+        return outputs
+
+    def to_responses(self, message: list[dict[str, str]], contents: list[str]) -> list[dict[str, Any]]:
+        # one output per sample, as the text-generation pipeline returns them
+        return [self.to_response(message, content)[0] for content in contents]
+
+    def prepare_stopper(self, generation_config: GenerationConfig) -> Optional[AnswerStopper]:
+        return AnswerStopper.from_generation_config(self.tokenizer, generation_config)
+
+    def stop_answers(
+        self,
+        contents: list[str],
+        list_of_num_tokens: list[int],
+        generation_config: GenerationConfig,
+        stopper: Optional[AnswerStopper],
+    ) -> list[str]:
+        """Cut every answer at its stop and record the decode steps its token budget had left."""
+        if stopper is None:
+            return contents
+
+        answers = []
+        for content, num_tokens in zip(contents, list_of_num_tokens):
+            end = stopper.find(content)
+            if end >= 0:
+                self.stats.add("stopping/stopped_sequences")
+                self.stats.add("stopping/saved_decode_steps", max(generation_config.max_new_tokens - num_tokens, 0))
+                content = content[:end]
+            answers.append(content)
+        self.stats.add("stopping/sequences", len(contents))
+        return answers
+
+    def engine_generate(
+        self,
+        messages: list[list[dict[str, str]]],
+        generation_config: GenerationConfig,
+        seeds: Optional[list[int]] = None,
+        constrained: bool = False,
+    ) -> list:
+        # the samples of a message are admitted next to each other, so they share its prefill
+        k = generation_config.num_samples
+        list_of_input_ids = [input_ids for input_ids in map(self.encode_messages, messages) for _ in range(k)]
+        stopper = self.prepare_stopper(generation_config)
+        requests = self.engine.generate(
+            list_of_input_ids,
+            generation_config,
+            seeds=expand_seeds(seeds, k),
+            trie=self.label_trie if constrained else None,
+            stopper=stopper,
+        )
+
+        contents = [self.tokenizer.decode(request.output_ids, skip_special_tokens=True) for request in requests]
+        # a sample ran out of tokens when it used its whole budget without reaching a stop
+        finish_reasons = [
+            "length"
+            if len(request.output_ids) >= generation_config.max_new_tokens
+            and (stopper is None or stopper.find(content) < 0)
+            else "stop"
+            for request, content in zip(requests, contents)
+        ]
+        contents = self.stop_answers(
+            contents, [len(request.output_ids) for request in requests], generation_config, stopper
+        )
+        responses = [self.to_responses(message, contents[i * k : (i + 1) * k]) for i, message in enumerate(messages)]
+
+        # the mean token log-probability of every sample gauges the confidence of its answer
+        for outputs, output_requests, output_finish_reasons in zip(
+            responses,
+            (requests[i : i + k] for i in range(0, len(requests), k)),
+            (finish_reasons[i : i + k] for i in range(0, len(requests), k)),
+        ):
+            for output, request, finish_reason in zip(outputs, output_requests, output_finish_reasons):
+                output["mean_log_prob"] = float(np.mean(request.output_log_probs)) if request.output_log_probs else None
+                output["num_tokens"] = len(request.output_ids)
+                output["finish_reason"] = finish_reason
+        return responses
+
+    def score_candidates(self, messages: list[list[dict[str, str]]], candidates: list[str]) -> torch.Tensor:
+        """Return the log-likelihood of every candidate answer to every message, shaped [messages, candidates].
+
+        A candidate is scored as the whole assistant response, i.e. followed by the terminator, so a label is not
+        rewarded for being the prefix of a longer one.
+        """
+        # scoring only needs the engine's prefill, so it does not switch generation over to the engine
+        if self.engine is None and self.scoring_engine is None:
+            self.scoring_engine = self.build_engine(self.config, self.model, self.tokenizer)
+        engine = self.engine if self.engine is not None else self.scoring_engine
+
+        terminator = self.get_terminators()[-1]
+        list_of_candidate_ids = [
+            self.tokenizer(candidate, add_special_tokens=False)["input_ids"] + [terminator] for candidate in candidates
+        ]
+
+        start = time.perf_counter()
+        scores = engine.score([self.encode_messages(message) for message in messages], list_of_candidate_ids)
+        self.stats.add("scoring/seconds", time.perf_counter() - start)
+        self.stats.add("scoring/sequences", len(messages))
+        return scores
+
+    def generate_cot(
+        self,
+        messages: list[list[dict[str, str]]],
+        answer_triggers: list[str],
+        generation_config: GenerationConfig,
+        seeds: Optional[list[int]] = None,
+        constrained: bool = False,
+        answer_generation_config: Optional[GenerationConfig] = None,
+    ) -> tuple[list[str], list[str]]:
+        """Decode the reasoning, then append the answer trigger to each sequence and continue from its cache.
+
+        Returns the reasoning and the answer decoded after the trigger for every message, or for every one of the
+        ``num_samples`` adjacent samples of every message. With ``constrained``, the answer is restricted to the labels
+        of the ontology trie. The answer takes its token budget and stopping criteria from ``answer_generation_config``
+        (``generation_config`` by default).
+        """
+        if self.engine is None:
+            raise ValueError("CoT continuation decodes with the engine, set `engine` to 'continuous'")
+
+        answer_generation_config = answer_generation_config or generation_config
+        stopper = self.prepare_stopper(answer_generation_config)
+        k = generation_config.num_samples
+        seeds = expand_seeds(seeds, k)
+        requests = []
+        for i, (message, trigger) in enumerate(zip(messages, answer_triggers)):
+            input_ids = self.encode_messages(message)
+            continuation_ids = self.tokenizer(f" {trigger}", add_special_tokens=False)["input_ids"]
+            for j in range(i * k, (i + 1) * k):
+                requests.append(
+                    GenerationRequest(
+                        uid=j,
+                        input_ids=input_ids,
+                        max_new_tokens=generation_config.max_new_tokens,
+                        continuation_ids=continuation_ids,
+                        generator=self.engine.make_generator(seeds[j]) if seeds is not None else None,
+                        continuation_trie=self.label_trie if constrained else None,
+                        continuation_stopper=stopper,
+                        continuation_max_new_tokens=answer_generation_config.max_new_tokens,
+                    )
+                )
+
+        start = time.perf_counter()
+        self.engine.generate_requests(requests, generation_config)
+        self.stats.add("generation/seconds", time.perf_counter() - start)
+        self.stats.add("generation/sequences", len(requests))
+        self.stats.add("generation/new_tokens", sum(len(r.first_output_ids) + len(r.output_ids) for r in requests))
+
+        reasonings = [self.tokenizer.decode(r.first_output_ids, skip_special_tokens=True) for r in requests]
+        answers = [self.tokenizer.decode(r.output_ids, skip_special_tokens=True) for r in requests]
+        answers = self.stop_answers(answers, [len(r.output_ids) for r in requests], answer_generation_config, stopper)
+        return reasonings, answers
+
+    def __call__(
+        self,
+        messages: list[dict[str, str]],
+        generation_config: GenerationConfig,
+        seeds: Optional[list[int]] = None,
+        constrained: bool = False,
+    ) -> dict:
+        start = time.perf_counter()
+        if self.engine is not None:
+            generated = self.engine_generate(messages, generation_config, seeds=seeds, constrained=constrained)
+        else:
+            # additional kwargs
+            pipeline_kwargs = {}
+            if "Meta-Llama-3" in self.config.model_name:
+                pipeline_kwargs["eos_token_id"] = self.get_terminators()
+            else:
+                pass
+            stopper = self.prepare_stopper(generation_config)
+            if stopper is not None:
+                pipeline_kwargs["stopping_criteria"] = StoppingCriteriaList([AnswerStoppingCriteria(stopper)])
+
+            if seeds is not None and generation_config.do_sample:
+                # the pipeline samples a whole batch from one random stream, so seeded messages run one at a time
+                generated = []
+                for message, seed in zip(messages, seeds):
+                    set_seed(seed)
+                    generated.extend(
+                        self.pipe([message], **generation_config.generate_kwargs(), **pipeline_kwargs, batch_size=1)
+                    )
+            else:
+                generated = self.pipe(
+                    messages,
+                    **generation_config.generate_kwargs(),
+                    **pipeline_kwargs,
+                    batch_size=self.config.batch_size,
+                )
+
+            if stopper is not None:
+                flat_outputs = [output for outputs in generated for output in outputs]
+                contents = [output["generated_text"][-1]["content"] for output in flat_outputs]
+                list_of_num_tokens = [
+                    len(ids) for ids in self.tokenizer(contents, add_special_tokens=False)["input_ids"]
+                ]
+                for output, answer in zip(
+                    flat_outputs, self.stop_answers(contents, list_of_num_tokens, generation_config, stopper)
+                ):
+                    output["generated_text"][-1]["content"] = answer
+
+        self.stats.add("generation/seconds", time.perf_counter() - start)
+        # every message returns `num_samples` sequences
+        self.stats.add("generation/sequences", sum(len(outputs) for outputs in generated))
+        # counted from the token ids the engine decoded, the answers of the text-generation pipeline are tokenized again
+        self.stats.add(
+            "generation/new_tokens",
+            sum(self.count_completion_tokens(output) for outputs in generated for output in outputs),
         )
+        return generated
 
     def run(
         self,
         list_of_messages: list[list[dict[str, str]]],
         generation_config: GenerationConfig,
     ) -> dict:
+        if self.engine is not None:
+            # hand every prompt to the engine at once so freed slots are refilled across batch boundaries
+            flat_messages = [message for messages in list_of_messages for message in messages]
+            flat_responses = iter(self(flat_messages, generation_config))
+            return [[next(flat_responses) for _ in messages] for messages in list_of_messages]
+
         list_of_responses = []
         for messages in list_of_messages:
             responses = self(messages, generation_config)
@@ -159,14 +523,37 @@ class PipelineBase:
 
 
 class CellTypeAnnotationPipeline(PipelineBase):
-    def __init__(self, config: PipelineConfig):
-        super().__init__(config)
+    def __init__(
+        self,
+        config: PipelineConfig,
+        model_and_tokenizer: Optional[tuple[Any, Any]] = None,
+        draft_model=None,
+        label_trie: Optional[LabelTrie] = None,
+    ):
+        super().__init__(config, model_and_tokenizer, draft_model, label_trie)
 
 
 class ChatGPTCellTypeAnnotationPipeline(PipelineBase):
-    def __init__(self, config: PipelineConfig):
-        super().__init__(config)
-        self.client = OpenAI(api_key=config.openai_token)
+    def __init__(
+        self,
+        config: PipelineConfig,
+        model_and_tokenizer: Optional[tuple[Any, Any]] = None,
+        draft_model=None,
+        label_trie: Optional[LabelTrie] = None,
+    ):
+        super().__init__(config, model_and_tokenizer, draft_model, label_trie)
+        self.client = OpenAI(api_key=config.openai_token, base_url=config.openai_base_url or None)
+        self.async_client = None
+        if config.api_concurrency > 0:
+            self.async_client = AsyncChatCompletionClient(
+                api_key=config.openai_token,
+                base_url=config.openai_base_url,
+                max_concurrency=config.api_concurrency,
+                requests_per_minute=config.api_requests_per_minute,
+                tokens_per_minute=config.api_tokens_per_minute,
+                max_retries=config.api_max_retries,
+                stats=self.stats,
+            )
         print_now()
 
     def prepare_model_and_tokenizer(self, config: PipelineConfig):
@@ -175,34 +562,86 @@ class ChatGPTCellTypeAnnotationPipeline(PipelineBase):
     def prepare_pipeline(self, config: PipelineConfig, model, tokenizer):
         return None
 
-    def __call__(self, messages: list[dict[str, str]], generation_config: GenerationConfig) -> dict:
-        generated = []
-        for message in messages:
-            output_dict = self.decode(
-                self.config.model_name,
-                message,
-                max_length=generation_config.max_new_tokens,
-                i=-1,
-                k=-1,  # no meaning for i and k
-            )
+    def count_prompt_tokens(self, message: list[dict[str, str]]) -> int:
+        # no local tokenizer, the character count is a good enough proxy for ordering prompts
+        return sum(len(m["content"]) for m in message)
 
-            # outputs
-            outputs = [{"generated_text": message.copy()}]
-            outputs[0]["generated_text"].append({"role": "assistant", "content": output_dict.content})
+    def score_candidates(self, messages: list[list[dict[str, str]]], candidates: list[str]) -> torch.Tensor:
+        raise ValueError("Candidate scoring needs the logits of a local model")
 
-            generated.append(outputs)
+    def prepare_label_trie(self, config: PipelineConfig) -> Optional[LabelTrie]:
+        if config.ontology_path:
+            raise ValueError("Ontology-constrained decoding needs the logits of a local model")
+        return None
 
+    def __call__(
+        self,
+        messages: list[dict[str, str]],
+        generation_config: GenerationConfig,
+        seeds: Optional[list[int]] = None,
+    ) -> dict:
+        if generation_config.num_samples > 1:
+            raise ValueError("The OpenAI models are queried greedily, sampling several answers needs a local model")
+        seeds = seeds if seeds is not None else [None] * len(messages)
+        # the API ends responses at up to 4 stop strings, line breaks and sentence ends are cut afterwards
+        stopper = self.prepare_stopper(generation_config)
+        stop = generation_config.stop_strings[:4] or None
+        if self.async_client is not None:
+            generated = self.decode_concurrently(
+                messages, max_length=generation_config.max_new_tokens, seeds=seeds, stop=stop
+            )
+        else:
+            generated = []
+            for message, seed in zip(messages, seeds):
+                output_dict = self.decode(
+                    self.config.model_name,
+                    message,
+                    max_length=generation_config.max_new_tokens,
+                    i=-1,
+                    k=-1,  # no meaning for i and k
+                    seed=seed,
+                    stop=stop,
+                )
+
+                # outputs
+                outputs = [{"generated_text": message.copy()}]
+                outputs[0]["generated_text"].append({"role": "assistant", "content": output_dict.content})
+
+                generated.append(outputs)
+
+        if stopper is not None:
+            for outputs in generated:
+                outputs[0]["generated_text"][-1]["content"] = stopper.truncate(
+                    outputs[0]["generated_text"][-1]["content"]
+                )
         return generated
 
-    def decode(self, model, input, max_length, i, k):
-        response = self.decoder_for_chatgpt(model, input, max_length, i, k)
+    def decode(self, model, input, max_length, i, k, seed=None, stop=None):
+        response = self.decoder_for_chatgpt(model, input, max_length, i, k, seed=seed, stop=stop)
         return response
 
-    # Sentence Generator (Decoder) for ChatGPT ...
-    def decoder_for_chatgpt(self, model, input, max_length, i, k):
-        # GPT-3 API allows each users execute the API within 60 times in a minute ...
-        time.sleep(self.config.api_time_interval)
-
+    def decode_concurrently(
+        self,
+        messages: list[list[dict[str, str]]],
+        max_length: int,
+        seeds: list[Optional[int]],
+        stop: Optional[list[str]] = None,
+    ) -> list:
+        engine = self.get_engine(self.config.model_name)
+        requests = []
+        for message, seed in zip(messages, seeds):
+            request = {"model": engine, "messages": message, "max_tokens": max_length, "temperature": 0, "stop": stop}
+            if seed is not None:
+                request["seed"] = seed
+            requests.append(request)
+
+        start = time.perf_counter()
+        output_dicts = self.async_client.complete(requests)
+        self.stats.add("generation/seconds", time.perf_counter() - start)
+        self.stats.add("generation/sequences", len(messages))
+        return [self.to_response(message, output_dict.content) for message, output_dict in zip(messages, output_dicts)]
+
+    def get_engine(self, model):
         # Specify engine ...
         # Instruct GPT3
         if model == "gpt3":
@@ -215,25 +654,121 @@ class ChatGPTCellTypeAnnotationPipeline(PipelineBase):
             engine = "text-davinci-002"
         else:
             engine = model
+        return engine
+
+    # Sentence Generator (Decoder) for ChatGPT ...
+    def decoder_for_chatgpt(self, model, input, max_length, i, k, seed=None, stop=None):
+        # GPT-3 API allows each users execute the API within 60 times in a minute ...
+        time.sleep(self.config.api_time_interval)
 
+        # the API seed makes repeated requests best-effort deterministic
+        seed_kwargs = {"seed": seed} if seed is not None else {}
+        engine = self.get_engine(model)
         response = self.client.chat.completions.create(
             model=engine,
             messages=input,
             max_tokens=max_length,
             temperature=0,
-            stop=None,
+            stop=stop,
+            **seed_kwargs,
         )
+        # the billed tokens, as the concurrent client records them
+        self.stats.add("openai/requests")
+        if response.usage is not None:
+            self.stats.add("openai/prompt_tokens", response.usage.prompt_tokens)
+            self.stats.add("openai/completion_tokens", response.usage.completion_tokens)
 
         return response.choices[0].message
 
 
+class ServedCellTypeAnnotationPipeline(ChatGPTCellTypeAnnotationPipeline):
+    """Client of a local `soar serve` daemon at `openai_base_url`, which holds `model_name` in memory.
+
+    The messages of a batch are sent concurrently so the daemon can batch them again. Unlike the OpenAI models, the
+    sampling settings, stopping criteria and ontology constraints of the experiment are passed on.
+    """
+
+    def __init__(
+        self,
+        config: PipelineConfig,
+        model_and_tokenizer: Optional[tuple[Any, Any]] = None,
+        draft_model=None,
+        label_trie: Optional[LabelTrie] = None,
+    ):
+        super().__init__(config, model_and_tokenizer, draft_model, label_trie)
+        # the daemon is local, so there are no rate limits to respect
+        self.async_client = AsyncChatCompletionClient(
+            api_key=config.openai_token or "EMPTY",
+            base_url=config.openai_base_url,
+            max_concurrency=config.api_concurrency if config.api_concurrency > 0 else config.batch_size,
+            requests_per_minute=float("inf"),
+            tokens_per_minute=float("inf"),
+            max_retries=config.api_max_retries,
+            stats=self.stats,
+        )
+
+    def prepare_label_trie(self, config: PipelineConfig) -> Optional[LabelTrie]:
+        # the daemon constrains the answers with the trie of its own pipeline
+        return None
+
+    def __call__(
+        self,
+        messages: list[dict[str, str]],
+        generation_config: GenerationConfig,
+        seeds: Optional[list[int]] = None,
+        constrained: bool = False,
+    ) -> dict:
+        # the samples of a message are sent as separate requests, the daemon batches them again
+        k = generation_config.num_samples
+        seeds = expand_seeds(seeds, k)
+        requests = []
+        for i, message in enumerate(message for message in messages for _ in range(k)):
+            request = {
+                "model": self.config.model_name,
+                "messages": message,
+                "max_tokens": generation_config.max_new_tokens,
+                "temperature": generation_config.temperature if generation_config.do_sample else 0,
+                "top_p": generation_config.top_p,
+                "stop": generation_config.stop_strings or None,
+                "extra_body": {
+                    "stop_at_newline": generation_config.stop_at_newline,
+                    "stop_at_sentence_end": generation_config.stop_at_sentence_end,
+                    "constrained": constrained,
+                },
+            }
+            if seeds is not None:
+                request["seed"] = seeds[i]
+            requests.append(request)
+
+        start = time.perf_counter()
+        contents = [output_dict.content for output_dict in self.async_client.complete(requests)]
+        self.stats.add("generation/seconds", time.perf_counter() - start)
+        self.stats.add("generation/sequences", len(requests))
+        return [self.to_responses(message, contents[i * k : (i + 1) * k]) for i, message in enumerate(messages)]
+
+
 class Cell2SentCellTypeAnnotationPipeline(CellTypeAnnotationPipeline):
     """
     ref: https://huggingface.co/vandijklab/pythia-160m-c2s
     """
 
-    def __init__(self, config: PipelineConfig):
-        super().__init__(config)
+    def __init__(
+        self,
+        config: PipelineConfig,
+        model_and_tokenizer: Optional[tuple[Any, Any]] = None,
+        draft_model=None,
+        label_trie: Optional[LabelTrie] = None,
+    ):
+        super().__init__(config, model_and_tokenizer, draft_model, label_trie)
+
+        # prompts are batched with left padding, pythia ships without a pad token
+        self.tokenizer.padding_side = "left"
+        if self.tokenizer.pad_token is None:
+            self.tokenizer.pad_token = self.tokenizer.eos_token
+
+        # the label is a single line, so decoding stops at EOS or at any token containing a newline
+        vocab = self.tokenizer.batch_decode([[i] for i in range(len(self.tokenizer))])
+        self.stop_token_ids = [self.tokenizer.eos_token_id] + [i for i, token in enumerate(vocab) if "\n" in token]
 
     def prepare_model_and_tokenizer(self, config: PipelineConfig):
         if config.huggingface_token:
@@ -250,12 +785,14 @@ class Cell2SentCellTypeAnnotationPipeline(CellTypeAnnotationPipeline):
                 save_after_init = True
 
         # for cell2sent, we use customly fintuned model. However, the tokenizer is loaded from the huggingface model.
+        # flash attention is only available on GPUs
+        model_kwargs = {"attn_implementation": "flash_attention_2" if torch.cuda.is_available() else "eager"}
+        model_kwargs.update(config.model_kwargs)
         model = AutoModelForCausalLM.from_pretrained(
             (config.local_finetuned_ckpt_path if config.local_finetuned_ckpt_path else load_from_str),
             torch_dtype=torch_dtype_map.get(config.torch_dtype, torch_dtype_map["bfloat16"]),
             device_map=config.device_map,
-            attn_implementation="flash_attention_2",
-            **config.model_kwargs,
+            **model_kwargs,
         )
         tokenizer = AutoTokenizer.from_pretrained(load_from_str, **config.tokenizer_kwargs)
 
@@ -280,36 +817,76 @@ class Cell2SentCellTypeAnnotationPipeline(CellTypeAnnotationPipeline):
         )
         return ctp
 
-    def complete_sentence(self, ctp: str) -> str:
-        tokens = self.tokenizer(ctp, return_tensors="pt")
-        input_ids = tokens["input_ids"].to(torch.device("cuda"))
-        attention_mask = tokens["attention_mask"].to(torch.device("cuda"))
+    def tokenize_messages(self, message: list[dict[str, str]]) -> list[int]:
+        return self.tokenizer(self.prepare_cellsentence(message))["input_ids"]
+
+    def prepare_label_trie(self, config: PipelineConfig) -> Optional[LabelTrie]:
+        if config.ontology_path:
+            raise ValueError("Cell2Sent decodes with `generate`, ontology-constrained decoding needs the engine")
+        return None
+
+    def prepare_engine(self, config: PipelineConfig, model, tokenizer):
+        # the cell sentence prompts are not chat messages, so the engine and its features are not wired in
+        if config.engine == "continuous" or config.prefix_caching or config.draft_model_name:
+            raise ValueError(
+                "Cell2Sent decodes with `generate`, unset `engine`, `prefix_caching` and `draft_model_name`"
+            )
+        return None
+
+    def count_prompt_tokens(self, message: list[dict[str, str]]) -> int:
+        return len(self.tokenizer(self.prepare_cellsentence(message))["input_ids"])
+
+    def complete_sentences(self, ctps: list[str], generation_config: GenerationConfig) -> list[str]:
+        tokens = self.tokenizer(ctps, return_tensors="pt", padding=True)
+        input_ids = tokens["input_ids"].to(self.model.device)
+        attention_mask = tokens["attention_mask"].to(self.model.device)
+
+        stopper = self.prepare_stopper(generation_config)
+        generate_kwargs = {}
+        if stopper is not None:
+            generate_kwargs["stopping_criteria"] = StoppingCriteriaList([AnswerStoppingCriteria(stopper)])
 
         with torch.inference_mode():
             outputs = self.model.generate(
                 input_ids=input_ids,
                 attention_mask=attention_mask,
-                do_sample=True,
-                max_length=2048,
-                top_k=50,
-                top_p=0.95,
+                **generation_config.generate_kwargs(),
+                eos_token_id=self.stop_token_ids,
+                pad_token_id=self.tokenizer.pad_token_id,
+                **generate_kwargs,
             )
 
-        output_text = self.tokenizer.decode(
-            outputs[0, input_ids.size(1) :], skip_special_tokens=True
-        )  # return newly generated tokens only
-        return output_text
-
-    def __call__(self, messages: list[dict[str, str]], generation_config: GenerationConfig) -> dict:
-        generated = []
-        for message in messages:
-            ctp = self.prepare_cellsentence(message)
-            output_text = self.complete_sentence(ctp)
+        # the samples of a prompt are returned next to each other
+        new_tokens = outputs[:, input_ids.size(1) :]
+        list_of_num_tokens = (new_tokens != self.tokenizer.pad_token_id).sum(dim=1).tolist()
+        self.stats.add("generation/new_tokens", sum(list_of_num_tokens))
 
-            # outputs
-            outputs = [{"generated_text": message.copy()}]
-            outputs[0]["generated_text"].append({"role": "assistant", "content": output_text})
-
-            generated.append(outputs)
+        # return newly generated tokens only, up to the first line break
+        output_texts = self.tokenizer.batch_decode(new_tokens, skip_special_tokens=True)
+        output_texts = [output_text.split("\n")[0] for output_text in output_texts]
+        return self.stop_answers(output_texts, list_of_num_tokens, generation_config, stopper)
 
+    def __call__(
+        self,
+        messages: list[dict[str, str]],
+        generation_config: GenerationConfig,
+        seeds: Optional[list[int]] = None,
+    ) -> dict:
+        start = time.perf_counter()
+        # `generate` samples a whole batch from one random stream, so seeded messages run one at a time
+        batch_size = self.config.batch_size if seeds is None else 1
+        generated = []
+        for batch_start in range(0, len(messages), batch_size):
+            batch = messages[batch_start : batch_start + batch_size]
+            ctps = [self.prepare_cellsentence(message) for message in batch]
+            if seeds is not None:
+                set_seed(seeds[batch_start])
+            output_texts = self.complete_sentences(ctps, generation_config)
+
+            k = generation_config.num_samples
+            for i, message in enumerate(batch):
+                generated.append(self.to_responses(message, output_texts[i * k : (i + 1) * k]))
+
+        self.stats.add("generation/seconds", time.perf_counter() - start)
+        self.stats.add("generation/sequences", sum(len(outputs) for outputs in generated))
         return generated
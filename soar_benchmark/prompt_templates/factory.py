@@ -1,10 +1,119 @@
+import re
+import json
+import hashlib
+
+from typing import Any, Optional
+from operator import itemgetter
+
+
+class CompiledPromptTemplate:
+    """The messages of a prompt template compiled once into %-formats of the messages holding slots, the rest of the
+    text is shared by every prompt.
+
+    The template is compiled by formatting its messages with placeholder slots, so ``format_messages`` must insert the
+    slots verbatim.
+    """
+
+    def __init__(self, prompter: "PromptTemplateBase", slot_names: tuple[str, ...]):
+        placeholders = {name: f"\x00{name}\x00" for name in slot_names}
+        pattern = re.compile("|".join(re.escape(placeholder) for placeholder in placeholders.values()))
+        # (role, static content or %-format, positions of its slots in `slot_names`)
+        self.messages: list[tuple[str, str, tuple[int, ...]]] = []
+        for message in prompter.format_messages(placeholders):
+            content = message["content"]
+            positions = tuple(slot_names.index(match.group()[1:-1]) for match in pattern.finditer(content))
+            if positions:
+                content = pattern.sub("%s", content.replace("%", "%%"))
+            self.messages.append((message["role"], content, positions))
+        # the slot values of every message picked in one call; a single value is a string, which `%` takes as is
+        self.formats = [
+            (role, content, itemgetter(*positions) if positions else None) for role, content, positions in self.messages
+        ]
+
+    def render(self, values: tuple[str, ...]) -> list[dict[str, str]]:
+        return [
+            {"role": role, "content": content % get_values(values) if get_values else content}
+            for role, content, get_values in self.formats
+        ]
+
+
 class PromptTemplateBase:
+    # token budget of a direct answer and whether it ends at its first line break, applied with `answer_stopping`
+    answer_max_new_tokens: Optional[int] = None
+    answer_stop_at_newline: bool = False
+    # whether the prompts show the `demo` of the samples
+    uses_demo: bool = False
+
+    def __init__(self):
+        self.compiled_templates: dict[tuple[str, ...], CompiledPromptTemplate] = {}
+        # samples usually share one demo list, so its block is rendered once; the demo lists are kept with their block
+        # so their ids are not reused while cached
+        self.demo_blocks: dict[int, tuple[list[dict[str, Any]], str]] = {}
+
     def format_messages(self, slots: dict[str, str], **kwargs) -> list[dict[str, str]]:
         raise NotImplementedError
 
     def get_messages(self, *args, **kwargs) -> str:
         raise NotImplementedError
 
+    def format_demo(self, demos: list[dict[str, Any]]) -> str:
+        raise NotImplementedError
+
+    def compile(self, slot_names: tuple[str, ...]) -> CompiledPromptTemplate:
+        if slot_names not in self.compiled_templates:
+            self.compiled_templates[slot_names] = CompiledPromptTemplate(self, slot_names)
+        return self.compiled_templates[slot_names]
+
+    def template_digest(self) -> str:
+        """Digest of the text every prompt shares (templates, triggers and the demo layout), so caches of rendered or
+        tokenized prompts notice an edited template."""
+        slot_names = [("tissue", "gene_names"), ("tissue", "gene_names", "reasoning")]
+        content = []
+        if self.uses_demo:
+            slot_names = [names + ("demo_block",) for names in slot_names]
+            demo = {"gene_names": ["\x00gene\x00"], "tissue": "\x00tissue\x00", "reasoning": "\x00reasoning\x00"}
+            content.append(self.format_demo([{**demo, "cell_type": "\x00cell_type\x00"}]))
+        content.extend(self.compile(names).messages for names in slot_names)
+        return hashlib.sha256(json.dumps(content).encode()).hexdigest()
+
+    def render_demo(self, demo: list[dict[str, Any]]) -> str:
+        if len(self.demo_blocks) >= 1024:
+            self.demo_blocks.clear()
+        if id(demo) not in self.demo_blocks:
+            self.demo_blocks[id(demo)] = (demo, self.format_demo(demo))
+        return self.demo_blocks[id(demo)][1]
+
+    def render_batch(
+        self,
+        samples: list[dict[str, Any]],
+        gene_num_limit: Optional[int] = None,
+        reasonings: Optional[list[str]] = None,
+        demos: Optional[list[list[dict[str, Any]]]] = None,
+    ) -> list[list[dict[str, str]]]:
+        """The messages of every sample, the same as ``get_messages`` with the sample's tissue and first
+        ``gene_num_limit`` genes, its reasoning if given, and its demo (``demos`` or else the sample's own)."""
+        slot_names = ("tissue", "gene_names")
+        if reasonings is not None:
+            slot_names += ("reasoning",)
+        if self.uses_demo:
+            slot_names += ("demo_block",)
+        render = self.compile(slot_names).render
+
+        # the slot values of the whole batch, one column per slot
+        columns = [
+            [sample["tissue"] for sample in samples],
+            [", ".join(sample["genes"][:gene_num_limit]) for sample in samples],
+        ]
+        if reasonings is not None:
+            columns.append(reasonings)
+        if self.uses_demo:
+            if demos is None:
+                demos = [sample.get("demo") for sample in samples]
+            if any(demo is None for demo in demos):
+                raise ValueError("The 'demo' key is missing in the slots")
+            columns.append([self.render_demo(demo) for demo in demos])
+        return [render(values) for values in zip(*columns)]
+
 
 class RankedGeneNamesPromptTemplate(PromptTemplateBase):
     def format_messages(self, slots: dict[str, str], **kwargs) -> list[dict[str, str]]:
@@ -34,6 +143,10 @@ class RankedGeneNamesPromptTemplate(PromptTemplateBase):
 
 
 class ZeroShotRankedGeneNamesPromptTemplate(RankedGeneNamesPromptTemplate):
+    # the trigger asks for one cell type name
+    answer_max_new_tokens = 64
+    answer_stop_at_newline = True
+
     @property
     def direct_answer_trigger_for_zeroshot(self):
         return "The most likely cell type (directly return one cell type name) is"
@@ -179,16 +292,24 @@ class ZeroShotCoTRankedGeneNamesPromptTemplateForSCACT(ZeroShotRankedGeneNamesPr
 
 
 class FewShotRankedGeneNamesPromptTemplate(ZeroShotCoTRankedGeneNamesPromptTemplate):
-    def format_messages(self, slots: dict[str, str], **kwargs) -> list[dict[str, str]]:
+    # the demonstrations reason over several lines before answering
+    answer_max_new_tokens = None
+    answer_stop_at_newline = False
+    uses_demo = True
+
+    def format_demo(self, demos: list[dict[str, Any]]) -> str:
         demo_messages = []
-        for demo in slots["demo"]:
+        for demo in demos:
             gene_names = ", ".join(demo["gene_names"])
             question = f"Question: Given the following markers [{gene_names}], what is the cell type in {demo['tissue']} corresponding to these markers?"
             reasoning = demo["reasoning"]
             answer = f"In summary, the most likely cell type (one cell type name) is {demo['cell_type']}"
             demo_messages.append(f"{question}\n{self.cot_trigger}\n{reasoning}\n{answer}")
+        return "\n\n".join(demo_messages)
 
-        demo_str = "\n\n".join(demo_messages)
+    def format_messages(self, slots: dict[str, str], **kwargs) -> list[dict[str, str]]:
+        # compiled templates take the demo block already rendered
+        demo_str = slots["demo_block"] if "demo_block" in slots else self.format_demo(slots["demo"])
         formated_messages: list[dict[str, str]] = [
             {
                 "role": "system",
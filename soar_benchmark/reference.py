@@ -0,0 +1,105 @@
+import json
+import numpy as np
+import scipy.sparse as sp
+
+from typing import Any, Optional
+from dataclasses import dataclass
+
+from soar_benchmark.dataset import read_ranked_genes
+
+
+@dataclass
+class ReferenceAtlasConfig:
+    # ranked marker genes of reference cell types, as `uns["gene_list"]` of an H5AD file (e.g. written by
+    # `soar prepare-markers`) or a JSON list of {"cell_type": ..., "gene_names": [...]}; disabled when empty
+    path: str = ""
+    # top ranked genes of every reference signature
+    num_genes: int = 50
+    # samples are answered with the best matching cell type, without calling the model, when its score (the share of
+    # the rank-weighted sample genes among its top genes) reaches the threshold
+    threshold: float = 0.8
+    # and beats the score of every other cell type by this margin
+    margin: float = 0.2
+    # samples scored at once
+    batch_size: int = 4096
+
+
+def rank_weights(n: int) -> np.ndarray:
+    # discounted like DCG, the first genes of a ranked list count most
+    return 1 / np.log2(np.arange(n) + 2)
+
+
+class ReferenceAtlas:
+    """Reference signatures as a sparse (signature, gene) matrix, scoring a batch of ranked gene lists against every
+    signature with one sparse product."""
+
+    def __init__(self, config: ReferenceAtlasConfig):
+        self.config = config
+        if config.path.endswith(".h5ad"):
+            cell_types, genes, gene_ids = read_ranked_genes(config.path)
+            signatures = [
+                (cell_type, [genes[i] for i in gene_ids[:, j] if i >= 0]) for j, cell_type in enumerate(cell_types)
+            ]
+        else:
+            with open(config.path) as f:
+                signatures = [(signature["cell_type"], signature["gene_names"]) for signature in json.load(f)]
+        if not signatures:
+            raise ValueError(f"No reference signatures in {config.path}")
+
+        # a cell type may have several signatures and scores as its best one
+        self.cell_types = sorted({cell_type for cell_type, _ in signatures})
+        signatures.sort(key=lambda signature: signature[0])
+        type_codes = np.searchsorted(self.cell_types, [cell_type for cell_type, _ in signatures])
+        self.type_starts = np.searchsorted(type_codes, np.arange(len(self.cell_types)))
+
+        self.gene_ids: dict[str, int] = {}
+        rows, columns = [], []
+        for row, (_, genes) in enumerate(signatures):
+            for gene in dict.fromkeys(genes[: config.num_genes]):
+                rows.append(row)
+                columns.append(self.gene_ids.setdefault(gene, len(self.gene_ids)))
+        self.signatures = sp.csr_matrix(
+            (np.ones(len(rows)), (rows, columns)), shape=(len(signatures), len(self.gene_ids))
+        ).T.tocsr()
+
+    def __len__(self):
+        return self.signatures.shape[1]
+
+    def score(self, gene_lists: list[list[str]]) -> np.ndarray:
+        """(gene list, cell type) scores between 0 and 1."""
+        rows, columns, weights = [], [], []
+        for row, genes in enumerate(gene_lists):
+            # genes missing from the reference still weigh on the total
+            genes = list(dict.fromkeys(genes))
+            sample_weights = rank_weights(len(genes))
+            sample_weights /= max(sample_weights.sum(), 1e-12)
+            for gene, weight in zip(genes, sample_weights):
+                if gene in self.gene_ids:
+                    rows.append(row)
+                    columns.append(self.gene_ids[gene])
+                    weights.append(weight)
+        samples = sp.csr_matrix((weights, (rows, columns)), shape=(len(gene_lists), len(self.gene_ids)))
+        scores = (samples @ self.signatures).toarray()
+        return np.maximum.reduceat(scores, self.type_starts, axis=1)
+
+    def match(self, gene_lists: list[list[str]]) -> list[Optional[dict[str, Any]]]:
+        scores = self.score(gene_lists)
+        best = scores.argmax(axis=1)
+        best_scores = scores[np.arange(len(scores)), best]
+        scores[np.arange(len(scores)), best] = 0
+        runner_up_scores = scores.max(axis=1) if scores.shape[1] > 1 else np.zeros(len(scores))
+
+        matches = []
+        for i, (score, runner_up_score) in enumerate(zip(best_scores.tolist(), runner_up_scores.tolist())):
+            if score >= self.config.threshold and score - runner_up_score >= self.config.margin:
+                matches.append(
+                    {
+                        "cell_type": self.cell_types[best[i]],
+                        "score": score,
+                        "runner_up_score": runner_up_score,
+                        "source": self.config.path,
+                    }
+                )
+            else:
+                matches.append(None)
+        return matches
@@ -0,0 +1,151 @@
+import os
+import json
+import time
+import numpy as np
+
+from array import array
+from pathlib import Path
+from typing import Any, Iterator
+
+from soar_benchmark.utils.digest import file_digest
+
+
+def read_demos(path: str) -> Iterator[dict[str, Any]]:
+    # a JSON list of demos like `demo_path`, or JSON lines for pools too large to load at once
+    with open(path) as f:
+        if path.endswith(".jsonl"):
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+        else:
+            yield from json.load(f)
+
+
+class DemoIndex:
+    """Inverted index from marker genes to the demos of a pool, retrieving the demos whose gene sets are most similar
+    to a sample's by Jaccard similarity.
+
+    The index is written once to ``{index_dir}/demo_index_{digest}`` and memory-mapped afterwards. A query only reads
+    the postings of its own genes, so it costs about ``genes per sample * pool size / vocabulary`` lookups however large
+    the pool is.
+    """
+
+    def __init__(self, pool_path: str, index_dir: str = ""):
+        self.pool_path = pool_path
+        index_dir = Path(index_dir) if index_dir else Path(f"{pool_path}.index")
+        self.directory = index_dir / f"demo_index_{file_digest(pool_path)[:16]}"
+        if not (self.directory / "meta.json").exists():
+            start = time.perf_counter()
+            self.build()
+            self.load()
+            print(f"Indexed {len(self)} demos of {pool_path} in {time.perf_counter() - start:.1f}s")
+        else:
+            self.load()
+
+    def build(self):
+        gene_ids: dict[str, int] = {}
+        # compact buffers, the pool may hold millions of demos
+        demo_genes, demo_ends, offsets = array("i"), array("q"), array("q", [0])
+        tmp_directory = self.directory.with_name(f"{self.directory.name}.tmp{os.getpid()}")
+        tmp_directory.mkdir(parents=True, exist_ok=True)
+        with open(tmp_directory / "demos.jsonl", "wb") as f:
+            for demo in read_demos(self.pool_path):
+                ids = {gene_ids.setdefault(gene, len(gene_ids)) for gene in demo["gene_names"]}
+                demo_genes.extend(sorted(ids))
+                demo_ends.append(len(demo_genes))
+                offsets.append(offsets[-1] + f.write(json.dumps(demo).encode() + b"\n"))
+
+        demo_genes = np.frombuffer(demo_genes, dtype=np.int32)
+        demo_ends = np.frombuffer(demo_ends, dtype=np.int64)
+        demo_sizes = np.diff(demo_ends, prepend=0).astype(np.int32)
+        # postings sorted by gene, then by demo
+        order = np.argsort(demo_genes, kind="stable")
+        postings = np.repeat(np.arange(len(demo_ends), dtype=np.int32), demo_sizes)[order]
+        gene_ends = np.cumsum(np.bincount(demo_genes, minlength=len(gene_ids)))
+        arrays = {
+            "postings": postings,
+            "gene_ends": gene_ends.astype(np.int64),
+            "demo_sizes": demo_sizes,
+            "offsets": np.frombuffer(offsets, dtype=np.int64),
+        }
+        for name, values in arrays.items():
+            np.save(tmp_directory / f"{name}.npy", values)
+        with open(tmp_directory / "meta.json", "w") as f:
+            json.dump({"genes": list(gene_ids), "num_demos": len(demo_ends)}, f)
+        try:
+            tmp_directory.rename(self.directory)
+        except OSError:
+            # another process built the same index meanwhile
+            for path in tmp_directory.iterdir():
+                path.unlink()
+            tmp_directory.rmdir()
+
+    def load(self):
+        with open(self.directory / "meta.json") as f:
+            meta = json.load(f)
+        self.gene_ids = {gene: i for i, gene in enumerate(meta["genes"])}
+        self.num_demos = meta["num_demos"]
+        for name in ["postings", "gene_ends", "demo_sizes", "offsets"]:
+            setattr(self, name, np.load(self.directory / f"{name}.npy", mmap_mode="r"))
+
+    def __len__(self):
+        return self.num_demos
+
+    def __getstate__(self):
+        # DataLoader workers reopen the memory-mapped files rather than receiving copies of them
+        return {"pool_path": self.pool_path, "directory": self.directory}
+
+    def __setstate__(self, state: dict[str, Any]):
+        self.__dict__.update(state)
+        self.load()
+
+    def search(self, gene_lists: list[list[str]], k: int, exclude_nested: bool = True) -> list[list[tuple[int, float]]]:
+        """The ``k`` demos most similar to every gene list as ``(demo, jaccard)`` pairs, most similar first; ties go
+        to the earlier demo and demos sharing no gene are never returned.
+
+        With ``exclude_nested``, demos whose gene set contains the gene list or is contained in it are skipped: when the
+        pool holds the evaluated samples themselves, with all their markers or only the top ones, a sample would
+        otherwise retrieve itself with its answer.
+        """
+        query_rows, query_genes, query_sizes = [], [], []
+        for row, genes in enumerate(gene_lists):
+            genes = set(genes)
+            query_sizes.append(len(genes))
+            ids = [self.gene_ids[gene] for gene in genes if gene in self.gene_ids]
+            query_rows.extend([row] * len(ids))
+            query_genes.extend(ids)
+
+        query_genes = np.asarray(query_genes, dtype=np.int64)
+        starts = np.where(query_genes > 0, self.gene_ends[np.maximum(query_genes - 1, 0)], 0)
+        lengths = self.gene_ends[query_genes] - starts
+        # positions of every posting of every query gene, without a Python loop over the postings
+        positions = np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
+        keys = np.repeat(np.asarray(query_rows, dtype=np.int64), lengths) * self.num_demos + self.postings[positions]
+        keys, intersections = np.unique(keys, return_counts=True)
+        rows, demos = np.divmod(keys, self.num_demos)
+        query_sizes = np.asarray(query_sizes)
+        if exclude_nested:
+            distinct = intersections < np.minimum(query_sizes[rows], self.demo_sizes[demos])
+            rows, demos, intersections = rows[distinct], demos[distinct], intersections[distinct]
+
+        unions = query_sizes[rows] + self.demo_sizes[demos] - intersections
+        scores = intersections / unions
+        order = np.lexsort((demos, -scores, rows))
+        rows, demos, scores = rows[order], demos[order], scores[order]
+        row_starts = np.searchsorted(rows, np.arange(len(gene_lists) + 1))
+        return [
+            list(zip(demos[start : min(start + k, end)].tolist(), scores[start : min(start + k, end)].tolist()))
+            for start, end in zip(row_starts[:-1], row_starts[1:])
+        ]
+
+    def get_demos(self, demo_ids: list[int]) -> list[dict[str, Any]]:
+        demos = []
+        with open(self.directory / "demos.jsonl", "rb") as f:
+            for i in demo_ids:
+                f.seek(self.offsets[i])
+                demos.append(json.loads(f.readline()))
+        return demos
+
+    def retrieve(self, gene_lists: list[list[str]], k: int) -> list[list[dict[str, Any]]]:
+        # the most similar demo goes last, right before the question
+        return [self.get_demos([demo for demo, _ in reversed(hits)]) for hits in self.search(gene_lists, k)]
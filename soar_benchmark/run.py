@@ -1,8 +1,200 @@
+import os
+import json
+import time
+import torch
+import multiprocessing
+
+from pathlib import Path
+from collections import defaultdict
+from dataclasses import replace
+from concurrent.futures import ProcessPoolExecutor
 from nntool.slurm import slurm_fn
-from soar_benchmark.task import CellTypeAnnotationTaskConfig, CellTypeAnnotationTask
+from soar_benchmark.task import CellTypeAnnotationTaskConfig, CellTypeAnnotationTask, pipeline_cls
+from soar_benchmark.serve import ChatCompletionServer
 
 
 @slurm_fn
 def start_annotation_task(config: CellTypeAnnotationTaskConfig):
     task = CellTypeAnnotationTask(config)
     task.run()
+
+
+@slurm_fn
+def merge_annotation_shards(config: CellTypeAnnotationTaskConfig):
+    task = CellTypeAnnotationTask(config)
+    task.merge_shards()
+
+
+def run_annotation_shard(config: CellTypeAnnotationTaskConfig, device: str):
+    # CUDA is initialized lazily, so the worker only sees its own GPU
+    if device:
+        os.environ["CUDA_VISIBLE_DEVICES"] = device
+    task = CellTypeAnnotationTask(config)
+    task.run()
+
+
+def start_sharded_annotation_task(config: CellTypeAnnotationTaskConfig):
+    """Annotate every shard of the dataset and merge their outputs in index order.
+
+    In slurm mode the shards are submitted as a job array followed by a dependent merge job. Otherwise they run as local
+    worker processes, spread round-robin over the visible GPUs.
+    """
+    shard_configs = [replace(config, shard_index=k) for k in range(config.num_shards)]
+    if config.slurm.mode == "slurm":
+        jobs = start_annotation_task[config.slurm].map_array(shard_configs)
+        return merge_annotation_shards[config.slurm].afterok(*jobs)(config)
+
+    devices = os.environ.get("CUDA_VISIBLE_DEVICES", ",".join(map(str, range(torch.cuda.device_count()))))
+    devices = [device for device in devices.split(",") if device]
+    num_workers = config.local_workers if config.local_workers > 0 else config.num_shards
+    with ProcessPoolExecutor(
+        max_workers=num_workers,
+        mp_context=multiprocessing.get_context("spawn"),
+        max_tasks_per_child=1,
+    ) as executor:
+        futures = [
+            executor.submit(run_annotation_shard, shard_config, devices[k % len(devices)] if devices else "")
+            for k, shard_config in enumerate(shard_configs)
+        ]
+        for future in futures:
+            future.result()
+
+    task = CellTypeAnnotationTask(config)
+    task.merge_shards()
+
+
+def model_group_key(config: CellTypeAnnotationTaskConfig) -> str:
+    # experiments agreeing on these settings run on the same loaded weights, and draft model
+    pipeline = config.pipeline
+    return json.dumps(
+        [
+            pipeline.pipeline_class_name,
+            pipeline.model_name,
+            pipeline.local_ckpt_path,
+            pipeline.local_finetuned_ckpt_path,
+            pipeline.torch_dtype,
+            pipeline.device_map,
+            pipeline.model_kwargs,
+            pipeline.tokenizer_kwargs,
+            pipeline.draft_model_name,
+            pipeline.draft_local_ckpt_path,
+        ],
+        sort_keys=True,
+    )
+
+
+def group_experiments(
+    experiments: dict[str, CellTypeAnnotationTaskConfig],
+) -> list[list[tuple[str, CellTypeAnnotationTaskConfig]]]:
+    groups = defaultdict(list)
+    for name, config in experiments.items():
+        groups[model_group_key(config)].append((name, config))
+    return list(groups.values())
+
+
+@slurm_fn
+def start_annotation_sweep(experiments: list[tuple[str, CellTypeAnnotationTaskConfig]], report_path: str):
+    """Run experiments sharing one model in order, loading its weights only for the first one.
+
+    Every later experiment gets its own pipeline (batch size, engine, ...) around the resident model and tokenizer, the
+    draft model and the label trie of its ontology. The report compares the wall time against sequential runs, which
+    would each load the weights again.
+    """
+    start = time.perf_counter()
+    model_and_tokenizer, draft_model, label_tries = None, None, {}
+    report = {"experiments": {}}
+    for name, config in experiments:
+        task = CellTypeAnnotationTask(config)
+        load_start = time.perf_counter()
+        pipeline = pipeline_cls[config.pipeline.pipeline_class_name](
+            config.pipeline,
+            model_and_tokenizer,
+            draft_model=draft_model,
+            label_trie=label_tries.get(config.pipeline.ontology_path),
+        )
+        if model_and_tokenizer is None:
+            model_and_tokenizer = (pipeline.model, pipeline.tokenizer)
+            report["load_seconds"] = time.perf_counter() - load_start
+        draft_model = draft_model or pipeline.draft_model
+        if pipeline.label_trie is not None:
+            label_tries[config.pipeline.ontology_path] = pipeline.label_trie
+
+        run_start = time.perf_counter()
+        task.run(pipeline=pipeline)
+        report["experiments"][name] = {
+            "output_folder": config.output_folder,
+            "run_seconds": time.perf_counter() - run_start,
+        }
+
+    report["wall_seconds"] = time.perf_counter() - start
+    report["sequential_seconds"] = len(experiments) * report["load_seconds"] + sum(
+        experiment["run_seconds"] for experiment in report["experiments"].values()
+    )
+    print(
+        f"Swept {len(experiments)} experiments of {experiments[0][1].pipeline.model_name} in "
+        f"{report['wall_seconds']:.1f}s, {report['sequential_seconds']:.1f}s estimated for sequential runs"
+    )
+    Path(report_path).parent.mkdir(parents=True, exist_ok=True)
+    with open(report_path, "w") as f:
+        json.dump(report, f, indent=4)
+    return report
+
+
+def start_sweep(experiments: dict[str, CellTypeAnnotationTaskConfig], output_folder: str):
+    """Annotate ``experiments`` grouped by model, one job per model loading its weights once.
+
+    Groups run as parallel jobs in slurm mode, and one after the other otherwise. Every group writes its timing report
+    to ``output_folder``, a local sweep also sums them up in ``sweep.json``. Sharded experiments are rejected, an
+    experiment of a sweep always annotates the whole dataset in its group's job.
+    """
+    sharded = [name for name, config in experiments.items() if config.num_shards > 1]
+    if sharded:
+        raise ValueError(f"A sweep does not shard experiments, run {', '.join(sharded)} with `soar annotate` instead")
+
+    groups = group_experiments(experiments)
+    report_paths = []
+    for k, group in enumerate(groups):
+        config = group[0][1]
+        report_paths.append(f"{output_folder}/sweep_{k}_{config.pipeline.model_custom_id}.json")
+        start_annotation_sweep[config.slurm](group, report_paths[-1])
+
+    if any(config.slurm.mode == "slurm" for config in experiments.values()):
+        return
+
+    reports = []
+    for report_path in report_paths:
+        with open(report_path) as f:
+            reports.append(json.load(f))
+    summary = {
+        "num_experiments": len(experiments),
+        "num_models": len(groups),
+        "wall_seconds": sum(report["wall_seconds"] for report in reports),
+        "sequential_seconds": sum(report["sequential_seconds"] for report in reports),
+    }
+    print(
+        f"Swept {summary['num_experiments']} experiments over {summary['num_models']} models in "
+        f"{summary['wall_seconds']:.1f}s, {summary['sequential_seconds']:.1f}s estimated for sequential runs"
+    )
+    with open(f"{output_folder}/sweep.json", "w") as f:
+        json.dump(summary, f, indent=4)
+
+
+def start_server(
+    experiments: dict[str, CellTypeAnnotationTaskConfig],
+    host: str = "127.0.0.1",
+    port: int = 8000,
+    max_batch_size: int = 64,
+    max_wait: float = 0.01,
+) -> ChatCompletionServer:
+    """Load the model of every group of ``experiments`` once and serve it under its model name and custom id.
+
+    The pipeline of a model is configured by its first experiment.
+    """
+    pipelines = {}
+    for group in group_experiments(experiments):
+        config = group[0][1].pipeline
+        pipeline = pipeline_cls[config.pipeline_class_name](config)
+        for _, experiment in group:
+            pipelines[experiment.pipeline.model_name] = pipeline
+            pipelines[experiment.pipeline.model_custom_id] = pipeline
+    return ChatCompletionServer(pipelines, host, port, max_batch_size=max_batch_size, max_wait=max_wait)
@@ -0,0 +1,45 @@
+from torch.utils.data import Sampler
+
+
+def padding_stats(batches: list[list[int]], lengths: list[int]) -> tuple[int, int]:
+    """Return the number of real and left-padded prompt tokens prefilled for ``batches``."""
+    num_tokens, num_padded_tokens = 0, 0
+    for batch in batches:
+        batch_lengths = [lengths[i] for i in batch]
+        num_tokens += sum(batch_lengths)
+        num_padded_tokens += max(batch_lengths) * len(batch_lengths)
+    return num_tokens, num_padded_tokens
+
+
+class LengthBucketBatchSampler(Sampler[list[int]]):
+    """Batch prompts of similar token length together.
+
+    Indices are split into ``num_buckets`` buckets of about equal size by prompt length and every batch is drawn from a
+    single bucket, so a short prompt is never left-padded to the length of a long one. Batches are yielded bucket by
+    bucket; the caller restores the original order from the sample ``index``.
+    """
+
+    def __init__(self, lengths: list[int], batch_size: int, num_buckets: int = 8):
+        self.lengths = lengths
+        self.batch_size = batch_size
+        self.num_buckets = max(1, min(num_buckets, len(lengths)))
+        self.batches = self.prepare_batches()
+
+    def prepare_batches(self) -> list[list[int]]:
+        sorted_indices = sorted(range(len(self.lengths)), key=lambda i: (self.lengths[i], i))
+        # round buckets up to whole batches so only the last bucket may end with a partial batch
+        bucket_size = -(-len(sorted_indices) // self.num_buckets)
+        bucket_size = max(1, -(-bucket_size // self.batch_size) * self.batch_size)
+
+        batches = []
+        for start in range(0, len(sorted_indices), bucket_size):
+            bucket = sorted_indices[start : start + bucket_size]
+            for batch_start in range(0, len(bucket), self.batch_size):
+                batches.append(bucket[batch_start : batch_start + self.batch_size])
+        return batches
+
+    def __iter__(self):
+        yield from self.batches
+
+    def __len__(self):
+        return len(self.batches)
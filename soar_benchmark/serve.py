@@ -0,0 +1,271 @@
+import json
+import time
+import uuid
+import queue
+import pprint
+import threading
+
+from dataclasses import asdict, dataclass, field
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Optional
+
+from soar_benchmark.pipeline import GenerationConfig, PipelineBase
+
+
+@dataclass
+class ChatRequest:
+    message: list[dict[str, str]]
+    generation_config: GenerationConfig
+    seed: Optional[int] = None
+    constrained: bool = False
+    future: Future = field(default_factory=Future)
+
+
+@dataclass
+class ChatResult:
+    content: str
+    prompt_tokens: int
+    completion_tokens: int
+    # "length" when the answer used its whole token budget, "stop" otherwise
+    finish_reason: str
+
+
+class MicroBatcher:
+    """Collect the chat requests arriving concurrently for one pipeline and answer them in batches.
+
+    A batch is closed after ``max_batch_size`` requests or ``max_wait`` seconds after its first request. Requests
+    with the same generation settings are passed to the pipeline together.
+    """
+
+    def __init__(self, pipeline: PipelineBase, max_batch_size: int = 64, max_wait: float = 0.01):
+        self.pipeline = pipeline
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.queue: queue.Queue[ChatRequest] = queue.Queue()
+        self.pipeline.stats.derive("serve/requests_per_batch", "serve/requests", "serve/batches")
+        self.thread = threading.Thread(target=self.loop, daemon=True)
+        self.thread.start()
+
+    def submit(self, request: ChatRequest) -> Future:
+        self.queue.put(request)
+        return request.future
+
+    def collect(self) -> list[ChatRequest]:
+        requests = [self.queue.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(requests) < self.max_batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                requests.append(self.queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return requests
+
+    def loop(self):
+        while True:
+            groups: dict[str, list[ChatRequest]] = {}
+            for request in self.collect():
+                key = json.dumps([asdict(request.generation_config), request.seed is None, request.constrained])
+                groups.setdefault(key, []).append(request)
+
+            for requests in groups.values():
+                self.answer(requests)
+
+    def answer(self, requests: list[ChatRequest]):
+        seeds = None if requests[0].seed is None else [request.seed for request in requests]
+        kwargs = {"constrained": True} if requests[0].constrained else {}
+        try:
+            responses = self.pipeline(
+                [request.message for request in requests], requests[0].generation_config, seeds=seeds, **kwargs
+            )
+        except Exception as e:
+            if len(requests) == 1:
+                requests[0].future.set_exception(e)
+            else:
+                # answer the group one by one, so a failing request does not fail the others batched with it
+                for request in requests:
+                    self.answer([request])
+            return
+
+        self.pipeline.stats.add("serve/batches")
+        self.pipeline.stats.add("serve/requests", len(requests))
+        for request, outputs in zip(requests, responses):
+            request.future.set_result(self.to_result(request, outputs[0]))
+
+    def to_result(self, request: ChatRequest, output: dict[str, Any]) -> ChatResult:
+        # token counts are taken here, on the batcher thread, so handler threads never touch the tokenizer
+        content = output["generated_text"][-1]["content"]
+        completion_tokens = self.pipeline.count_completion_tokens(output)
+        finish_reason = output.get("finish_reason")
+        if finish_reason is None:
+            finish_reason = "length" if completion_tokens >= request.generation_config.max_new_tokens else "stop"
+        return ChatResult(
+            content,
+            prompt_tokens=self.pipeline.count_prompt_tokens(request.message),
+            completion_tokens=completion_tokens,
+            finish_reason=finish_reason,
+        )
+
+
+def to_generation_config(body: dict[str, Any]) -> GenerationConfig:
+    # sampling at temperature 0 is greedy decoding, as for the OpenAI API
+    temperature = body.get("temperature", 1.0)
+    stop = body.get("stop") or []
+    return GenerationConfig(
+        max_new_tokens=body.get("max_tokens") or GenerationConfig.max_new_tokens,
+        do_sample=temperature > 0,
+        temperature=temperature if temperature > 0 else 1.0,
+        top_p=body.get("top_p", 1.0),
+        stop_strings=[stop] if isinstance(stop, str) else list(stop),
+        stop_at_newline=body.get("stop_at_newline", False),
+        stop_at_sentence_end=body.get("stop_at_sentence_end", False),
+    )
+
+
+def check_request(body: dict[str, Any]):
+    messages = body["messages"]
+    if not isinstance(messages, list) or not messages:
+        raise TypeError("messages must be a non-empty list")
+    for i, message in enumerate(messages):
+        if not isinstance(message, dict):
+            raise TypeError(f"messages[{i}] is a JSON {type(message).__name__}, not an object")
+        for key in ("role", "content"):
+            if key not in message:
+                raise KeyError(f"messages[{i}].{key}")
+            if not isinstance(message[key], str):
+                raise TypeError(f"messages[{i}].{key} must be a string")
+
+    seed = body.get("seed")
+    if seed is not None and (not isinstance(seed, int) or isinstance(seed, bool)):
+        raise TypeError("seed must be an integer")
+    if not isinstance(body.get("constrained", False), bool):
+        raise TypeError("constrained must be a boolean")
+
+
+class ChatCompletionHandler(BaseHTTPRequestHandler):
+    server: "ChatCompletionServer"
+
+    def send_json(self, status: int, body: dict[str, Any]):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def send_error_json(self, status: int, message: str):
+        self.send_json(status, {"error": {"message": message, "type": "invalid_request_error", "code": status}})
+
+    def do_GET(self):
+        if self.path.rstrip("/") != "/v1/models":
+            return self.send_error_json(404, f"Unknown path {self.path}")
+
+        models = [{"id": name, "object": "model", "owned_by": "soar"} for name in self.server.batchers]
+        self.send_json(200, {"object": "list", "data": models})
+
+    def do_POST(self):
+        if self.path.rstrip("/") != "/v1/chat/completions":
+            return self.send_error_json(404, f"Unknown path {self.path}")
+
+        # a malformed request is answered like the OpenAI API does, without reaching the batcher
+        try:
+            body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+            if not isinstance(body, dict):
+                raise TypeError(f"the body is a JSON {type(body).__name__}, not an object")
+            check_request(body)
+            message = body["messages"]
+            generation_config = to_generation_config(body)
+        except json.JSONDecodeError as e:
+            return self.send_error_json(400, f"The body is not valid JSON: {e}")
+        except KeyError as e:
+            return self.send_error_json(400, f"Missing required parameter {e}")
+        except (TypeError, ValueError) as e:
+            return self.send_error_json(400, f"Invalid request: {e}")
+
+        batcher = self.server.batchers.get(body.get("model"))
+        if batcher is None:
+            return self.send_error_json(404, f"Model {body.get('model')} is not served")
+        if body.get("n", 1) != 1:
+            return self.send_error_json(400, "Only n=1 is supported")
+
+        future = batcher.submit(
+            ChatRequest(message, generation_config, seed=body.get("seed"), constrained=body.get("constrained", False))
+        )
+        try:
+            result = future.result()
+        except Exception as e:
+            return self.send_error_json(500, f"{type(e).__name__}: {e}")
+
+        self.send_json(
+            200,
+            {
+                "id": f"chatcmpl-{uuid.uuid4().hex}",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": body["model"],
+                "choices": [
+                    {
+                        "index": 0,
+                        "message": {"role": "assistant", "content": result.content},
+                        "finish_reason": result.finish_reason,
+                        "logprobs": None,
+                    }
+                ],
+                "usage": {
+                    "prompt_tokens": result.prompt_tokens,
+                    "completion_tokens": result.completion_tokens,
+                    "total_tokens": result.prompt_tokens + result.completion_tokens,
+                },
+            },
+        )
+
+    def log_message(self, format, *args):
+        # one line per request would drown the pipeline logs
+        pass
+
+
+class ChatCompletionServer(ThreadingHTTPServer):
+    """OpenAI-compatible chat completion endpoint in front of resident pipelines, keyed by served model name.
+
+    Besides the OpenAI request fields (``max_tokens``, ``temperature``, ``top_p``, ``stop``, ``seed``), a request may
+    set ``stop_at_newline``, ``stop_at_sentence_end`` and ``constrained`` (ontology-constrained answers).
+    """
+
+    daemon_threads = True
+
+    def __init__(
+        self,
+        pipelines: dict[str, PipelineBase],
+        host: str = "127.0.0.1",
+        port: int = 8000,
+        max_batch_size: int = 64,
+        max_wait: float = 0.01,
+    ):
+        super().__init__((host, port), ChatCompletionHandler)
+        # names aliasing the same pipeline share its batcher, so their requests are batched together
+        batchers: dict[int, MicroBatcher] = {}
+        self.batchers: dict[str, MicroBatcher] = {}
+        for name, pipeline in pipelines.items():
+            if id(pipeline) not in batchers:
+                batchers[id(pipeline)] = MicroBatcher(pipeline, max_batch_size, max_wait)
+            self.batchers[name] = batchers[id(pipeline)]
+
+    @property
+    def base_url(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def serve(self):
+        print(f"Serving {', '.join(self.batchers)} at {self.base_url}")
+        try:
+            self.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.server_close()
+            for batcher in {id(batcher): batcher for batcher in self.batchers.values()}.values():
+                print(batcher.pipeline.config.model_custom_id)
+                pprint.pp(batcher.pipeline.stats.summary(), width=240)
@@ -0,0 +1,131 @@
+import re
+import torch
+
+from typing import Optional
+from dataclasses import dataclass
+from transformers import StoppingCriteria
+
+
+# a sentence ends at punctuation followed by whitespace, so abbreviations like "CD4+." only end it once the next word
+# is generated and decimals never do
+SENTENCE_END = re.compile(r"[.!?](?=\s)")
+
+
+@dataclass
+class StopState:
+    # the first token of a sequence whose text is not whitespace, where its answer starts; -1 before that
+    answer_start: int = -1
+
+
+class AnswerStopper:
+    """Find where a short answer ends in its decoded text.
+
+    The answer ends right before the first stop string, and optionally at the first line break or sentence end after
+    the answer started, i.e. leading whitespace does not end it.
+
+    While decoding, ``is_stopped`` only decodes the last ``tail_tokens`` tokens of a sequence, which hold any stop
+    that the last token can have completed, so checking a sequence costs the same at every step.
+    """
+
+    def __init__(
+        self,
+        tokenizer=None,
+        stop_strings: list[str] = (),
+        stop_at_newline: bool = False,
+        stop_at_sentence_end: bool = False,
+    ):
+        self.tokenizer = tokenizer
+        self.stop_strings = [stop_string for stop_string in stop_strings if stop_string]
+        self.stop_at_newline = stop_at_newline
+        self.stop_at_sentence_end = stop_at_sentence_end
+        # a stop string spans at most one token per character, a sentence end two characters; a few more tokens
+        # cover tokens that only decode to text together with their neighbours
+        self.tail_tokens = max([len(stop_string) for stop_string in self.stop_strings] + [2]) + 4
+
+    @classmethod
+    def from_generation_config(cls, tokenizer, generation_config) -> Optional["AnswerStopper"]:
+        if not (
+            generation_config.stop_strings
+            or generation_config.stop_at_newline
+            or generation_config.stop_at_sentence_end
+        ):
+            return None
+        return cls(
+            tokenizer,
+            generation_config.stop_strings,
+            generation_config.stop_at_newline,
+            generation_config.stop_at_sentence_end,
+        )
+
+    def find(self, text: str) -> int:
+        """Return the length of the answer in ``text``, or -1 if it has not ended yet."""
+        ends = [end for end in (text.find(stop_string) for stop_string in self.stop_strings) if end >= 0]
+        start = len(text) - len(text.lstrip())
+        if self.stop_at_newline and text.find("\n", start) >= 0:
+            ends.append(text.find("\n", start))
+        if self.stop_at_sentence_end:
+            match = SENTENCE_END.search(text, start)
+            if match:
+                # keep the punctuation
+                ends.append(match.end())
+        return min(ends, default=-1)
+
+    def truncate(self, text: str) -> str:
+        end = self.find(text)
+        return text if end < 0 else text[:end]
+
+    def decode(self, token_ids: list[int]) -> str:
+        return self.tokenizer.decode(token_ids, skip_special_tokens=True)
+
+    def is_stopped(self, token_ids: list[int], state: Optional[StopState] = None) -> bool:
+        """Whether the answer in ``token_ids`` has ended, for a sequence checked after every token with ``state``.
+
+        Without ``state`` the whole sequence is decoded.
+        """
+        if state is None:
+            return self.find(self.decode(token_ids)) >= 0
+
+        if state.answer_start < 0 and token_ids and self.decode(token_ids[-1:]).strip():
+            state.answer_start = len(token_ids) - 1
+        # earlier stops were caught at earlier steps, only the tail can hold a new one
+        tail_start = max(len(token_ids) - self.tail_tokens, 0)
+        text = self.decode(token_ids[tail_start:])
+        if any(stop_string in text for stop_string in self.stop_strings):
+            return True
+        if state.answer_start < 0:
+            return False
+        if state.answer_start > tail_start:
+            text = self.decode(token_ids[state.answer_start :])
+        return self.find(text) >= 0
+
+
+class AnswerStoppingCriteria(StoppingCriteria):
+    """Stop every sequence of a ``generate`` call on its own once its answer ended.
+
+    The text-generation pipeline calls ``generate`` once per batch with the same criteria, a new call is recognized by
+    its sequences no longer extending the previous step by one token.
+    """
+
+    def __init__(self, stopper: AnswerStopper):
+        self.stopper = stopper
+        self.prompt_ids: Optional[torch.Tensor] = None
+        self.states: list[StopState] = []
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> torch.BoolTensor:
+        prompt_length = self.prompt_ids.size(1) if self.prompt_ids is not None else 0
+        if (
+            self.prompt_ids is None
+            or input_ids.size(0) != self.prompt_ids.size(0)
+            or input_ids.size(1) <= prompt_length
+            or not torch.equal(input_ids[:, :prompt_length], self.prompt_ids)
+        ):
+            # the first step of a call has generated a single token
+            self.prompt_ids = input_ids[:, :-1]
+            prompt_length = self.prompt_ids.size(1)
+            self.states = [StopState() for _ in range(input_ids.size(0))]
+
+        stopped = [
+            self.stopper.is_stopped(token_ids, state)
+            for token_ids, state in zip(input_ids[:, prompt_length:].tolist(), self.states)
+        ]
+        return torch.tensor(stopped, dtype=torch.bool, device=input_ids.device)
@@ -1,28 +1,42 @@
 import json
+import time
 import pprint
-from typing import Any
+import numpy as np
+from typing import Any, Optional
 
 from tqdm import tqdm
 from pathlib import Path
-from dataclasses import asdict, dataclass, field
+from dataclasses import asdict, dataclass, field, replace
 from transformers import set_seed
 from nntool.slurm import SlurmConfig
 from torch.utils.data import Subset, DataLoader
 
 from soar_benchmark.dataset import (
+    ColumnarDataset,
+    ColumnarDatasetConfig,
     JSONDatasetConfig,
     DatasetBaseConfig,
     H5ADDataset,
     H5ADDatasetConfig,
+    H5ADCellDataset,
+    H5ADCellDatasetConfig,
 )
-from soar_benchmark.pipeline import PipelineConfig, GenerationConfig
+from soar_benchmark.pipeline import PipelineConfig, GenerationConfig, expand_seeds, message_key
 from soar_benchmark.pipeline import (
     CellTypeAnnotationPipeline,
     PipelineBase,
     Cell2SentCellTypeAnnotationPipeline,
     ChatGPTCellTypeAnnotationPipeline,
+    ServedCellTypeAnnotationPipeline,
 )
 from soar_benchmark.dataset import JSONDataset
+from soar_benchmark.cache import CachedPipeline, PromptCache, ResponseCache
+from soar_benchmark.collate import PromptBatch, PromptCollator
+from soar_benchmark.retrieval import DemoIndex
+from soar_benchmark.reference import ReferenceAtlas, ReferenceAtlasConfig
+from soar_benchmark.cascade import CascadeTierConfig, answer_confidence
+from soar_benchmark.utils.checkpoint import JSONLWriter, read_jsonl
+from soar_benchmark.sampler import LengthBucketBatchSampler, padding_stats
 from soar_benchmark.prompt_templates.factory import (
     PromptTemplateBase,
     RankedGeneNamesPromptTemplate,
@@ -46,6 +60,7 @@ pipeline_cls: dict[str, PipelineBase] = {
     "CellTypeAnnotationPipeline": CellTypeAnnotationPipeline,
     "Cell2SentCellTypeAnnotationPipeline": Cell2SentCellTypeAnnotationPipeline,
     "ChatGPTCellTypeAnnotationPipeline": ChatGPTCellTypeAnnotationPipeline,
+    "ServedCellTypeAnnotationPipeline": ServedCellTypeAnnotationPipeline,
 }
 
 
@@ -61,7 +76,9 @@ class TaskBase:
         self.output_folder = Path(config.output_folder)
         self.output_folder.mkdir(parents=True, exist_ok=True)
 
-        # save config file
+        self.save_config(config)
+
+    def save_config(self, config: TaskConfig):
         with open(self.output_folder / "config.json", "w") as f:
             json.dump(asdict(config), f, indent=4)
 
@@ -76,92 +93,607 @@ class TaskBase:
 class CellTypeAnnotationTaskConfig(TaskConfig):
     promter_name: str = "ranked_gene"
     gene_num_limit: int = -1
+    # batch prompts of similar token length to reduce left padding
+    length_bucketing: bool = False
+    num_length_buckets: int = 8
+    # zero-shot CoT: answer by appending the trigger to the generated reasoning and decoding on from its KV cache
+    # instead of prefilling a second prompt (requires the engine)
+    cot_continuation: bool = False
+    # reuse responses of earlier runs stored in this SQLite file (disabled when empty)
+    response_cache_path: str = ""
+    response_cache_max_mb: float = 1024
+    # render and tokenize the prompts of the next batches in DataLoader worker processes while a batch generates
+    num_workers: int = 0
+    prefetch_factor: int = 2
+    # reuse the prompt token ids of earlier runs stored in this folder, keyed by the dataset files, the prompter and the
+    # tokenizer (disabled when empty, prompts are tokenized ahead of time for the engine only)
+    prompt_cache_dir: str = ""
+    # skip samples already written to `{model_custom_id}.jsonl` by an interrupted run
+    resume: bool = False
+    # fsync the JSONL output every n batches
+    fsync_every: int = 8
+    # split the dataset into `num_shards` strided shards; shard_index -1 annotates every shard (as a slurm job array
+    # in slurm mode, as local worker processes otherwise) and merges them, k >= 0 annotates shard k only
+    num_shards: int = 1
+    shard_index: int = -1
+    # local worker processes running shards at the same time, 0 runs every shard at once
+    local_workers: int = 0
+    # seed every sample from (random_seed, index), so sampled responses do not depend on batching or sharding
+    per_sample_seeding: bool = False
+    # rank candidate labels by their log-likelihood given the prompt instead of generating an answer; candidates are
+    # read from a JSON list or a text file with one label per line, or default to the non-empty labels of the dataset
+    scoring: bool = False
+    candidate_labels_path: str = ""
+    num_ranked_candidates: int = 5
+    # cap direct answers at the prompter's answer token budget and end them at their first line break; stop strings and
+    # sentence-end stopping are set in `generation` and, like these, never cut the reasoning of CoT prompters short
+    answer_stopping: bool = False
     dataset: DatasetBaseConfig = field(default_factory=DatasetBaseConfig)
     generation: GenerationConfig = field(default_factory=GenerationConfig)
     pipeline: PipelineConfig = field(default_factory=PipelineConfig)
     slurm: SlurmConfig = field(default_factory=SlurmConfig)
+    # answer with a cascade of pipelines, cheapest first, passing the answers rated below a tier's threshold on to the
+    # next tier; records note the answering tier and `{model_custom_id}_cascade.json` breaks cost and latency down
+    cascade: list[CascadeTierConfig] = field(default_factory=list)
+    # answer the samples matching a reference signature confidently with its cell type before calling the model;
+    # records note the match and the run stats count the saved model calls
+    reference: ReferenceAtlasConfig = field(default_factory=ReferenceAtlasConfig)
 
 
 class CellTypeAnnotationTask(TaskBase):
     def __init__(self, config: CellTypeAnnotationTaskConfig):
+        config = self.seed_sharded_sampling(config)
         super().__init__(config)
         self.config = config
         self.gene_limit_num = config.gene_num_limit if config.gene_num_limit > 0 else None
+        # one prompter per task, its templates are compiled once and reused for every batch
+        self.prompter = prompter_cls[config.promter_name]() if config.promter_name in prompter_cls else None
+        self.demo_index = self.prepare_demo_index()
+        self.check_cascade()
+
+    @staticmethod
+    def seed_sharded_sampling(config: CellTypeAnnotationTaskConfig) -> CellTypeAnnotationTaskConfig:
+        # a shard batches other samples together than a single-process run, so sampled responses only match it when
+        # every sample is seeded by itself
+        generations = [config.generation] + [tier.generation for tier in config.cascade if tier.generation is not None]
+        if (
+            config.num_shards <= 1
+            or config.per_sample_seeding
+            or config.scoring
+            or not any(generation.do_sample for generation in generations)
+        ):
+            return config
+        print("Sampling in shards, turning on `per_sample_seeding` so the responses do not depend on the sharding")
+        return replace(config, per_sample_seeding=True)
+
+    def save_config(self, config: CellTypeAnnotationTaskConfig):
+        # shard workers share the output folder, the launcher or the merge job writes the config of the whole run
+        if config.num_shards > 1 and config.shard_index >= 0:
+            return
+        super().save_config(config)
+
+    @property
+    def output_name(self) -> str:
+        if self.config.shard_index < 0:
+            return self.config.pipeline.model_custom_id
+        return self.shard_name(self.config.shard_index)
+
+    def shard_name(self, shard_index: int) -> str:
+        return f"{self.config.pipeline.model_custom_id}_shard{shard_index}-of-{self.config.num_shards}"
+
+    @property
+    def answer_kwargs(self) -> dict[str, Any]:
+        return self.constrained_kwargs(self.config.pipeline)
+
+    def constrained_kwargs(self, config: PipelineConfig) -> dict[str, Any]:
+        # the pipeline restricts the answer to ontology labels when it has a label trie; only direct answers and the
+        # answers after the CoT trigger are constrained, few-shot answers follow their own reasoning
+        if not config.ontology_path or self.config.promter_name == "few_shot":
+            return {}
+        return {"constrained": True}
+
+    @property
+    def answer_generation_config(self) -> GenerationConfig:
+        generation = self.config.generation
+        if not self.config.answer_stopping:
+            return generation
+
+        prompter = prompter_cls[self.config.promter_name]
+        return replace(
+            generation,
+            max_new_tokens=min(generation.max_new_tokens, prompter.answer_max_new_tokens or generation.max_new_tokens),
+            stop_at_newline=generation.stop_at_newline or prompter.answer_stop_at_newline,
+        )
+
+    @property
+    def reasoning_generation_config(self) -> GenerationConfig:
+        return replace(self.config.generation, stop_strings=[], stop_at_newline=False, stop_at_sentence_end=False)
+
+    def sample_seeds(self, batch: list[dict[str, Any]], stage: int = 0) -> Optional[list[int]]:
+        if not self.config.per_sample_seeding:
+            return None
+        return [
+            int(np.random.SeedSequence([self.config.random_seed, sample["index"], stage]).generate_state(1)[0])
+            for sample in batch
+        ]
 
     def prepare_input(self, batch: list[dict[str, Any]], post_batch: list[dict[str, Any]] = None):
         prompter_name = self.config.promter_name
-        prompter = prompter_cls[prompter_name]()
-
-        messages = []
-        for i, sample in enumerate(batch):
-            if prompter_name in {"zero_shot", "zero_shot_scact", "ranked_gene"}:
-                x = prompter.get_messages(
-                    sample["tissue"],
-                    sample["genes"][: self.gene_limit_num],
-                )
-            elif prompter_name in {"zero_shot_cot", "zero_shot_cot_scact"}:
-                kwargs = (
-                    {"reasoning": post_batch[i][0]["generated_text"][-1]["content"]} if post_batch is not None else {}
-                )
-                x = prompter.get_messages(sample["tissue"], sample["genes"][: self.gene_limit_num], **kwargs)
-            elif prompter_name in {
-                "few_shot",
-            }:
-                x = prompter.get_messages(
-                    sample["tissue"],
-                    sample["genes"][: self.gene_limit_num],
-                    demo=sample["demo"],
+        if prompter_name not in prompter_cls:
+            raise ValueError(f"Invalid prompter name: {prompter_name}")
+
+        reasonings = None
+        if prompter_name in {"zero_shot_cot", "zero_shot_cot_scact"} and post_batch is not None:
+            reasonings = [outputs[0]["generated_text"][-1]["content"] for outputs in post_batch]
+        demos = None
+        if prompter_name == "few_shot" and self.demo_index is not None:
+            demos = self.demo_index.retrieve(
+                [sample["genes"][: self.gene_limit_num] for sample in batch], self.config.dataset.num_retrieved_demos
+            )
+        return self.prompter.render_batch(batch, self.gene_limit_num, reasonings=reasonings, demos=demos)
+
+    def continue_cot(self, pipeline: PipelineBase, batch: list[dict[str, Any]], messages: list[list[dict[str, str]]]):
+        answer_triggers = [self.prompter.direct_answer_trigger_for_zeroshot_cot({"tissue": s["tissue"]}) for s in batch]
+        reasonings, answers = pipeline.generate_cot(
+            messages,
+            answer_triggers,
+            self.reasoning_generation_config,
+            seeds=self.sample_seeds(batch),
+            answer_generation_config=self.answer_generation_config,
+            **self.answer_kwargs,
+        )
+
+        # record the sequence the model decoded: the first-turn messages, the reasoning with the trigger appended to
+        # it, and the answer continued from there as the last turn, where the analysis scripts read the answer
+        k = self.reasoning_generation_config.num_samples
+        outputs = [
+            pipeline.to_response(
+                messages[i // k] + [{"role": "assistant", "content": f"{reasoning} {answer_triggers[i // k]}"}], answer
+            )[0]
+            for i, (reasoning, answer) in enumerate(zip(reasonings, answers))
+        ]
+        pprint.pp(outputs, width=240)
+        return [outputs[i * k : (i + 1) * k] for i in range(len(batch))]
+
+    def check_cascade(self):
+        # a single answer, or several greedy ones, always agrees with itself and would never be passed on
+        for t, tier in enumerate(self.config.cascade):
+            generation = tier.generation or self.config.generation
+            if tier.confidence == "agreement" and (generation.num_samples < 2 or not generation.do_sample):
+                raise ValueError(
+                    f"Tier {t} rates answers by agreement, set its `generation.num_samples` to at least 2 and "
+                    "`generation.do_sample`"
                 )
+
+    def prepare_cascade(self, pipeline: PipelineBase):
+        if self.config.scoring or self.config.promter_name in {"zero_shot_cot", "zero_shot_cot_scact"}:
+            raise ValueError("The cascade rates generated answers, use a prompter without reasoning and no scoring")
+
+        self.tiers: list[tuple[CascadeTierConfig, PipelineBase]] = []
+        for tier in self.config.cascade:
+            if tier.pipeline is None or tier.pipeline == self.config.pipeline:
+                self.tiers.append((tier, pipeline))
             else:
-                raise ValueError(f"Invalid prompter name: {prompter_name}")
+                self.tiers.append((tier, self.prepare_pipeline(tier.pipeline)))
+        self.tier_reports = [
+            {"samples": 0, "answered": 0, "seconds": 0.0, "prompt_tokens": 0, "completion_tokens": 0}
+            for _ in self.tiers
+        ]
+
+    def run_cascade(self, batch: list[dict[str, Any]], messages: list[list[dict[str, str]]]):
+        responses = [None] * len(batch)
+        cascades = [{"confidences": [], "seconds": 0.0} for _ in batch]
+        remaining = list(range(len(batch)))
+        for t, (tier, pipeline) in enumerate(self.tiers):
+            if not remaining:
+                break
+
+            counters = dict(pipeline.stats.counters)
+            start = time.perf_counter()
+            tier_responses = pipeline(
+                [messages[i] for i in remaining],
+                tier.generation or self.answer_generation_config,
+                seeds=self.sample_seeds([batch[i] for i in remaining]),
+                **self.constrained_kwargs(pipeline.config),
+            )
+            seconds = time.perf_counter() - start
+
+            # API pipelines count the billed tokens reported by the API, local ones tokenize the prompts and count the
+            # decoded tokens
+            delta = {name: pipeline.stats.get(name) - counters.get(name, 0.0) for name in pipeline.stats.counters}
+            report = self.tier_reports[t]
+            report["samples"] += len(remaining)
+            report["seconds"] += seconds
+            if pipeline.tokenizer is None:
+                report["prompt_tokens"] += int(delta.get("openai/prompt_tokens", 0))
+                report["completion_tokens"] += int(delta.get("openai/completion_tokens", 0))
+            else:
+                report["prompt_tokens"] += sum(pipeline.count_prompt_tokens(messages[i]) for i in remaining)
+                report["completion_tokens"] += sum(
+                    pipeline.count_completion_tokens(output) for outputs in tier_responses for output in outputs
+                )
+
+            escalated = []
+            for i, outputs in zip(remaining, tier_responses):
+                output, confidence = answer_confidence(outputs, tier.confidence)
+                cascades[i]["confidences"].append(confidence)
+                cascades[i]["seconds"] += seconds
+                if t < len(self.tiers) - 1:
+                    if confidence is None:
+                        raise ValueError(
+                            f"Tier {t} records no token log-probabilities, set its `engine` to 'continuous'"
+                        )
+                    if confidence < tier.threshold:
+                        escalated.append(i)
+                        continue
+
+                responses[i] = [output] + [other for other in outputs if other is not output]
+                cascades[i]["tier"] = t
+                cascades[i]["model_custom_id"] = pipeline.config.model_custom_id
+                report["answered"] += 1
+            remaining = escalated
+        return responses, cascades
+
+    def write_cascade_report(self):
+        tiers = []
+        for (tier, pipeline), report in zip(self.tiers, self.tier_reports):
+            cost = (
+                report["prompt_tokens"] * tier.prompt_token_price
+                + report["completion_tokens"] * tier.completion_token_price
+            )
+            tiers.append(
+                {
+                    "model_custom_id": pipeline.config.model_custom_id,
+                    **report,
+                    "escalated": report["samples"] - report["answered"],
+                    "cost": cost / 1e6,
+                    "seconds_per_sample": report["seconds"] / max(report["samples"], 1),
+                }
+            )
+
+        # running the last tier alone, extrapolated from the samples it was sent
+        num_samples, last = tiers[0]["samples"], tiers[-1]
+        summary = {
+            "samples": num_samples,
+            "cost": sum(tier["cost"] for tier in tiers),
+            "seconds": sum(tier["seconds"] for tier in tiers),
+            "last_tier_cost": last["cost"] / max(last["samples"], 1) * num_samples,
+            "last_tier_seconds": last["seconds_per_sample"] * num_samples,
+            "tiers": tiers,
+        }
+        pprint.pp(summary, width=240)
+        with open(self.output_folder / f"{self.output_name}_cascade.json", "w") as f:
+            json.dump(summary, f, indent=4)
+
+    def prepare_candidate_labels(self, dataset: Subset) -> list[str]:
+        if not self.config.candidate_labels_path:
+            # the vocabulary of the whole dataset, so every shard ranks the same candidates; missing labels are no
+            # candidates
+            labels = dataset.dataset.get_labels()
+            return sorted({label for label in labels if isinstance(label, str) and label.strip()})
 
-            messages.append(x)
-        return messages
+        path = Path(self.config.candidate_labels_path)
+        if path.suffix == ".json":
+            with open(path) as f:
+                return json.load(f)
+        with open(path) as f:
+            return [line.strip() for line in f if line.strip()]
+
+    def rank_candidates(self, pipeline: PipelineBase, messages: list[list[dict[str, str]]]):
+        log_likelihoods = pipeline.score_candidates(messages, self.candidate_labels)
+        # normalized over the candidate set
+        probabilities = log_likelihoods.softmax(dim=-1)
+        top = probabilities.topk(min(self.config.num_ranked_candidates, len(self.candidate_labels)), dim=-1)
+
+        responses, rankings = [], []
+        for i, message in enumerate(messages):
+            ranking = [
+                {
+                    "label": self.candidate_labels[j],
+                    "log_likelihood": log_likelihoods[i, j].item(),
+                    "probability": probabilities[i, j].item(),
+                }
+                for j in top.indices[i].tolist()
+            ]
+            responses.append(pipeline.to_response(message, ranking[0]["label"]))
+            rankings.append(ranking)
+        return responses, rankings
 
     def prepare_dataset(self):
         dataset = None
         if isinstance(self.config.dataset, JSONDatasetConfig):
             dataset = JSONDataset(self.config.dataset)
+        elif isinstance(self.config.dataset, ColumnarDatasetConfig):
+            dataset = ColumnarDataset(self.config.dataset)
         elif isinstance(self.config.dataset, H5ADDatasetConfig):
             dataset = H5ADDataset(self.config.dataset)
+        elif isinstance(self.config.dataset, H5ADCellDatasetConfig):
+            dataset = H5ADCellDataset(self.config.dataset)
         else:
             raise NotImplementedError
 
-        dataset = Subset(dataset, indices=list(range(len(dataset))))
+        indices = list(range(len(dataset)))
+        if self.config.shard_index >= 0:
+            indices = indices[self.config.shard_index :: self.config.num_shards]
+        dataset = Subset(dataset, indices=indices)
         return dataset
 
-    def run(self, *args, **kwargs):
-        pipeline = pipeline_cls[self.config.pipeline.pipeline_class_name](self.config.pipeline)
-        dataset = self.prepare_dataset()
-        dataloader = DataLoader(
+    def prepare_demo_index(self) -> Optional[DemoIndex]:
+        dataset_config = self.config.dataset
+        if not dataset_config.demo_pool_path:
+            return None
+        demo_index = DemoIndex(dataset_config.demo_pool_path, dataset_config.demo_index_dir)
+        print(f"Retrieving {dataset_config.num_retrieved_demos} of {len(demo_index)} demos per sample")
+        return demo_index
+
+    def prepare_prompt_cache(self, pipeline: PipelineBase) -> Optional[PromptCache]:
+        # the text-generation pipeline tokenizes its inputs itself, only the engine takes prompt token ids
+        if not self.config.prompt_cache_dir or pipeline.engine is None:
+            return None
+
+        key = PromptCache.make_key(
+            self.config.dataset,
+            self.config.promter_name,
+            self.prompter.template_digest() if self.prompter is not None else "",
+            self.config.gene_num_limit,
+            self.config.pipeline.pipeline_class_name,
+            pipeline.tokenizer,
+        )
+        prompt_cache = PromptCache(self.config.prompt_cache_dir, key)
+        print(f"Prompt cache {prompt_cache.path} holds {len(prompt_cache)} prompts")
+        return prompt_cache
+
+    def prepare_dataloader(self, dataset: Subset, pipeline: PipelineBase, batch_size: int) -> DataLoader:
+        collate_fn = PromptCollator(
+            self.prepare_input,
+            pipeline.tokenize_messages if pipeline.engine is not None else None,
+            self.prompt_cache,
+        )
+        loader_kwargs = {"collate_fn": collate_fn, "num_workers": self.config.num_workers}
+        if self.config.num_workers > 0:
+            loader_kwargs["prefetch_factor"] = self.config.prefetch_factor
+        if not self.config.length_bucketing:
+            return DataLoader(
+                dataset,
+                batch_size=batch_size,
+                shuffle=False,
+                **loader_kwargs,
+            )
+
+        lengths = []
+        for i in range(len(dataset)):
+            sample = dataset[i]
+            input_ids = self.prompt_cache.get(sample["index"]) if self.prompt_cache is not None else None
+            if input_ids is None:
+                lengths.append(pipeline.count_prompt_tokens(self.prepare_input([sample])[0]))
+            else:
+                lengths.append(len(input_ids))
+        batch_sampler = LengthBucketBatchSampler(lengths, batch_size, self.config.num_length_buckets)
+
+        # compare against the padding the sequential batches would have needed
+        sequential_batches = [
+            list(range(i, min(i + batch_size, len(lengths)))) for i in range(0, len(lengths), batch_size)
+        ]
+        num_tokens, num_padded_tokens = padding_stats(batch_sampler.batches, lengths)
+        _, num_sequential_padded_tokens = padding_stats(sequential_batches, lengths)
+        pipeline.stats.set("sampler/prompt_tokens", num_tokens)
+        pipeline.stats.set("sampler/padded_prompt_tokens", num_padded_tokens)
+        pipeline.stats.set("sampler/sequential_padded_prompt_tokens", num_sequential_padded_tokens)
+        pipeline.stats.set("sampler/padding_ratio", 1 - num_tokens / max(num_padded_tokens, 1))
+        pipeline.stats.set("sampler/sequential_padding_ratio", 1 - num_tokens / max(num_sequential_padded_tokens, 1))
+
+        return DataLoader(
             dataset,
-            batch_size=self.config.pipeline.batch_size,
-            shuffle=False,
-            collate_fn=lambda x: x,
+            batch_sampler=batch_sampler,
+            **loader_kwargs,
         )
 
-        context = []
-        for batch in tqdm(dataloader):
-            x = self.prepare_input(batch)
-            responses = pipeline(x, self.config.generation)
+    def annotate_batch(self, pipeline: PipelineBase, prompt_batch: PromptBatch, writer: JSONLWriter):
+        batch, x = prompt_batch.samples, prompt_batch.messages
+        # the engine looks the prompts of this batch up instead of tokenizing them again
+        pipeline.prompt_ids.clear()
+        if prompt_batch.input_ids is not None:
+            pipeline.prompt_ids.update(zip(map(message_key, x), prompt_batch.input_ids))
 
-            if self.config.promter_name in {"zero_shot_cot", "zero_shot_cot_scact"}:
-                x = self.prepare_input(batch, responses)
-                post_responses = pipeline(x, self.config.generation)
-                pprint.pp([(r, pr) for r, pr in zip(responses, post_responses)], width=240)
+        rankings, cascades = None, None
+        if self.config.scoring:
+            responses, rankings = self.rank_candidates(pipeline, x)
+        elif self.config.cascade:
+            responses, cascades = self.run_cascade(batch, x)
+        elif self.config.promter_name in {"zero_shot_cot", "zero_shot_cot_scact"} and self.config.cot_continuation:
+            responses = self.continue_cot(pipeline, batch, x)
+        elif self.config.promter_name in {"zero_shot_cot", "zero_shot_cot_scact"}:
+            # only the answer after the trigger is constrained, the reasoning is free-form
+            responses = pipeline(x, self.reasoning_generation_config, seeds=self.sample_seeds(batch))
+            # every sampled reasoning is answered once
+            k = self.reasoning_generation_config.num_samples
+            reasonings = [[output] for outputs in responses for output in outputs]
+            x = self.prepare_input([sample for sample in batch for _ in range(k)], reasonings)
+            post_responses = pipeline(
+                x,
+                replace(self.answer_generation_config, num_samples=1),
+                seeds=expand_seeds(self.sample_seeds(batch, stage=1), k),
+                **self.answer_kwargs,
+            )
+            pprint.pp([(r, pr) for r, pr in zip(reasonings, post_responses)], width=240)
+
+            responses = [[outputs[0] for outputs in post_responses[i * k : (i + 1) * k]] for i in range(len(batch))]
+        else:
+            responses = pipeline(x, self.answer_generation_config, seeds=self.sample_seeds(batch), **self.answer_kwargs)
 
-                responses = post_responses
+        records = []
+        for i, response in enumerate(responses):
+            index = batch[i]["index"]
+            records.append(
+                {
+                    "index": index,
+                    "sample": batch[i],
+                    "messages": response,
+                }
+            )
+            if rankings is not None:
+                records[-1]["candidates"] = rankings[i]
+            if cascades is not None:
+                records[-1]["cascade"] = cascades[i]
+            pprint.pp(records[-1], width=240)
+        writer.write(records)
 
-            for i, response in enumerate(responses):
-                index = batch[i]["index"]
-                context.append(
+    def answer_from_reference(self, pipeline: PipelineBase, dataset: Subset, writer: JSONLWriter) -> Subset:
+        reference = ReferenceAtlas(self.config.reference)
+        start = time.perf_counter()
+        remaining_indices = []
+        for batch_start in range(0, len(dataset), self.config.reference.batch_size):
+            positions = range(batch_start, min(batch_start + self.config.reference.batch_size, len(dataset)))
+            batch = [dataset[i] for i in positions]
+            matches = reference.match([sample["genes"][: self.gene_limit_num] for sample in batch])
+            records = []
+            for position, sample, match in zip(positions, batch, matches):
+                if match is None:
+                    remaining_indices.append(dataset.indices[position])
+                    continue
+                # the same record layout as a model answer, so the analysis scripts are unchanged
+                message = self.prepare_input([sample])[0]
+                records.append(
                     {
-                        "index": index,
-                        "sample": batch[i],
-                        "messages": response,
+                        "index": sample["index"],
+                        "sample": sample,
+                        "messages": pipeline.to_response(message, match["cell_type"]),
+                        "reference": match,
                     }
                 )
-                pprint.pp(context[-1], width=240)
+            writer.write(records)
 
+        # a two-stage chain of thought calls the model twice per sample
+        calls_per_sample = (
+            2
+            if self.config.promter_name in {"zero_shot_cot", "zero_shot_cot_scact"} and not self.config.cot_continuation
+            else 1
+        )
+        answered = len(dataset) - len(remaining_indices)
+        pipeline.stats.set("reference/answered_samples", answered)
+        pipeline.stats.set("reference/saved_llm_calls", answered * calls_per_sample)
+        pipeline.stats.set("reference/seconds", time.perf_counter() - start)
+        print(
+            f"Answered {answered} of {len(dataset)} samples from {len(reference)} reference signatures, "
+            f"saving {answered * calls_per_sample} model calls"
+        )
+        return Subset(dataset.dataset, remaining_indices)
+
+    def prepare_pipeline(self, config: PipelineConfig, pipeline: Optional[PipelineBase] = None) -> PipelineBase:
+        if pipeline is None:
+            pipeline = pipeline_cls[config.pipeline_class_name](config)
+        if self.config.response_cache_path:
+            cache = ResponseCache(
+                self.config.response_cache_path,
+                max_bytes=int(self.config.response_cache_max_mb * 2**20),
+                stats=pipeline.stats,
+            )
+            pipeline = CachedPipeline(pipeline, cache)
+        if (
+            self.config.per_sample_seeding
+            and self.config.generation.do_sample
+            and pipeline.model is not None
+            and pipeline.engine is None
+            and config.batch_size > 1
+        ):
+            print(
+                f"Warning: {config.model_custom_id} samples seeded prompts one at a time instead of in batches of "
+                f"{config.batch_size}, set `engine` to 'continuous' to keep the batches"
+            )
+        return pipeline
+
+    def run(self, pipeline: Optional[PipelineBase] = None):
+        pipeline = self.prepare_pipeline(self.config.pipeline, pipeline)
+        dataset = self.prepare_dataset()
+        results_path = self.output_folder / f"{self.output_name}.jsonl"
+        if self.config.resume:
+            finished_indices = {record["index"] for record in read_jsonl(results_path)}
+            dataset = Subset(dataset.dataset, [i for i in dataset.indices if i not in finished_indices])
+            pipeline.stats.set("task/resumed_samples", len(finished_indices))
+            print(f"Resuming with {len(finished_indices)} finished samples, {len(dataset)} remaining")
+        writer = JSONLWriter(results_path, append=self.config.resume, fsync_every=self.config.fsync_every)
+        if self.config.reference.path:
+            dataset = self.answer_from_reference(pipeline, dataset, writer)
+
+        batch_size = self.config.pipeline.batch_size
+        if self.config.pipeline.engine == "continuous":
+            # the engine keeps `batch_size` sequences active and refills them from this larger queue
+            batch_size = max(batch_size, self.config.pipeline.engine_queue_size)
+        self.prompt_cache = self.prepare_prompt_cache(pipeline)
+        dataloader = self.prepare_dataloader(dataset, pipeline, batch_size)
+        if self.config.generation.num_samples > 1 and (self.config.scoring or not self.config.generation.do_sample):
+            raise ValueError("Several samples per prompt need sampling, set `generation.do_sample` and not `scoring`")
+        tier_pipelines = [tier.pipeline for tier in self.config.cascade if tier.pipeline is not None]
+        if self.config.promter_name == "few_shot" and any(
+            config.ontology_path for config in [self.config.pipeline, *tier_pipelines]
+        ):
+            raise ValueError(
+                "Few-shot prompts reason before answering, which ontology-constrained decoding would cut off; "
+                "use a zero-shot prompter or no `ontology_path`"
+            )
+        if self.config.scoring:
+            if self.config.promter_name in {"zero_shot_cot", "zero_shot_cot_scact"}:
+                raise ValueError("Candidates are scored right after the prompt, use a prompter without reasoning")
+            self.candidate_labels = self.prepare_candidate_labels(dataset)
+        if self.config.cascade:
+            self.prepare_cascade(pipeline)
+        if self.config.pipeline.prefix_caching and len(dataset) > 0:
+            pipeline.prepare_prefix_cache(self.prepare_input([dataset[i]])[0] for i in range(len(dataset)))
+
+        with writer.sync_on_sigterm():
+            wait_start = time.perf_counter()
+            for batch in tqdm(dataloader):
+                # time the generation loop spends waiting on prompts, rendered and tokenized by the workers meanwhile
+                pipeline.stats.add("dataloader/wait_seconds", time.perf_counter() - wait_start)
+                pipeline.stats.add("dataloader/collate_seconds", batch.seconds)
+                pipeline.stats.add("dataloader/cached_prompts", batch.num_cached_prompts)
+                if self.prompt_cache is not None and batch.input_ids is not None:
+                    for sample, input_ids in zip(batch.samples, batch.input_ids):
+                        self.prompt_cache.put(sample["index"], input_ids)
+
+                self.annotate_batch(pipeline, batch, writer)
+                wait_start = time.perf_counter()
+        writer.close()
+        if self.prompt_cache is not None:
+            self.prompt_cache.save()
+
+        # shards are assembled into the single JSON file by `merge_shards`
+        if self.config.shard_index < 0:
+            self.write_results(read_jsonl(results_path))
+
+        stats = pipeline.stats.summary()
+        pprint.pp(stats, width=240)
+        with open(self.output_folder / f"{self.output_name}_stats.json", "w") as f:
+            json.dump(stats, f, indent=4)
+        if self.config.cascade:
+            self.write_cascade_report()
+
+    def write_results(self, records: list[dict[str, Any]]):
+        # the single JSON file read by the analysis scripts, in index order as batches may be formed out of order,
+        # e.g. by length bucketing
+        context = sorted(records, key=lambda x: x["index"])
         with open(self.output_folder / f"{self.config.pipeline.model_custom_id}.json", "w") as f:
             json.dump(context, f, indent=4)
+        if isinstance(self.config.dataset, H5ADCellDatasetConfig):
+            self.write_cell_answers(context)
+
+    def write_cell_answers(self, records: list[dict[str, Any]]):
+        # every cell gets the answer of its gene signature
+        dataset = H5ADCellDataset(self.config.dataset)
+        answers = {record["index"]: record["messages"][0]["generated_text"][-1]["content"] for record in records}
+        cells = dataset.fan_out(answers)
+        cells.to_csv(self.output_folder / f"{self.config.pipeline.model_custom_id}_cells.csv", index=False)
+        print(f"Fanned {len(answers)} answers out to {len(cells)} cells")
+
+    def merge_shards(self):
+        records = []
+        for shard_index in range(self.config.num_shards):
+            shard_path = self.output_folder / f"{self.shard_name(shard_index)}.jsonl"
+            if not shard_path.exists():
+                raise FileNotFoundError(f"Missing output of shard {shard_index}: {shard_path}")
+            records.extend(read_jsonl(shard_path))
+
+        num_samples = len(self.prepare_dataset())
+        if len(records) != num_samples:
+            raise ValueError(f"Shards hold {len(records)} results for {num_samples} samples")
+        self.write_results(records)
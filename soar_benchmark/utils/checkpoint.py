@@ -0,0 +1,79 @@
+import os
+import sys
+import json
+import signal
+import threading
+
+from pathlib import Path
+from typing import Any
+from contextlib import contextmanager
+
+
+def read_jsonl(path: Path) -> list[dict[str, Any]]:
+    """Read the records of a JSONL file, cutting off a trailing line left incomplete by an interrupted write.
+
+    A record only counts once its newline is written: a run killed between the JSON and the newline would otherwise
+    have its next record appended onto the same line when resumed.
+    """
+    if not path.exists():
+        return []
+
+    records, valid_bytes = [], 0
+    with open(path, "rb") as f:
+        for line in f:
+            if not line.endswith(b"\n"):
+                break
+            try:
+                records.append(json.loads(line))
+            except json.JSONDecodeError:
+                break
+            valid_bytes += len(line)
+
+    if valid_bytes < path.stat().st_size:
+        with open(path, "r+b") as f:
+            f.truncate(valid_bytes)
+    return records
+
+
+class JSONLWriter:
+    """Append records to a JSONL file, flushing after every write and fsyncing every ``fsync_every`` writes."""
+
+    def __init__(self, path: Path, append: bool = False, fsync_every: int = 1):
+        self.file = open(path, "a" if append else "w")
+        self.fsync_every = max(1, fsync_every)
+        self.num_writes = 0
+
+    def write(self, records: list[dict[str, Any]]):
+        for record in records:
+            self.file.write(json.dumps(record) + "\n")
+        self.file.flush()
+
+        self.num_writes += 1
+        if self.num_writes % self.fsync_every == 0:
+            os.fsync(self.file.fileno())
+
+    def sync(self):
+        if not self.file.closed:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+
+    def close(self):
+        self.sync()
+        self.file.close()
+
+    @contextmanager
+    def sync_on_sigterm(self):
+        """Sync written records to disk before exiting on SIGTERM, e.g. when a slurm job is preempted."""
+        if threading.current_thread() is not threading.main_thread():
+            yield
+            return
+
+        def handler(signum, frame):
+            self.sync()
+            sys.exit(128 + signum)
+
+        previous_handler = signal.signal(signal.SIGTERM, handler)
+        try:
+            yield
+        finally:
+            signal.signal(signal.SIGTERM, previous_handler)
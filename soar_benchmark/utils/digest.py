@@ -0,0 +1,12 @@
+import hashlib
+
+from pathlib import Path
+
+
+def file_digest(path: str) -> str:
+    # large files, e.g. H5AD atlases, are identified by their size and modification time instead of their content
+    stat = Path(path).stat()
+    if stat.st_size > 256 * 2**20:
+        return f"{stat.st_size}-{stat.st_mtime_ns}"
+    with open(path, "rb") as f:
+        return hashlib.file_digest(f, "sha256").hexdigest()
@@ -0,0 +1,43 @@
+import time
+
+from collections import defaultdict
+from contextlib import contextmanager
+
+
+class RunStats:
+    """Named counters and timers collected over one annotation run.
+
+    Counters are plain floats keyed by ``"<component>/<name>"``. Rates registered with ``derive`` are computed
+    from two counters when the summary is requested.
+    """
+
+    def __init__(self):
+        self.counters: dict[str, float] = defaultdict(float)
+        self.derived: dict[str, tuple[str, str]] = {}
+
+    def add(self, name: str, value: float = 1.0):
+        self.counters[name] += value
+
+    def set(self, name: str, value: float):
+        self.counters[name] = value
+
+    def get(self, name: str, default: float = 0.0) -> float:
+        return self.counters.get(name, default)
+
+    @contextmanager
+    def timer(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.counters[name] += time.perf_counter() - start
+
+    def derive(self, name: str, numerator: str, denominator: str):
+        self.derived[name] = (numerator, denominator)
+
+    def summary(self) -> dict[str, float]:
+        summary = dict(self.counters)
+        for name, (numerator, denominator) in self.derived.items():
+            if numerator in self.counters and self.counters.get(denominator):
+                summary[name] = self.counters[numerator] / self.counters[denominator]
+        return summary
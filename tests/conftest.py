@@ -0,0 +1,64 @@
+import torch
+import pytest
+
+from tokenizers import Tokenizer, decoders, models, pre_tokenizers, trainers
+from transformers import LlamaConfig, LlamaForCausalLM, PreTrainedTokenizerFast
+
+CHAT_TEMPLATE = (
+    "{% for m in messages %}<s>{{ m['role'] }}\n{{ m['content'] }}</s>\n{% endfor %}"
+    "{% if add_generation_prompt %}<s>assistant\n{% endif %}"
+)
+
+
+def make_tiny_lm(seed: int, num_hidden_layers: int = 2, vocab_size: int = 128) -> LlamaForCausalLM:
+    # a randomly initialized Llama small enough to decode on a CPU in milliseconds; the default initialization is so
+    # small that the next token barely depends on the context, larger weights make greedy outputs sensitive to
+    # misplaced positions and cache entries
+    torch.manual_seed(seed)
+    config = LlamaConfig(
+        vocab_size=vocab_size,
+        hidden_size=32,
+        intermediate_size=64,
+        num_hidden_layers=num_hidden_layers,
+        num_attention_heads=4,
+        num_key_value_heads=2,
+        max_position_embeddings=256,
+        bos_token_id=1,
+        eos_token_id=2,
+        pad_token_id=0,
+        initializer_range=0.3,
+    )
+    return LlamaForCausalLM(config).eval()
+
+
+@pytest.fixture(scope="session")
+def tiny_lm() -> LlamaForCausalLM:
+    return make_tiny_lm(seed=0)
+
+
+@pytest.fixture(scope="session")
+def tiny_draft_lm() -> LlamaForCausalLM:
+    return make_tiny_lm(seed=1, num_hidden_layers=1)
+
+
+@pytest.fixture(scope="session")
+def tiny_model_path(tmp_path_factory) -> str:
+    """A byte-level BPE tokenizer with a chat template and a random Llama, saved like a hub checkpoint."""
+    tokenizer = Tokenizer(models.BPE(unk_token="<unk>"))
+    tokenizer.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+    tokenizer.decoder = decoders.ByteLevel()
+    trainer = trainers.BpeTrainer(
+        vocab_size=300,
+        special_tokens=["<pad>", "<s>", "</s>", "<unk>"],
+        initial_alphabet=pre_tokenizers.ByteLevel.alphabet(),
+    )
+    tokenizer.train_from_iterator(["the most likely cell type is T cell, B cell or monocyte"] * 10, trainer)
+    tokenizer = PreTrainedTokenizerFast(
+        tokenizer_object=tokenizer, bos_token="<s>", eos_token="</s>", unk_token="<unk>", pad_token="<pad>"
+    )
+    tokenizer.chat_template = CHAT_TEMPLATE
+
+    path = tmp_path_factory.mktemp("tiny_model")
+    tokenizer.save_pretrained(path)
+    make_tiny_lm(seed=0, vocab_size=len(tokenizer)).save_pretrained(path)
+    return str(path)
@@ -0,0 +1,146 @@
+import itertools
+import threading
+
+from soar_benchmark import cache as cache_module
+from soar_benchmark.cache import CachedPipeline, PromptCache, ResponseCache
+from soar_benchmark.pipeline import GenerationConfig, PipelineConfig
+from soar_benchmark.utils.stats import RunStats
+
+
+class EchoPipeline:
+    """Answers every message with its content and records the batches it was called with."""
+
+    def __init__(self):
+        self.config = PipelineConfig(model_custom_id="echo", model_name="echo")
+        self.stats = RunStats()
+        self.calls = []
+
+    def __call__(self, messages, generation_config, seeds=None, **kwargs):
+        self.calls.append(([message[0]["content"] for message in messages], seeds))
+        return [message[0]["content"] for message in messages]
+
+
+def make_messages(contents: list[str]) -> list[list[dict[str, str]]]:
+    return [[{"role": "user", "content": content}] for content in contents]
+
+
+def tick_clock(monkeypatch):
+    # strictly increasing access times, so the eviction order does not depend on the clock resolution
+    clock = itertools.count()
+    monkeypatch.setattr(cache_module.time, "time", lambda: float(next(clock)))
+
+
+def test_response_cache_evicts_least_recently_used(tmp_path, monkeypatch):
+    tick_clock(monkeypatch)
+    # every value is stored as a 3 byte JSON string, so 3 entries fit
+    cache = ResponseCache(str(tmp_path / "responses.sqlite"), max_bytes=9)
+    cache.put_many({"a": "1"})
+    cache.put_many({"b": "2"})
+    cache.put_many({"c": "3"})
+    assert cache.get_many(["a", "b", "c"]) == {"a": "1", "b": "2", "c": "3"}
+
+    # reading "a" makes "b" the least recently used entry
+    cache.get_many(["a"])
+    cache.get_many(["c"])
+    cache.put_many({"d": "4"})
+    assert cache.get_many(["a", "b", "c", "d"]) == {"a": "1", "c": "3", "d": "4"}
+    assert cache.stats.get("cache/evictions") == 1
+
+    # the lookup above refreshed every remaining entry in one go, "e" evicts the oldest of them until 3 fit again
+    cache.get_many(["d"])
+    cache.put_many({"e": "5", "f": "6"})
+    assert set(cache.get_many(["a", "c", "d", "e", "f"])) == {"d", "e", "f"}
+    assert cache.stats.get("cache/evictions") == 3
+
+
+def test_cached_pipeline_sends_only_misses_in_order(tmp_path):
+    pipeline = EchoPipeline()
+    cached = CachedPipeline(pipeline, ResponseCache(str(tmp_path / "responses.sqlite"), max_bytes=2**20))
+    generation_config = GenerationConfig(do_sample=False)
+
+    assert cached(make_messages(["b", "d"]), generation_config) == ["b", "d"]
+    assert cached(make_messages(["a", "b", "c", "d", "e"]), generation_config) == ["a", "b", "c", "d", "e"]
+    assert pipeline.calls == [(["b", "d"], None), (["a", "c", "e"], None)]
+
+    # the seeds of the misses follow their messages
+    assert cached(make_messages(["f", "a", "g"]), generation_config, seeds=[5, 6, 7]) == ["f", "a", "g"]
+    assert pipeline.calls[-1] == (["f", "g"], [5, 7])
+    assert pipeline.stats.summary()["cache/hit_rate"] == 3 / 10
+
+
+def test_cached_pipeline_key_depends_on_seed_only_when_sampling(tmp_path):
+    cached = CachedPipeline(EchoPipeline(), ResponseCache(str(tmp_path / "responses.sqlite"), max_bytes=2**20))
+    message = make_messages(["a"])[0]
+
+    greedy = GenerationConfig(do_sample=False)
+    assert cached.get_key(message, greedy, seed=1) == cached.get_key(message, greedy, seed=2)
+    assert cached.get_key(message, greedy) == cached.get_key(message, greedy, seed=1)
+
+    sampled = GenerationConfig(do_sample=True)
+    assert cached.get_key(message, sampled, seed=1) != cached.get_key(message, sampled, seed=2)
+    assert cached.get_key(message, sampled, seed=1) != cached.get_key(message, greedy, seed=1)
+
+
+def test_cached_pipeline_key_depends_on_model_and_tokenizer_kwargs(tmp_path):
+    pipeline = EchoPipeline()
+    cached = CachedPipeline(pipeline, ResponseCache(str(tmp_path / "responses.sqlite"), max_bytes=2**20))
+    message, greedy = make_messages(["a"])[0], GenerationConfig(do_sample=False)
+
+    key = cached.get_key(message, greedy)
+    pipeline.config.model_kwargs = {"attn_implementation": "sdpa"}
+    assert cached.get_key(message, greedy) != key
+    key = cached.get_key(message, greedy)
+    pipeline.config.tokenizer_kwargs = {"chat_template": "{{ messages }}"}
+    assert cached.get_key(message, greedy) != key
+
+
+def test_cached_pipeline_bypasses_unseeded_sampling(tmp_path):
+    pipeline = EchoPipeline()
+    cached = CachedPipeline(pipeline, ResponseCache(str(tmp_path / "responses.sqlite"), max_bytes=2**20))
+    sampled = GenerationConfig(do_sample=True)
+
+    # repeated prompts are sampled again, on every call
+    for _ in range(2):
+        assert cached(make_messages(["a", "a"]), sampled) == ["a", "a"]
+    assert pipeline.calls == [(["a", "a"], None)] * 2
+    assert pipeline.stats.get("cache/bypassed") == 4
+    assert pipeline.stats.get("cache/lookups") == 0
+
+    # seeded samples are cached
+    cached(make_messages(["a", "a"]), sampled, seeds=[1, 2])
+    cached(make_messages(["a", "a"]), sampled, seeds=[1, 2])
+    assert pipeline.calls[2:] == [(["a", "a"], [1, 2])]
+
+
+def test_prompt_cache_merges_concurrent_saves(tmp_path):
+    # every cache opens the file before any other saved, like the shards of one run
+    caches = [PromptCache(str(tmp_path), "key") for _ in range(8)]
+
+    def fill(shard: int, cache: PromptCache):
+        for index in range(shard, 400, len(caches)):
+            cache.put(index, [index] * (index % 7 + 1))
+            if index % 50 == shard:
+                cache.save()
+        cache.save()
+
+    threads = [threading.Thread(target=fill, args=(shard, cache)) for shard, cache in enumerate(caches)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    cache = PromptCache(str(tmp_path), "key")
+    assert len(cache) == 400
+    assert all(cache.get(index) == [index] * (index % 7 + 1) for index in range(400))
+
+
+def test_prompt_cache_keeps_loaded_prompts(tmp_path):
+    cache = PromptCache(str(tmp_path), "key")
+    cache.put(0, [1, 2, 3])
+    cache.save()
+
+    reopened = PromptCache(str(tmp_path), "key")
+    reopened.put(1, [4])
+    reopened.save()
+    assert reopened.get(0) == [1, 2, 3]
+    assert PromptCache(str(tmp_path), "key").get(1) == [4]
@@ -0,0 +1,57 @@
+import pytest
+
+from test_task import make_config, write_json_dataset
+
+from soar_benchmark.dataset import JSONDatasetConfig
+from soar_benchmark.pipeline import CellTypeAnnotationPipeline, PipelineConfig
+from soar_benchmark.task import CellTypeAnnotationTask
+
+
+@pytest.fixture(scope="module")
+def engine_pipeline(tiny_model_path):
+    config = PipelineConfig(
+        model_custom_id="tiny",
+        model_name=tiny_model_path,
+        torch_dtype="float32",
+        device_map="cpu",
+        tokenizer_kwargs={"padding_side": "left"},
+        engine="continuous",
+    )
+    return CellTypeAnnotationPipeline(config)
+
+
+@pytest.mark.parametrize("num_workers", [0, 2])
+@pytest.mark.parametrize("length_bucketing", [False, True])
+def test_collated_batches_match_unbatched_prompts(tmp_path, engine_pipeline, num_workers, length_bucketing):
+    labels = ["T cell", "B cell", "monocyte", "NK cell", "T cell", "B cell", "platelet"]
+    json_path = write_json_dataset(tmp_path / "data.json", labels)
+    task = CellTypeAnnotationTask(
+        make_config(
+            tmp_path,
+            promter_name="zero_shot",
+            dataset=JSONDatasetConfig(json_path=json_path),
+            pipeline=engine_pipeline.config,
+            num_workers=num_workers,
+            length_bucketing=length_bucketing,
+            num_length_buckets=2,
+            prompt_cache_dir=str(tmp_path / "prompts"),
+        )
+    )
+    dataset = task.prepare_dataset()
+
+    # the first pass tokenizes every prompt, the second reads them from the prompt cache
+    for num_cached_prompts in [0, len(labels)]:
+        task.prompt_cache = task.prepare_prompt_cache(engine_pipeline)
+        indices, cached = [], 0
+        for batch in task.prepare_dataloader(dataset, engine_pipeline, batch_size=3):
+            cached += batch.num_cached_prompts
+            for sample, message, input_ids in zip(batch.samples, batch.messages, batch.input_ids):
+                expected_sample = dataset[sample["index"]]
+                assert sample == expected_sample
+                assert message == task.prepare_input([expected_sample])[0]
+                assert input_ids == engine_pipeline.tokenize_messages(message)
+                task.prompt_cache.put(sample["index"], input_ids)
+                indices.append(sample["index"])
+        task.prompt_cache.save()
+        assert sorted(indices) == list(range(len(labels)))
+        assert cached == num_cached_prompts
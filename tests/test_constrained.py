@@ -0,0 +1,81 @@
+import os
+import pytest
+
+from transformers import AutoTokenizer
+
+from soar_benchmark.bioontology.trie import LabelTrie
+from soar_benchmark.engine import ContinuousBatchingEngine
+from soar_benchmark.pipeline import CellTypeAnnotationPipeline, GenerationConfig, PipelineConfig
+
+from test_engine import PAD_TOKEN_ID, make_prompts
+
+EOS_TOKEN_ID = 2
+# [10, 11] is a label and the prefix of [10, 11, 12], and the labels starting with 10 branch into 11 and 13
+LABELS = [[10, 11], [10, 11, 12], [10, 13, 14], [20], [20, 21, 22, 23], [30, 31, 32]]
+
+
+def test_trie_branches_at_shared_prefixes():
+    trie = LabelTrie(LABELS, [EOS_TOKEN_ID])
+    assert sorted(trie.allowed_tokens(0)) == [10, 20, 30]
+    node = trie.next(0, 10)
+    assert sorted(trie.allowed_tokens(node)) == [11, 13]
+    # a label extended by a longer one may be ended by the terminator or continued
+    node = trie.next(node, 11)
+    assert sorted(trie.allowed_tokens(node)) == [EOS_TOKEN_ID, 12]
+    assert not trie.is_complete(node)
+    assert trie.is_complete(trie.next(node, 12))
+
+
+def test_trie_is_cached_through_a_temporary_file(tiny_model_path, tmp_path):
+    tokenizer = AutoTokenizer.from_pretrained(tiny_model_path)
+    labels = ["T cell", "B cell", "monocyte"]
+    trie = LabelTrie.from_labels(labels, tokenizer, [EOS_TOKEN_ID], str(tmp_path))
+    # only the finished pickle is left in the cache, and a later run reads it back
+    (cache_name,) = os.listdir(tmp_path)
+    assert cache_name.startswith("label_trie_") and cache_name.endswith(".pkl")
+    cached = LabelTrie.from_labels(labels, tokenizer, [EOS_TOKEN_ID], str(tmp_path))
+    assert cached.children == trie.children
+
+
+@pytest.mark.parametrize("do_sample", [False, True])
+def test_constrained_outputs_are_labels(tiny_lm, do_sample):
+    prompts = make_prompts(16, seed=8) * (4 if do_sample else 1)
+    generation_config = GenerationConfig(max_new_tokens=8, do_sample=do_sample, temperature=2.0, top_p=1.0)
+    engine = ContinuousBatchingEngine(tiny_lm, 8, [EOS_TOKEN_ID], pad_token_id=PAD_TOKEN_ID)
+    trie = LabelTrie(LABELS, [EOS_TOKEN_ID])
+    requests = engine.generate(
+        prompts, generation_config, seeds=list(range(len(prompts))) if do_sample else None, trie=trie
+    )
+
+    outputs = [request.output_ids for request in requests]
+    assert all(output_ids in LABELS for output_ids in outputs)
+    if do_sample:
+        # sampling reaches several branches below the shared prefixes
+        assert len({tuple(output_ids) for output_ids in outputs if output_ids[0] == 10}) > 1
+        assert len({tuple(output_ids) for output_ids in outputs}) > 3
+
+
+def test_constrained_pipeline_answers_are_ontology_labels(tiny_model_path, tmp_path):
+    labels = ["T cell", "T cell, alpha-beta", "T helper cell", "B cell", "monocyte", "natural killer cell"]
+    ontology_path = tmp_path / "labels.txt"
+    ontology_path.write_text("\n".join(labels))
+    config = PipelineConfig(
+        model_custom_id="tiny",
+        model_name=tiny_model_path,
+        torch_dtype="float32",
+        device_map="cpu",
+        tokenizer_kwargs={"padding_side": "left"},
+        engine="continuous",
+        ontology_path=str(ontology_path),
+        ontology_cache_dir=str(tmp_path / "cache"),
+    )
+    pipeline = CellTypeAnnotationPipeline(config)
+    messages = [[{"role": "user", "content": f"Which cell type expresses marker {i}?"}] for i in range(8)]
+    generated = pipeline(
+        messages,
+        GenerationConfig(max_new_tokens=16, do_sample=True, num_samples=4),
+        seeds=list(range(8)),
+        constrained=True,
+    )
+    answers = [output["generated_text"][-1]["content"].strip() for outputs in generated for output in outputs]
+    assert all(answer in labels for answer in answers)
@@ -0,0 +1,255 @@
+import os
+import sys
+import json
+import anndata
+import pytest
+import numpy as np
+import scanpy as sc
+import pandas as pd
+import scipy.sparse as sp
+
+from soar_benchmark.dataset import (
+    ColumnarDataset,
+    ColumnarDatasetConfig,
+    H5ADCellDataset,
+    H5ADCellDatasetConfig,
+    H5ADDataset,
+    H5ADDatasetConfig,
+    JSONDataset,
+    JSONDatasetConfig,
+    read_chunks,
+    top_expressed_genes,
+)
+
+# no row has a tissue and some rows have no annotation or broadtype
+ROWS = [
+    {
+        "subset": "ds1",
+        "tissue": None,
+        "gene list": "CD3E, CD3D,CD2",
+        "annotation": "T cell",
+        "cl_name": "T cell",
+        "cl_id": "CL:0000084",
+        "broadtype": "lymphocyte",
+    },
+    {
+        "subset": "ds1",
+        "tissue": None,
+        "gene list": "MS4A1",
+        "annotation": None,
+        "cl_name": "",
+        "cl_id": "",
+        "broadtype": None,
+    },
+    {
+        "subset": "ds2",
+        "tissue": None,
+        "gene list": "CD14, LYZ, CD3E",
+        "annotation": "monocyte",
+        "cl_name": "monocyte",
+        "cl_id": "CL:0000576",
+        "broadtype": "myeloid",
+    },
+] * 3
+
+
+def write_cells(path, X, labels):
+    adata = anndata.AnnData(
+        X=sp.csr_matrix(np.array(X, dtype=np.float32)),
+        obs=pd.DataFrame({"label": pd.Categorical(labels)}, index=[f"cell{i}" for i in range(len(X))]),
+        var=pd.DataFrame(index=[f"GENE{j}" for j in range(len(X[0]))]),
+    )
+    adata.write_h5ad(path)
+
+
+def test_cells_without_expressed_genes_are_skipped(tmp_path):
+    path = tmp_path / "cells.h5ad"
+    X = [
+        [3, 2, 0, 0],
+        [0, 0, 0, 0],
+        [5, 1, 0, 0],
+        [0, 0, 0, 0],
+        [0, 0, 4, 1],
+    ]
+    write_cells(path, X, ["B cell", "T cell", "B cell", "T cell", None])
+    config = H5ADCellDatasetConfig(h5ad_path=str(path), gene_num=2, label_key="label", chunk_size=2)
+
+    for _ in range(2):  # built, then read from the sidecar
+        dataset = H5ADCellDataset(config)
+        assert len(dataset) == 2
+        assert [dataset[i]["genes"] for i in range(2)] == [["GENE0", "GENE1"], ["GENE2", "GENE3"]]
+        # the empty cells are labeled T cell but never weigh on the labels, and the last signature has no label
+        assert [dataset[i]["label"] for i in range(2)] == ["B cell", ""]
+
+        cells = dataset.fan_out({0: "B cell", 1: "NK cell"})
+        assert cells["signature"].tolist() == [0, -1, 0, -1, 1]
+        assert cells["answer"].tolist() == ["B cell", None, "B cell", None, "NK cell"]
+    # the sidecar was written through a temporary file that is gone
+    assert sorted(os.listdir(tmp_path)) == ["cells.h5ad", "cells.h5ad.top2.cells.npz"]
+
+
+@pytest.mark.parametrize("suffix", [".json", ".jsonl", ".parquet"])
+@pytest.mark.parametrize("cached", [False, True])
+def test_columnar_dataset_matches_json_dataset(tmp_path, suffix, cached):
+    with open(tmp_path / "rows.json", "w") as f:
+        json.dump(ROWS, f)
+    path = tmp_path / f"rows{suffix}"
+    if suffix == ".jsonl":
+        path.write_text("".join(json.dumps(row) + "\n" for row in ROWS))
+    elif suffix == ".parquet":
+        pytest.importorskip("pyarrow")
+        pd.DataFrame(ROWS).to_parquet(path)
+
+    reference = JSONDataset(JSONDatasetConfig(json_path=str(tmp_path / "rows.json")))
+    config = ColumnarDatasetConfig(path=str(path), cache_dir=str(tmp_path / "cache") if cached else "", chunk_size=2)
+    for _ in range(2 if cached else 1):  # parsed into the cache, then memory-mapped
+        dataset = ColumnarDataset(config)
+        assert len(dataset) == len(reference)
+        for index in [*range(len(reference)), np.int64(4)]:
+            assert_same_values(dataset[index], reference[index])
+        assert_same_values(dataset.get_labels(), reference.get_labels())
+
+
+def test_parquet_without_pyarrow_names_the_extra(tmp_path, monkeypatch):
+    monkeypatch.setitem(sys.modules, "pyarrow.parquet", None)
+    with pytest.raises(ImportError, match=r"soar_benchmark\[parquet\]"):
+        next(read_chunks(str(tmp_path / "rows.parquet"), ["annotation"], 2))
+
+
+def test_columnar_dataset_removes_its_partial_cache(tmp_path, monkeypatch):
+    path = tmp_path / "rows.json"
+    with open(path, "w") as f:
+        json.dump(ROWS, f)
+
+    def fail(self, directory):
+        (directory / "labels.bin").write_bytes(b"partial")
+        raise OSError("No space left on device")
+
+    config = ColumnarDatasetConfig(path=str(path), cache_dir=str(tmp_path / "cache"))
+    with monkeypatch.context() as m:
+        m.setattr(ColumnarDataset, "parse", fail)
+        with pytest.raises(OSError, match="No space left"):
+            ColumnarDataset(config)
+    assert os.listdir(tmp_path / "cache") == []
+
+    ColumnarDataset(config)
+    assert [name.startswith("columnar_") and ".tmp" not in name for name in os.listdir(tmp_path / "cache")] == [True]
+
+
+def assert_same_values(values, reference):
+    # NaN is never equal to itself, so values are compared with their types
+    if isinstance(reference, (dict, list)):
+        assert type(values) is type(reference) and len(values) == len(reference)
+        keys = reference.keys() if isinstance(reference, dict) else range(len(reference))
+        for key in keys:
+            assert_same_values(values[key], reference[key])
+    else:
+        assert type(values) is type(reference)
+        assert values == reference or (pd.isna(values) and pd.isna(reference))
+
+
+def test_json_dataset_missing_values(tmp_path):
+    # missing values are read as pandas reads them, they are rendered into prompts and written to the results
+    with open(tmp_path / "rows.json", "w") as f:
+        json.dump(ROWS, f)
+    dataset = JSONDataset(JSONDatasetConfig(json_path=str(tmp_path / "rows.json")))
+    assert type(dataset[0]["tissue"]) is np.float64 and np.isnan(dataset[0]["tissue"])
+    assert dataset[1]["label"] is None and dataset[1]["broadtype"] is None
+
+
+def write_ranked_genes(path, num_groups: int = 4, num_genes: int = 30, seed: int = 0):
+    rng = np.random.default_rng(seed)
+    adata = anndata.AnnData(
+        X=rng.poisson(1.0, (80, num_genes)).astype(np.float32),
+        obs=pd.DataFrame(
+            {"cell_type": pd.Categorical([f"type {i % num_groups}" for i in range(80)])},
+            index=[f"cell{i}" for i in range(80)],
+        ),
+        var=pd.DataFrame(index=[f"GENE{j}" for j in range(num_genes)]),
+    )
+    sc.tl.rank_genes_groups(adata, "cell_type", method="t-test", key_added="gene_list")
+    adata.write_h5ad(path)
+
+
+def reference_samples(path, gene_num: int) -> list[tuple[str, list[str]]]:
+    # the samples as read from the whole AnnData object
+    names = sc.read_h5ad(path).uns["gene_list"]["names"]
+    return [(cell_type, [str(gene) for gene in names[cell_type][:gene_num]]) for cell_type in names.dtype.names]
+
+
+def labeled_genes(dataset) -> list[tuple[str, list[str]]]:
+    return [(dataset[i]["label"], dataset[i]["genes"]) for i in range(len(dataset))]
+
+
+def test_h5ad_dataset_matches_full_read_with_and_without_sidecar(tmp_path):
+    path = tmp_path / "ranked.h5ad"
+    write_ranked_genes(path)
+    expected = reference_samples(path, gene_num=5)
+
+    sidecar = tmp_path / "cache" / "ranked.h5ad.gene_list.npz"
+    configs = [
+        H5ADDatasetConfig(h5ad_path=str(path), gene_num=5, use_gene_list_cache=False),
+        # the first run writes the sidecar, the second reads it
+        H5ADDatasetConfig(h5ad_path=str(path), gene_num=5, gene_list_cache_dir=str(tmp_path / "cache")),
+        H5ADDatasetConfig(h5ad_path=str(path), gene_num=5, gene_list_cache_dir=str(tmp_path / "cache")),
+    ]
+    for config in configs:
+        dataset = H5ADDataset(config)
+        assert labeled_genes(dataset) == expected
+        assert dataset.get_labels() == [cell_type for cell_type, _ in expected]
+    # the sidecar was written through a temporary file that is gone
+    assert os.listdir(tmp_path / "cache") == [sidecar.name]
+
+    # a rewritten file is read again instead of served from the stale sidecar
+    write_ranked_genes(path, num_groups=3, seed=1)
+    dataset = H5ADDataset(configs[-1])
+    assert labeled_genes(dataset) == reference_samples(path, gene_num=5)
+
+
+def reference_top_genes(X: np.ndarray, n: int) -> np.ndarray:
+    # the positive values of every row sorted by value, ties by column, padded with -1
+    top = np.full((X.shape[0], n), -1, dtype=np.int32)
+    for row, values in enumerate(X):
+        columns = sorted(np.flatnonzero(values > 0), key=lambda j: (-values[j], j))[:n]
+        top[row, : len(columns)] = columns
+    return top
+
+
+@pytest.mark.parametrize("n", [1, 3, 8])
+@pytest.mark.parametrize("max_block_size", [8, 2**24])
+def test_top_expressed_genes_matches_dense_sort(n, max_block_size):
+    rng = np.random.default_rng(n)
+    # small integer values give many ties, some negative values are never selected
+    X = rng.integers(-1, 4, size=(40, 12)).astype(np.float32) * (rng.random((40, 12)) < 0.5)
+    X[3] = 0  # a cell without expressed genes
+    X[7] = -1  # a cell with only negative values
+    X[11, :2] = 2  # a cell with fewer expressed genes than n
+    X[11, 2:] = 0
+    top = top_expressed_genes(sp.csr_matrix(X), n, max_block_size=max_block_size)
+    np.testing.assert_array_equal(top, reference_top_genes(X, n))
+    assert (top[3] == -1).all() and (top[7] == -1).all()
+
+
+def test_cell_signatures_match_dense_top_genes(tmp_path):
+    rng = np.random.default_rng(0)
+    X = rng.integers(0, 3, size=(60, 10)) * (rng.random((60, 10)) < 0.6)
+    X[[5, 17]] = 0
+    path = tmp_path / "cells.h5ad"
+    write_cells(path, X, ["T cell"] * 60)
+    expected = reference_top_genes(X.astype(np.float32), 3)
+
+    for unordered in [False, True]:
+        config = H5ADCellDatasetConfig(h5ad_path=str(path), gene_num=3, unordered_signatures=unordered, chunk_size=7)
+        dataset = H5ADCellDataset(config)
+        for cell, signature in enumerate(dataset.cell_signatures.tolist()):
+            genes = [f"GENE{j}" for j in expected[cell] if j >= 0]
+            if not genes:
+                assert signature == -1
+            elif unordered:
+                assert set(dataset[signature]["genes"]) == set(genes)
+            else:
+                assert dataset[signature]["genes"] == genes
+        # every signature is a distinct sample
+        samples = [dataset[i]["genes"] for i in range(len(dataset))]
+        keys = [frozenset(genes) for genes in samples] if unordered else [tuple(genes) for genes in samples]
+        assert len(set(keys)) == len(samples)
@@ -0,0 +1,229 @@
+import copy
+import torch
+import pytest
+
+from transformers import MinPLogitsWarper, TypicalLogitsWarper
+from soar_benchmark.engine import ContinuousBatchingEngine, GenerationRequest
+from soar_benchmark.pipeline import GenerationConfig
+
+PAD_TOKEN_ID = 0
+
+
+def make_prompts(num_prompts: int, seed: int = 0) -> list[list[int]]:
+    generator = torch.Generator().manual_seed(seed)
+    lengths = torch.randint(3, 24, (num_prompts,), generator=generator).tolist()
+    return [torch.randint(4, 128, (length,), generator=generator).tolist() for length in lengths]
+
+
+def reference_generate(model, input_ids: list[int], max_new_tokens: int, eos_token_id: int) -> list[int]:
+    """Greedy tokens of `model.generate` for one unpadded prompt, without the terminator."""
+    with torch.inference_mode():
+        outputs = model.generate(
+            torch.tensor([input_ids]),
+            attention_mask=torch.ones((1, len(input_ids)), dtype=torch.long),
+            max_new_tokens=max_new_tokens,
+            do_sample=False,
+            eos_token_id=eos_token_id,
+            pad_token_id=PAD_TOKEN_ID,
+        )
+    output_ids = outputs[0, len(input_ids) :].tolist()
+    return output_ids[: output_ids.index(eos_token_id)] if eos_token_id in output_ids else output_ids
+
+
+def frequent_token(model, prompts: list[list[int]], max_new_tokens: int) -> int:
+    # a token greedy decoding emits for some prompts, used as terminator so those sequences end early
+    counts = torch.zeros(model.config.vocab_size, dtype=torch.long)
+    for input_ids in prompts:
+        counts[reference_generate(model, input_ids, max_new_tokens, eos_token_id=-1)[max_new_tokens // 2 :]] += 1
+    return int(counts.argmax())
+
+
+@pytest.mark.parametrize("max_active_sequences", [1, 3, 16])
+def test_greedy_matches_generate(tiny_lm, max_active_sequences):
+    prompts = make_prompts(10)
+    generation_config = GenerationConfig(max_new_tokens=12, do_sample=False)
+    eos_token_id = frequent_token(tiny_lm, prompts, generation_config.max_new_tokens)
+
+    engine = ContinuousBatchingEngine(tiny_lm, max_active_sequences, [eos_token_id], pad_token_id=PAD_TOKEN_ID)
+    requests = engine.generate(prompts, generation_config)
+
+    expected = [reference_generate(tiny_lm, p, generation_config.max_new_tokens, eos_token_id) for p in prompts]
+    assert [request.output_ids for request in requests] == expected
+    # some sequences end at the terminator while others keep decoding
+    assert {len(output_ids) for output_ids in expected} != {generation_config.max_new_tokens}
+    # the terminators are not counted as new tokens
+    assert engine.stats.get("engine/new_tokens") == sum(len(output_ids) for output_ids in expected)
+
+
+def test_eviction_refills_freed_slots(tiny_lm):
+    prompts = make_prompts(8, seed=1)
+    budgets = [2, 9, 4, 12, 1, 7, 3, 10]
+    generation_config = GenerationConfig(max_new_tokens=max(budgets), do_sample=False)
+    engine = ContinuousBatchingEngine(tiny_lm, 3, [-1], pad_token_id=PAD_TOKEN_ID)
+    requests = [
+        GenerationRequest(uid=i, input_ids=input_ids, max_new_tokens=budget)
+        for i, (input_ids, budget) in enumerate(zip(prompts, budgets))
+    ]
+    engine.generate_requests(requests, generation_config)
+
+    for request, input_ids, budget in zip(requests, prompts, budgets):
+        assert request.finished
+        assert request.output_ids == reference_generate(tiny_lm, input_ids, budget, eos_token_id=-1)
+    # queued prompts were admitted as sequences ran out of budget, not in fixed batches of 3
+    assert engine.stats.get("engine/admissions") > -(-len(prompts) // 3)
+
+
+@pytest.mark.parametrize("num_draft_tokens", [1, 4])
+def test_speculative_matches_greedy(tiny_lm, tiny_draft_lm, num_draft_tokens):
+    prompts = make_prompts(10, seed=2)
+    generation_config = GenerationConfig(max_new_tokens=12, do_sample=False)
+    eos_token_id = frequent_token(tiny_lm, prompts, generation_config.max_new_tokens)
+
+    greedy = ContinuousBatchingEngine(tiny_lm, 4, [eos_token_id], pad_token_id=PAD_TOKEN_ID)
+    speculative = ContinuousBatchingEngine(
+        tiny_lm,
+        4,
+        [eos_token_id],
+        pad_token_id=PAD_TOKEN_ID,
+        draft_model=tiny_draft_lm,
+        num_draft_tokens=num_draft_tokens,
+    )
+    expected = [request.output_ids for request in greedy.generate(prompts, generation_config)]
+    assert [request.output_ids for request in speculative.generate(prompts, generation_config)] == expected
+    assert speculative.stats.get("engine/draft_tokens") > 0
+
+
+def test_speculative_records_acceptance_per_batch(tiny_lm, tiny_draft_lm, capsys):
+    generation_config = GenerationConfig(max_new_tokens=8, do_sample=False)
+    engine = ContinuousBatchingEngine(
+        tiny_lm, 4, [-1], pad_token_id=PAD_TOKEN_ID, draft_model=tiny_draft_lm, num_draft_tokens=3
+    )
+    for seed in range(3):
+        engine.generate(make_prompts(5, seed=seed), generation_config)
+
+    assert len(engine.batch_acceptance) == 3
+    assert all(0 <= accepted <= drafted and drafted > 0 for accepted, drafted in engine.batch_acceptance)
+    assert sum(accepted for accepted, _ in engine.batch_acceptance) == engine.stats.get("engine/accepted_draft_tokens")
+    assert sum(drafted for _, drafted in engine.batch_acceptance) == engine.stats.get("engine/draft_tokens")
+    assert len(engine.batch_throughput) == 3
+    assert all(new_tokens > 0 and seconds > 0 for new_tokens, seconds in engine.batch_throughput)
+    assert sum(new_tokens for new_tokens, _ in engine.batch_throughput) == engine.stats.get("engine/new_tokens")
+    out = capsys.readouterr().out
+    assert out.count("draft tokens in this batch") == out.count("tokens/s") == 3
+
+
+def set_generation_config(monkeypatch, model, **kwargs):
+    generation_config = copy.deepcopy(model.generation_config)
+    generation_config.update(**kwargs)
+    monkeypatch.setattr(model, "generation_config", generation_config)
+
+
+@pytest.mark.parametrize("num_draft_tokens", [0, 3])
+def test_checkpoint_processors_match_generate(tiny_lm, tiny_draft_lm, monkeypatch, num_draft_tokens):
+    prompts = make_prompts(8, seed=3)
+    max_new_tokens = 12
+    plain = [reference_generate(tiny_lm, p, max_new_tokens, eos_token_id=-1) for p in prompts]
+
+    # a checkpoint may penalize repetitions in its generation config, `generate` applies them under the run settings
+    set_generation_config(monkeypatch, tiny_lm, repetition_penalty=1.5, no_repeat_ngram_size=2)
+    engine = ContinuousBatchingEngine(
+        tiny_lm,
+        3,
+        [-1],
+        pad_token_id=PAD_TOKEN_ID,
+        draft_model=tiny_draft_lm if num_draft_tokens else None,
+        num_draft_tokens=max(num_draft_tokens, 1),
+    )
+    requests = engine.generate(prompts, GenerationConfig(max_new_tokens=max_new_tokens, do_sample=False))
+
+    expected = [reference_generate(tiny_lm, p, max_new_tokens, eos_token_id=-1) for p in prompts]
+    assert [request.output_ids for request in requests] == expected
+    assert expected != plain
+
+
+def test_checkpoint_warpers_are_applied(tiny_lm, monkeypatch):
+    set_generation_config(monkeypatch, tiny_lm, do_sample=True, min_p=0.1, typical_p=0.9)
+    engine = ContinuousBatchingEngine(tiny_lm, 3, [-1], pad_token_id=PAD_TOKEN_ID)
+
+    warpers = engine.prepare_logits_warper(GenerationConfig(do_sample=True))
+    assert {MinPLogitsWarper, TypicalLogitsWarper} <= {type(warper) for warper in warpers}
+
+
+@pytest.mark.parametrize("max_active_sequences", [1, 3, 16])
+def test_continuation_matches_prefill_of_the_whole_sequence(tiny_lm, max_active_sequences):
+    prompts = make_prompts(8, seed=3)
+    generation_config = GenerationConfig(max_new_tokens=10, do_sample=False)
+    eos_token_id = frequent_token(tiny_lm, prompts, generation_config.max_new_tokens)
+    trigger_ids = [17, 42, 99]
+
+    engine = ContinuousBatchingEngine(tiny_lm, max_active_sequences, [eos_token_id], pad_token_id=PAD_TOKEN_ID)
+    requests = [
+        GenerationRequest(
+            uid=i, input_ids=p, max_new_tokens=generation_config.max_new_tokens, continuation_ids=trigger_ids
+        )
+        for i, p in enumerate(prompts)
+    ]
+    engine.generate_requests(requests, generation_config)
+
+    for request, input_ids in zip(requests, prompts):
+        # the old two-pass flow: decode the reasoning, then prefill prompt, reasoning and trigger again
+        reasoning_ids = reference_generate(tiny_lm, input_ids, generation_config.max_new_tokens, eos_token_id)
+        answer_ids = reference_generate(
+            tiny_lm, input_ids + reasoning_ids + trigger_ids, generation_config.max_new_tokens, eos_token_id
+        )
+        assert request.first_output_ids == reasoning_ids
+        assert request.output_ids == answer_ids
+    # reasonings ending at the terminator and at the budget are both continued
+    assert {len(request.first_output_ids) for request in requests} != {generation_config.max_new_tokens}
+    assert engine.stats.get("engine/continuation_reused_tokens") > 0
+
+
+@pytest.mark.parametrize("continuation", [False, True])
+def test_prefix_caching_matches_full_prefill(tiny_lm, continuation):
+    prefix_ids = make_prompts(1, seed=4)[0] + [5, 6, 7]
+    # most prompts share the prefix, the others are prefilled from scratch in the same batches
+    prompts = [prefix_ids + suffix for suffix in make_prompts(6, seed=5)] + make_prompts(3, seed=6)
+    generation_config = GenerationConfig(max_new_tokens=10, do_sample=False)
+    eos_token_id = frequent_token(tiny_lm, prompts, generation_config.max_new_tokens)
+
+    outputs = {}
+    for prefix_caching in [False, True]:
+        engine = ContinuousBatchingEngine(tiny_lm, 4, [eos_token_id], pad_token_id=PAD_TOKEN_ID)
+        if prefix_caching:
+            engine.set_prefix(prefix_ids)
+        requests = [
+            GenerationRequest(
+                uid=i,
+                input_ids=p,
+                max_new_tokens=generation_config.max_new_tokens,
+                continuation_ids=[17, 42] if continuation else None,
+            )
+            for i, p in enumerate(prompts)
+        ]
+        engine.generate_requests(requests, generation_config)
+        outputs[prefix_caching] = [(request.first_output_ids, request.output_ids) for request in requests]
+        assert (engine.stats.get("engine/prefix_reused_tokens") > 0) == prefix_caching
+    assert outputs[True] == outputs[False]
+
+
+def reference_log_likelihood(model, input_ids: list[int], candidate_ids: list[int]) -> float:
+    """Summed log-probability of the candidate tokens from one forward pass over the unpadded prompt and candidate."""
+    with torch.inference_mode():
+        logits = model(torch.tensor([input_ids + candidate_ids])).logits[0].float()
+    log_probs = torch.log_softmax(logits[len(input_ids) - 1 : -1], dim=-1)
+    return float(log_probs.gather(-1, torch.tensor(candidate_ids)[:, None]).sum())
+
+
+@pytest.mark.parametrize("candidate_batch_size", [1, 2, 8])
+def test_score_matches_full_forward(tiny_lm, candidate_batch_size):
+    # prompts of different lengths are left-padded into one prefill batch
+    prompts = make_prompts(5, seed=7)
+    assert len({len(input_ids) for input_ids in prompts}) > 1
+    candidates = [[11], [12, 13], [14, 15, 16, 17], [12, 13, 20], [30, 31, 32, 33, 34, 35]]
+
+    engine = ContinuousBatchingEngine(tiny_lm, 8, [2], pad_token_id=PAD_TOKEN_ID)
+    scores = engine.score(prompts, candidates, candidate_batch_size=candidate_batch_size)
+
+    expected = torch.tensor([[reference_log_likelihood(tiny_lm, p, c) for c in candidates] for p in prompts])
+    assert scores.shape == (len(prompts), len(candidates))
+    torch.testing.assert_close(scores, expected, atol=1e-4, rtol=1e-4)
@@ -0,0 +1,118 @@
+import pytest
+import numpy as np
+import pandas as pd
+import scanpy as sc
+import anndata as ad
+import scipy.sparse as sp
+
+from soar_benchmark.markers import MarkerConfig, rank_marker_genes
+
+
+@pytest.fixture(scope="module")
+def atlas_path(tmp_path_factory) -> str:
+    """Small integer counts where the cells of group k express genes 5k to 5k + 4 more highly, and some cells have no
+    group."""
+    rng = np.random.default_rng(0)
+    num_cells, num_genes = 150, 30
+    groups = rng.integers(4, size=num_cells)
+    X = rng.poisson(0.8, size=(num_cells, num_genes)).astype(np.float32)
+    for k in range(4):
+        X[np.ix_(groups == k, range(5 * k, 5 * k + 5))] += rng.poisson(2.0, size=((groups == k).sum(), 5))
+    labels = pd.Categorical.from_codes(groups, [f"type {k}" for k in range(4)])
+    labels[rng.choice(num_cells, 12, replace=False)] = np.nan
+
+    path = tmp_path_factory.mktemp("markers") / "atlas.h5ad"
+    ad.AnnData(
+        X=sp.csr_matrix(X),
+        obs=pd.DataFrame({"cell_type": labels}, index=[f"cell{i}" for i in range(num_cells)]),
+        var=pd.DataFrame(index=[f"GENE{j}" for j in range(num_genes)]),
+    ).write_h5ad(path)
+    return str(path)
+
+
+def scores_by_gene(gene_list, key: str = "scores") -> dict[str, dict[str, float]]:
+    names = gene_list["names"]
+    return {
+        group: dict(zip(map(str, names[group]), np.asarray(gene_list[key][group], dtype=np.float64)))
+        for group in names.dtype.names
+    }
+
+
+@pytest.mark.parametrize(
+    "method, normalize_total",
+    # integer counts fall into distinct Wilcoxon bins, so the binned ranks are exact
+    [("t-test", 0.0), ("t-test", 1e4), ("wilcoxon", 0.0)],
+)
+def test_ranking_matches_scanpy(tmp_path, atlas_path, method, normalize_total):
+    config = MarkerConfig(
+        h5ad_path=atlas_path,
+        groupby="cell_type",
+        output_path=str(tmp_path / "gene_list.h5ad"),
+        method=method,
+        n_genes=30,
+        normalize_total=normalize_total,
+        chunk_size=40,
+    )
+    gene_list = rank_marker_genes(config)
+
+    # scanpy counts cells without a group toward the rest of every group, they are left out of both rankings here
+    adata = sc.read_h5ad(atlas_path)
+    adata = adata[adata.obs["cell_type"].notna()].copy()
+    if normalize_total > 0:
+        sc.pp.normalize_total(adata, target_sum=normalize_total)
+        sc.pp.log1p(adata)
+    sc.tl.rank_genes_groups(adata, "cell_type", method=method, n_genes=30, key_added="gene_list")
+    expected = adata.uns["gene_list"]
+
+    for key in ["scores", "pvals"]:
+        ranked, reference = scores_by_gene(gene_list, key), scores_by_gene(expected, key)
+        for group in reference:
+            assert ranked[group].keys() == reference[group].keys()
+            for gene, value in reference[group].items():
+                assert ranked[group][gene] == pytest.approx(value, rel=1e-4, abs=1e-6), (key, group, gene)
+    for group in expected["names"].dtype.names:
+        # the planted marker genes rank first, in the same order
+        assert list(gene_list["names"][group][:5]) == list(expected["names"][group][:5])
+        k = int(group.split()[-1])
+        assert set(gene_list["names"][group][:5]) == {f"GENE{j}" for j in range(5 * k, 5 * k + 5)}
+
+    # the ranked gene list is read back from the output file like `H5ADDataset` reads it
+    written = ad.read_h5ad(config.output_path).uns["gene_list"]
+    assert [list(written["names"][group]) for group in written["names"].dtype.names] == [
+        list(gene_list["names"][group]) for group in gene_list["names"].dtype.names
+    ]
+
+
+def test_chunking_and_workers_do_not_change_the_ranking(tmp_path, atlas_path):
+    rankings = []
+    for chunk_size, num_workers in [(1000, 0), (7, 0), (33, 2)]:
+        config = MarkerConfig(
+            h5ad_path=atlas_path,
+            groupby="cell_type",
+            output_path=str(tmp_path / f"gene_list_{chunk_size}.h5ad"),
+            method="wilcoxon",
+            n_genes=10,
+            chunk_size=chunk_size,
+            num_workers=num_workers,
+        )
+        gene_list = rank_marker_genes(config)
+        rankings.append({group: list(gene_list["names"][group]) for group in gene_list["names"].dtype.names})
+    assert rankings[1] == rankings[0] and rankings[2] == rankings[0]
+
+
+@pytest.mark.parametrize("categories", [["type 0"], ["type 0", "type 1"]])
+def test_a_single_group_is_rejected(tmp_path, categories):
+    # with an unused category, all cells are still in a single group
+    path = tmp_path / "one_group.h5ad"
+    ad.AnnData(
+        X=sp.csr_matrix(np.ones((6, 4), dtype=np.float32)),
+        obs=pd.DataFrame(
+            {"cell_type": pd.Categorical(["type 0"] * 6, categories=categories)},
+            index=[f"cell{i}" for i in range(6)],
+        ),
+        var=pd.DataFrame(index=[f"GENE{j}" for j in range(4)]),
+    ).write_h5ad(path)
+
+    config = MarkerConfig(h5ad_path=str(path), groupby="cell_type", output_path=str(tmp_path / "gene_list.h5ad"))
+    with pytest.raises(ValueError, match="at least two groups with cells"):
+        rank_marker_genes(config)
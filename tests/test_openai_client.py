@@ -0,0 +1,159 @@
+import json
+import time
+import openai
+import asyncio
+import threading
+import pytest
+
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from soar_benchmark.openai.client import AsyncChatCompletionClient, TokenBucket
+
+
+class MockChatCompletionHandler(BaseHTTPRequestHandler):
+    """Answers with the prompt, after failing the first attempts of prompts like "fail 429 500 #id" with those
+    statuses in turn."""
+
+    server: "MockChatCompletionServer"
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        prompt = body["messages"][-1]["content"]
+        server = self.server
+        with server.lock:
+            attempt = server.attempts[prompt]
+            server.attempts[prompt] += 1
+            server.in_flight += 1
+            server.max_in_flight = max(server.max_in_flight, server.in_flight)
+        time.sleep(server.latency)
+        with server.lock:
+            server.in_flight -= 1
+
+        failures = (
+            [word for word in prompt.split()[1:] if not word.startswith("#")] if prompt.startswith("fail") else []
+        )
+        if failures == ["always"] or attempt < len(failures):
+            status = 500 if failures == ["always"] else int(failures[attempt])
+            payload = {"error": {"message": f"mock {status}", "type": "mock"}}
+        else:
+            status = 200
+            payload = {
+                "id": "chatcmpl-mock",
+                "object": "chat.completion",
+                "created": 0,
+                "model": body["model"],
+                "choices": [
+                    {"index": 0, "finish_reason": "stop", "message": {"role": "assistant", "content": f"echo {prompt}"}}
+                ],
+                "usage": {"prompt_tokens": 10, "completion_tokens": 2, "total_tokens": 12},
+            }
+
+        data = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        if status == 429:
+            self.send_header("retry-after", "0.01")
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class MockChatCompletionServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, latency: float = 0.0):
+        super().__init__(("127.0.0.1", 0), MockChatCompletionHandler)
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.attempts: Counter = Counter()
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    @property
+    def base_url(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+
+@pytest.fixture
+def mock_server():
+    server = MockChatCompletionServer()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def make_requests(prompts: list[str], max_tokens: int = 8) -> list[dict]:
+    return [
+        {"model": "mock", "messages": [{"role": "user", "content": prompt}], "max_tokens": max_tokens}
+        for prompt in prompts
+    ]
+
+
+def test_retries_failed_requests(mock_server):
+    client = AsyncChatCompletionClient("key", base_url=mock_server.base_url, max_backoff=0.01)
+    prompts = ["ok #0", "fail 429 #1", "fail 500 #2", "fail 429 500 429 #3", "ok #4"]
+    messages = client.complete(make_requests(prompts))
+
+    # answers come back in request order, whatever order the retries finish in
+    assert [message.content for message in messages] == [f"echo {prompt}" for prompt in prompts]
+    assert client.stats.get("openai/retries") == 5
+    assert client.stats.get("openai/requests") == len(prompts)
+    assert client.stats.get("openai/prompt_tokens") == 10 * len(prompts)
+    assert client.stats.get("openai/completion_tokens") == 2 * len(prompts)
+
+
+def test_completes_inside_a_running_event_loop(mock_server):
+    # e.g. a notebook cell, which runs inside the kernel's event loop
+    async def notebook_cell():
+        client = AsyncChatCompletionClient("key", base_url=mock_server.base_url, max_backoff=0.01)
+        return client.complete(make_requests(["ok #0", "fail 429 #1"]))
+
+    messages = asyncio.run(notebook_cell())
+    assert [message.content for message in messages] == ["echo ok #0", "echo fail 429 #1"]
+
+
+def test_gives_up_after_max_retries(mock_server):
+    client = AsyncChatCompletionClient("key", base_url=mock_server.base_url, max_retries=2, max_backoff=0.01)
+    with pytest.raises(openai.InternalServerError):
+        client.complete(make_requests(["fail always"]))
+    assert mock_server.attempts["fail always"] == 3
+
+
+def test_does_not_retry_client_errors(mock_server):
+    client = AsyncChatCompletionClient("key", base_url=mock_server.base_url, max_backoff=0.01)
+    with pytest.raises(openai.BadRequestError):
+        client.complete(make_requests(["fail 400"]))
+    assert mock_server.attempts["fail 400"] == 1
+
+
+def test_limits_concurrency(mock_server):
+    mock_server.latency = 0.05
+    client = AsyncChatCompletionClient("key", base_url=mock_server.base_url, max_concurrency=3)
+    client.complete(make_requests([f"ok #{i}" for i in range(12)]))
+    assert mock_server.max_in_flight == 3
+
+
+def test_limits_requests_per_minute(mock_server):
+    # the bucket starts full, the request past its capacity waits for 1 / (120 / 60s) = 0.5s of refill
+    client = AsyncChatCompletionClient("key", base_url=mock_server.base_url, requests_per_minute=120)
+    start = time.monotonic()
+    client.complete(make_requests([f"ok #{i}" for i in range(121)]))
+    assert time.monotonic() - start >= 0.45
+
+
+def test_token_bucket_waits_for_refill():
+    async def acquire_all(bucket: TokenBucket, amounts: list[float]) -> float:
+        start = time.monotonic()
+        for amount in amounts:
+            await bucket.acquire(amount)
+        return time.monotonic() - start
+
+    # 6000 tokens per minute refill 100 tokens per second
+    assert asyncio.run(acquire_all(TokenBucket(6000), [6000])) < 0.05
+    assert 0.25 <= asyncio.run(acquire_all(TokenBucket(6000), [6000, 30])) < 0.5
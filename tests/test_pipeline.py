@@ -0,0 +1,152 @@
+import torch
+import pytest
+
+from dataclasses import replace
+
+from soar_benchmark.engine import longest_common_prefix
+from soar_benchmark.pipeline import (
+    Cell2SentCellTypeAnnotationPipeline,
+    CellTypeAnnotationPipeline,
+    GenerationConfig,
+    PipelineConfig,
+)
+
+
+@pytest.mark.parametrize("engine", ["", "continuous"])
+def test_counts_every_sampled_sequence(tiny_model_path, engine):
+    config = PipelineConfig(
+        model_custom_id="tiny",
+        model_name=tiny_model_path,
+        torch_dtype="float32",
+        device_map="cpu",
+        tokenizer_kwargs={"padding_side": "left"},
+        engine=engine,
+    )
+    pipeline = CellTypeAnnotationPipeline(config)
+    messages = [[{"role": "user", "content": f"Which cell type expresses marker {i}?"}] for i in range(4)]
+    generated = pipeline(messages, GenerationConfig(max_new_tokens=4, do_sample=True, num_samples=3))
+    assert [len(outputs) for outputs in generated] == [3] * 4
+    assert pipeline.stats.get("generation/sequences") == 12
+    # both paths report their throughput
+    assert pipeline.stats.get("generation/new_tokens") == sum(
+        pipeline.count_completion_tokens(output) for outputs in generated for output in outputs
+    )
+    assert pipeline.stats.get("generation/new_tokens") > 0
+
+
+def test_score_candidates_match_full_forward(tiny_model_path):
+    config = PipelineConfig(
+        model_custom_id="tiny",
+        model_name=tiny_model_path,
+        torch_dtype="float32",
+        device_map="cpu",
+        tokenizer_kwargs={"padding_side": "left"},
+        batch_size=2,
+    )
+    pipeline = CellTypeAnnotationPipeline(config)
+    messages = [
+        [{"role": "user", "content": "Which cell type expresses CD3E?"}],
+        [{"role": "user", "content": "Which cell type, in blood, expresses CD19, MS4A1 and CD79A?"}],
+        [{"role": "user", "content": "CD14?"}],
+    ]
+    candidates = ["T cell", "B cell", "monocyte", "natural killer cell"]
+    scores = pipeline.score_candidates(messages, candidates)
+
+    # every candidate is scored as the whole response, followed by the terminator
+    terminator = pipeline.get_terminators()[-1]
+    expected = torch.empty(len(messages), len(candidates))
+    for i, message in enumerate(messages):
+        input_ids = pipeline.encode_messages(message)
+        for j, candidate in enumerate(candidates):
+            candidate_ids = pipeline.tokenizer(candidate, add_special_tokens=False)["input_ids"] + [terminator]
+            with torch.inference_mode():
+                logits = pipeline.model(torch.tensor([input_ids + candidate_ids])).logits[0].float()
+            log_probs = torch.log_softmax(logits[len(input_ids) - 1 : -1], dim=-1)
+            expected[i, j] = log_probs.gather(-1, torch.tensor(candidate_ids)[:, None]).sum()
+    torch.testing.assert_close(scores, expected, atol=1e-4, rtol=1e-4)
+
+
+def cell2sent_config(tiny_model_path, **kwargs) -> PipelineConfig:
+    return PipelineConfig(
+        model_custom_id="tiny",
+        model_name=tiny_model_path,
+        torch_dtype="float32",
+        device_map="cpu",
+        pipeline_class_name="Cell2SentCellTypeAnnotationPipeline",
+        **kwargs,
+    )
+
+
+def test_cell2sent_batches_match_single_prompts(tiny_model_path):
+    pipeline = Cell2SentCellTypeAnnotationPipeline(cell2sent_config(tiny_model_path, batch_size=4))
+    # gene lists of different lengths, so the batched prompts are padded
+    messages = [
+        [{"role": "user", "content": f"Genes: [{', '.join(f'GENE{j}' for j in range(i, 2 * i + 1))}]"}]
+        for i in range(6)
+    ]
+    generation_config = GenerationConfig(max_new_tokens=6, do_sample=False)
+    batched = pipeline(messages, generation_config)
+
+    pipeline.config.batch_size = 1
+    assert pipeline(messages, generation_config) == batched
+    assert pipeline.stats.get("generation/new_tokens") > 0
+
+
+@pytest.mark.parametrize("kwargs", [{"engine": "continuous"}, {"prefix_caching": True}, {"draft_model_name": "draft"}])
+def test_cell2sent_rejects_engine_settings(tiny_model_path, kwargs):
+    with pytest.raises(ValueError, match="Cell2Sent decodes with `generate`"):
+        Cell2SentCellTypeAnnotationPipeline(cell2sent_config(tiny_model_path, **kwargs))
+
+
+def test_longest_common_prefix_keeps_a_token_per_prompt():
+    assert longest_common_prefix([]) == []
+    assert longest_common_prefix([[1, 2, 3, 4], [1, 2, 3, 5], [1, 2, 6]]) == [1, 2]
+    # a prompt equal to the prefix keeps its last token to seed its first generated token
+    assert longest_common_prefix([[1, 2, 3], [1, 2, 3, 4]]) == [1, 2]
+    assert longest_common_prefix([[7, 8], [9]]) == []
+
+
+def test_longest_common_prefix_streams_prompts():
+    read = []
+
+    def prompts():
+        for input_ids in [[1, 2, 3, 4], [1, 2, 5], [6, 7], [1, 2, 3]]:
+            read.append(input_ids)
+            yield input_ids
+
+    # once no prefix is shared, the remaining prompts are never read
+    assert longest_common_prefix(prompts()) == []
+    assert len(read) == 3
+
+
+def test_shared_prompt_prefix_answers_like_full_prefill(tiny_model_path):
+    config = PipelineConfig(
+        model_custom_id="tiny",
+        model_name=tiny_model_path,
+        torch_dtype="float32",
+        device_map="cpu",
+        tokenizer_kwargs={"padding_side": "left"},
+        engine="continuous",
+        batch_size=3,
+    )
+    pipeline = CellTypeAnnotationPipeline(config)
+    cached = CellTypeAnnotationPipeline(
+        replace(config, prefix_caching=True), model_and_tokenizer=(pipeline.model, pipeline.tokenizer)
+    )
+    # a constant system prompt and demo in front of every sample, like the few-shot prompters
+    system = {"role": "system", "content": "You annotate cell types. Example: CD3E, CD3D -> T cell."}
+    messages = [[system, {"role": "user", "content": f"Genes: MARKER{i}, GENE{i * 7}"}] for i in range(7)]
+    generation_config = GenerationConfig(max_new_tokens=6, do_sample=False)
+
+    cached.prepare_prefix_cache(messages)
+    prefix_ids = cached.engine.prefix_ids
+    assert len(prefix_ids) > len(cached.tokenizer(system["content"])["input_ids"])
+    assert all(cached.tokenize_messages(message)[: len(prefix_ids)] == prefix_ids for message in messages)
+
+    # the same tokens, with log-probabilities equal up to the summation order of the attention
+    for outputs, expected in zip(cached(messages, generation_config), pipeline(messages, generation_config)):
+        assert outputs[0]["generated_text"] == expected[0]["generated_text"]
+        assert outputs[0]["num_tokens"] == expected[0]["num_tokens"]
+        assert outputs[0]["mean_log_prob"] == pytest.approx(expected[0]["mean_log_prob"], abs=1e-4)
+    assert cached.stats.get("engine/prefix_reused_tokens") == len(prefix_ids) * len(messages)
+    assert pipeline.stats.get("engine/prefix_reused_tokens") == 0
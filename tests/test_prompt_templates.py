@@ -0,0 +1,48 @@
+import pickle
+
+import pytest
+
+from soar_benchmark.task import prompter_cls
+from soar_benchmark.prompt_templates.factory import FewShotRankedGeneNamesPromptTemplate
+from analysis.benchmark.prompt_rendering import synthetic_samples, render_per_sample
+
+
+@pytest.mark.parametrize("prompter_name", list(prompter_cls))
+def test_render_batch_matches_get_messages(prompter_name):
+    batch = synthetic_samples(num_samples=8, num_genes=50, genes_per_sample=6, num_demos=2)
+    # % signs and braces in the values are kept verbatim
+    batch[0]["tissue"] = "100% {tissue}"
+    prompter = prompter_cls[prompter_name]()
+    assert prompter.render_batch(batch, 4) == render_per_sample(prompter_name, batch, 4)
+
+    # the compiled templates survive the trip to DataLoader workers
+    prompter = pickle.loads(pickle.dumps(prompter))
+    assert prompter.render_batch(batch, 4) == render_per_sample(prompter_name, batch, 4)
+
+
+@pytest.mark.parametrize("prompter_name", ["zero_shot_cot", "zero_shot_cot_scact"])
+def test_render_batch_answer_prompts(prompter_name):
+    batch = synthetic_samples(num_samples=4, num_genes=50, genes_per_sample=6, num_demos=0)
+    reasonings = [f"Reasoning %s {{{i}}}" for i in range(len(batch))]
+    prompter = prompter_cls[prompter_name]()
+    assert prompter.render_batch(batch, 4, reasonings=reasonings) == render_per_sample(
+        prompter_name, batch, 4, reasonings
+    )
+
+
+def test_template_digest_follows_the_template_text():
+    digests = {name: cls().template_digest() for name, cls in prompter_cls.items()}
+    assert len(set(digests.values())) == len(digests)
+    assert prompter_cls["few_shot"]().template_digest() == digests["few_shot"]
+
+    class EditedDemo(FewShotRankedGeneNamesPromptTemplate):
+        @property
+        def cot_trigger(self):
+            return "Let's think it through."
+
+    class EditedDemoLayout(FewShotRankedGeneNamesPromptTemplate):
+        def format_demo(self, demos):
+            return super().format_demo(demos).replace("Question:", "Q:")
+
+    assert EditedDemo().template_digest() != digests["few_shot"]
+    assert EditedDemoLayout().template_digest() != digests["few_shot"]
@@ -0,0 +1,63 @@
+import json
+import pytest
+import numpy as np
+
+from soar_benchmark.reference import ReferenceAtlas, ReferenceAtlasConfig
+
+SIGNATURES = [
+    {"cell_type": "T cell", "gene_names": ["CD3E", "CD3D", "CD2", "IL7R", "CD3E"]},
+    {"cell_type": "B cell", "gene_names": ["MS4A1", "CD79A", "CD19", "CD74"]},
+    # a second signature of the same cell type, the cell type scores as the best of them
+    {"cell_type": "T cell", "gene_names": ["CD8A", "CD8B", "GZMK", "CD3D"]},
+    {"cell_type": "monocyte", "gene_names": ["CD14", "LYZ", "FCN1", "CD74", "S100A8"]},
+]
+
+
+def dense_scores(signatures: list[dict], gene_lists: list[list[str]], num_genes: int) -> tuple[list[str], np.ndarray]:
+    """Score every gene list against every cell type gene by gene, without the sparse matrices."""
+    cell_types = sorted({signature["cell_type"] for signature in signatures})
+    scores = np.zeros((len(gene_lists), len(cell_types)))
+    for i, genes in enumerate(gene_lists):
+        genes = list(dict.fromkeys(genes))
+        weights = [1 / np.log2(rank + 2) for rank in range(len(genes))]
+        total = sum(weights)
+        for signature in signatures:
+            top = set(signature["gene_names"][:num_genes])
+            score = sum(weight for gene, weight in zip(genes, weights) if gene in top) / total if genes else 0.0
+            j = cell_types.index(signature["cell_type"])
+            scores[i, j] = max(scores[i, j], score)
+    return cell_types, scores
+
+
+def dense_match(cell_types: list[str], scores: np.ndarray, threshold: float, margin: float) -> list:
+    answers = []
+    for row in scores:
+        order = sorted(range(len(row)), key=lambda j: (-row[j], j))
+        best, runner_up = row[order[0]], row[order[1]] if len(row) > 1 else 0.0
+        answers.append(cell_types[order[0]] if best >= threshold and best - runner_up >= margin else None)
+    return answers
+
+
+@pytest.mark.parametrize("num_genes", [2, 3, 50])
+def test_reference_matches_dense_scoring(tmp_path, num_genes):
+    path = tmp_path / "reference.json"
+    with open(path, "w") as f:
+        json.dump(SIGNATURES, f)
+    config = ReferenceAtlasConfig(path=str(path), num_genes=num_genes, threshold=0.5, margin=0.2)
+    atlas = ReferenceAtlas(config)
+
+    rng = np.random.default_rng(num_genes)
+    vocabulary = sorted({gene for signature in SIGNATURES for gene in signature["gene_names"]}) + ["GENE1", "GENE2"]
+    gene_lists = [list(rng.choice(vocabulary, size=rng.integers(1, 8))) for _ in range(200)]
+    # an exact signature, a gene list repeating its genes, unknown genes only, and no genes at all
+    gene_lists += [["CD3E", "CD3D", "CD2"], ["MS4A1", "MS4A1", "CD79A"], ["GENE1", "GENE2"], []]
+
+    cell_types, expected = dense_scores(SIGNATURES, gene_lists, num_genes)
+    assert atlas.cell_types == cell_types
+    np.testing.assert_allclose(atlas.score(gene_lists), expected, atol=1e-12)
+
+    answers = [match["cell_type"] if match else None for match in atlas.match(gene_lists)]
+    assert answers == dense_match(cell_types, expected, config.threshold, config.margin)
+    assert answers[-4:] == ["T cell", "B cell", None, None]
+    # some samples are answered from the reference and others go on to the model
+    assert 0 < sum(answer is not None for answer in answers) < len(answers)
@@ -0,0 +1,34 @@
+import json
+
+from soar_benchmark.retrieval import DemoIndex
+
+
+def write_pool(path, gene_sets: list[list[str]]):
+    with open(path, "w") as f:
+        for i, genes in enumerate(gene_sets):
+            f.write(json.dumps({"gene_names": genes, "tissue": "blood", "cell_type": f"type {i}"}) + "\n")
+
+
+def test_search_ranks_by_jaccard(tmp_path):
+    pool_path = tmp_path / "pool.jsonl"
+    write_pool(pool_path, [["A", "B", "X"], ["A", "Y", "Z"], ["C", "D"], ["A", "B", "W", "V"]])
+    index = DemoIndex(str(pool_path), str(tmp_path / "index"))
+
+    # Jaccard with {A, B, C}: 2/4, 1/5, 1/4, 2/5
+    hits = index.search([["A", "B", "C"]], k=3)[0]
+    assert [demo for demo, _ in hits] == [0, 3, 2]
+    assert [score for _, score in hits] == [2 / 4, 2 / 5, 1 / 4]
+    # the most similar demo goes last
+    assert [demo["cell_type"] for demo in index.retrieve([["A", "B", "C"]], k=3)[0]] == ["type 2", "type 3", "type 0"]
+
+
+def test_search_skips_the_sample_itself(tmp_path):
+    pool_path = tmp_path / "pool.jsonl"
+    sample_genes = ["G1", "G2", "G3", "G4", "G5", "G6"]
+    write_pool(pool_path, [sample_genes, sample_genes[:3], sample_genes[:2] + ["H1"], ["G1", "H2"]])
+    index = DemoIndex(str(pool_path), str(tmp_path / "index"))
+
+    # the full marker list, or only its top genes, retrieves neither its own demo nor a nested one
+    assert [demo for demo, _ in index.search([sample_genes], k=4)[0]] == [2, 3]
+    assert [demo for demo, _ in index.search([sample_genes[:3]], k=4)[0]] == [2, 3]
+    assert [demo for demo, _ in index.search([sample_genes[:3]], k=4, exclude_nested=False)[0]] == [1, 0, 2, 3]
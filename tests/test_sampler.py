@@ -0,0 +1,35 @@
+import random
+import pytest
+
+from soar_benchmark.sampler import LengthBucketBatchSampler, padding_stats
+
+
+@pytest.mark.parametrize("num_prompts", [0, 1, 7, 64, 101])
+@pytest.mark.parametrize("batch_size", [1, 4, 16])
+@pytest.mark.parametrize("num_buckets", [1, 3, 8, 200])
+def test_visits_every_index_once(num_prompts, batch_size, num_buckets):
+    rng = random.Random(num_prompts * 31 + batch_size)
+    lengths = [rng.randint(5, 300) for _ in range(num_prompts)]
+    sampler = LengthBucketBatchSampler(lengths, batch_size, num_buckets)
+
+    batches = list(sampler)
+    assert len(batches) == len(sampler)
+    assert sorted(i for batch in batches for i in batch) == list(range(num_prompts))
+    # only the last batch may be partial
+    assert all(len(batch) == batch_size for batch in batches[:-1])
+    assert all(0 < len(batch) <= batch_size for batch in batches)
+
+
+def test_batches_prompts_of_similar_length():
+    rng = random.Random(0)
+    lengths = [rng.randint(5, 300) for _ in range(256)]
+    sampler = LengthBucketBatchSampler(lengths, batch_size=8, num_buckets=8)
+
+    # batches follow the prompt lengths, so each batch is padded to a length close to its own
+    flat_lengths = [lengths[i] for batch in sampler for i in batch]
+    assert flat_lengths == sorted(lengths)
+    sequential_batches = [list(range(i, min(i + 8, len(lengths)))) for i in range(0, len(lengths), 8)]
+    num_tokens, num_padded_tokens = padding_stats(sampler.batches, lengths)
+    _, num_sequential_padded_tokens = padding_stats(sequential_batches, lengths)
+    assert num_tokens == sum(lengths)
+    assert num_padded_tokens < num_sequential_padded_tokens
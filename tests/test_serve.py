@@ -0,0 +1,164 @@
+import json
+import threading
+import urllib.error
+import urllib.request
+import openai
+import pytest
+
+from concurrent.futures import ThreadPoolExecutor
+
+from soar_benchmark.pipeline import CellTypeAnnotationPipeline, GenerationConfig, PipelineConfig
+from soar_benchmark.serve import ChatCompletionServer, ChatRequest, MicroBatcher
+
+
+@pytest.fixture(scope="module")
+def pipeline(tiny_model_path):
+    config = PipelineConfig(
+        model_custom_id="tiny",
+        model_name=tiny_model_path,
+        torch_dtype="float32",
+        device_map="cpu",
+        tokenizer_kwargs={"padding_side": "left"},
+        engine="continuous",
+    )
+    return CellTypeAnnotationPipeline(config)
+
+
+@pytest.fixture(scope="module")
+def server(pipeline):
+    server = ChatCompletionServer({"tiny": pipeline}, port=0, max_batch_size=8, max_wait=0.05)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture(scope="module")
+def client(server):
+    return openai.OpenAI(base_url=server.base_url, api_key="unused", max_retries=0)
+
+
+def messages(i: int) -> list[dict[str, str]]:
+    return [{"role": "user", "content": f"Which cell type expresses marker {i}?"}]
+
+
+def test_round_trip_matches_pipeline(pipeline, client):
+    generation_config = GenerationConfig(max_new_tokens=8, do_sample=False)
+    expected = pipeline([messages(i) for i in range(6)], generation_config)
+
+    with ThreadPoolExecutor(6) as executor:
+        responses = list(
+            executor.map(
+                lambda i: client.chat.completions.create(
+                    model="tiny", messages=messages(i), max_tokens=8, temperature=0
+                ),
+                range(6),
+            )
+        )
+    for response, outputs, i in zip(responses, expected, range(6)):
+        choice = response.choices[0]
+        assert choice.message.content == outputs[0]["generated_text"][-1]["content"]
+        assert response.usage.prompt_tokens == pipeline.count_prompt_tokens(messages(i))
+        assert response.usage.completion_tokens == outputs[0]["num_tokens"]
+        assert choice.finish_reason == ("length" if outputs[0]["num_tokens"] == 8 else "stop")
+    # concurrent requests are answered in shared batches
+    stats = pipeline.stats.summary()
+    assert stats["serve/requests_per_batch"] > 1
+
+
+def test_finish_reason(client):
+    response = client.chat.completions.create(model="tiny", messages=messages(0), max_tokens=3, temperature=0)
+    assert response.choices[0].finish_reason == "length"
+    assert response.usage.completion_tokens == 3
+
+    # stopping at the first character of the answer ends it early
+    stop = response.choices[0].message.content[:1]
+    response = client.chat.completions.create(
+        model="tiny", messages=messages(0), max_tokens=3, temperature=0, stop=[stop]
+    )
+    assert response.choices[0].finish_reason == "stop"
+    assert response.choices[0].message.content == ""
+
+
+def test_lists_models(client):
+    assert [model.id for model in client.models.list().data] == ["tiny"]
+
+
+def test_rejects_unknown_models_and_several_choices(client):
+    with pytest.raises(openai.NotFoundError):
+        client.chat.completions.create(model="unknown", messages=messages(0))
+    with pytest.raises(openai.BadRequestError):
+        client.chat.completions.create(model="tiny", messages=messages(0), n=2)
+
+
+def test_counts_tokens_on_batcher_thread(pipeline, server, client, monkeypatch):
+    threads = []
+    count_prompt_tokens = pipeline.count_prompt_tokens
+
+    def recording_count_prompt_tokens(message):
+        threads.append(threading.current_thread())
+        return count_prompt_tokens(message)
+
+    monkeypatch.setattr(pipeline, "count_prompt_tokens", recording_count_prompt_tokens)
+    client.chat.completions.create(model="tiny", messages=messages(0), max_tokens=3, temperature=0)
+    assert threads == [server.batchers["tiny"].thread]
+
+
+@pytest.mark.parametrize(
+    "body, message",
+    [
+        (b"{not json", "not valid JSON"),
+        (b'["tiny"]', "not an object"),
+        (json.dumps({"model": "tiny"}).encode(), "Missing required parameter 'messages'"),
+        (json.dumps({"model": "tiny", "messages": messages(0), "temperature": "hot"}).encode(), "Invalid request"),
+        (json.dumps({"model": "tiny", "messages": "hello"}).encode(), "non-empty list"),
+        (json.dumps({"model": "tiny", "messages": [{"role": "user"}]}).encode(), "messages[0].content"),
+        (json.dumps({"model": "tiny", "messages": [{"role": "user", "content": 1}]}).encode(), "must be a string"),
+        (json.dumps({"model": "tiny", "messages": messages(0), "seed": "1"}).encode(), "seed must be an integer"),
+        (json.dumps({"model": "tiny", "messages": messages(0), "constrained": "yes"}).encode(), "constrained"),
+    ],
+)
+def test_rejects_malformed_bodies(server, client, body, message):
+    request = urllib.request.Request(
+        f"{server.base_url}/chat/completions", data=body, headers={"Content-Type": "application/json"}
+    )
+    with pytest.raises(urllib.error.HTTPError) as error:
+        urllib.request.urlopen(request)
+    assert error.value.code == 400
+    error_body = json.loads(error.value.read())["error"]
+    assert error_body["type"] == "invalid_request_error"
+    assert message in error_body["message"]
+
+    # the server keeps answering
+    response = client.chat.completions.create(model="tiny", messages=messages(0), max_tokens=2, temperature=0)
+    assert response.choices[0].finish_reason == "length"
+
+
+class FailingPipeline:
+    """Fail every call that contains a message asking to fail."""
+
+    def __init__(self, pipeline):
+        self.pipeline = pipeline
+
+    def __getattr__(self, name):
+        return getattr(self.pipeline, name)
+
+    def __call__(self, messages, *args, **kwargs):
+        if any(message[-1]["content"] == "fail" for message in messages):
+            raise ValueError("failing message")
+        return self.pipeline(messages, *args, **kwargs)
+
+
+def test_failing_request_does_not_fail_its_batch(pipeline):
+    generation_config = GenerationConfig(max_new_tokens=4, do_sample=False)
+    expected = pipeline([messages(i) for i in range(3)], generation_config)
+
+    # a long wait puts all requests in one batch
+    batcher = MicroBatcher(FailingPipeline(pipeline), max_batch_size=8, max_wait=0.5)
+    failing = batcher.submit(ChatRequest([{"role": "user", "content": "fail"}], generation_config))
+    futures = [batcher.submit(ChatRequest(messages(i), generation_config)) for i in range(3)]
+
+    with pytest.raises(ValueError, match="failing message"):
+        failing.result()
+    for future, outputs in zip(futures, expected):
+        assert future.result().content == outputs[0]["generated_text"][-1]["content"]
@@ -0,0 +1,54 @@
+import random
+import pytest
+
+from transformers import AutoTokenizer
+
+from soar_benchmark.stopping import AnswerStopper, StopState
+
+
+@pytest.fixture(scope="module")
+def tokenizer(tiny_model_path):
+    return AutoTokenizer.from_pretrained(tiny_model_path)
+
+
+def random_texts(num_texts: int) -> list[str]:
+    rng = random.Random(0)
+    pieces = [" ", "  ", "\n", ".", ". ", "T cell", " B", " monocyte", "CD4+.", "3.5", "é", "END", "EN", "?"]
+    return ["".join(rng.choice(pieces) for _ in range(rng.randint(1, 40))) for _ in range(num_texts)]
+
+
+def first_stop(stopper: AnswerStopper, token_ids: list[int], incremental: bool) -> int:
+    state = StopState()
+    for length in range(1, len(token_ids) + 1):
+        if stopper.is_stopped(token_ids[:length], state if incremental else None):
+            return length
+    return -1
+
+
+@pytest.mark.parametrize(
+    "kwargs",
+    [
+        {"stop_strings": ["END"]},
+        {"stop_strings": ["T cell", "\n\n"]},
+        {"stop_at_newline": True},
+        {"stop_at_sentence_end": True},
+        {"stop_strings": ["monocyte"], "stop_at_newline": True, "stop_at_sentence_end": True},
+    ],
+)
+def test_incremental_check_matches_full_decode(tokenizer, kwargs):
+    stopper = AnswerStopper(tokenizer, **kwargs)
+    for text in random_texts(300):
+        token_ids = tokenizer(text, add_special_tokens=False)["input_ids"]
+        assert first_stop(stopper, token_ids, incremental=True) == first_stop(stopper, token_ids, incremental=False)
+
+
+def test_incremental_check_decodes_a_bounded_tail(tokenizer):
+    stopper = AnswerStopper(tokenizer, stop_strings=["END"], stop_at_newline=True)
+    decoded_lengths = []
+    decode = stopper.decode
+    stopper.decode = lambda token_ids: decoded_lengths.append(len(token_ids)) or decode(token_ids)
+
+    token_ids = tokenizer(" T cell" * 200, add_special_tokens=False)["input_ids"]
+    state = StopState()
+    assert not any(stopper.is_stopped(token_ids[:length], state) for length in range(1, len(token_ids) + 1))
+    assert max(decoded_lengths) <= stopper.tail_tokens
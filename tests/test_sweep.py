@@ -0,0 +1,138 @@
+import json
+import pytest
+
+from dataclasses import replace
+from nntool.slurm import SlurmConfig
+from test_task import make_config, write_json_dataset
+
+from soar_benchmark.dataset import JSONDatasetConfig
+from soar_benchmark.pipeline import CellTypeAnnotationPipeline, GenerationConfig, PipelineConfig
+from soar_benchmark.run import group_experiments, start_sweep
+from soar_benchmark.task import CellTypeAnnotationTask
+
+
+def read_answers(output_folder) -> list[str]:
+    with open(output_folder / "tiny.json") as f:
+        records = json.load(f)
+    assert [record["index"] for record in records] == list(range(len(records)))
+    return [record["messages"][0]["generated_text"][-1]["content"] for record in records]
+
+
+def test_groups_experiments_by_loaded_model(tmp_path):
+    base = make_config(tmp_path)
+    experiments = {
+        "zero_shot": replace(base, promter_name="zero_shot"),
+        "other_model": replace(base, pipeline=replace(base.pipeline, model_name="other")),
+        # batching and decoding settings run on the same weights
+        "ranked_gene_engine": replace(base, pipeline=replace(base.pipeline, batch_size=16, engine="continuous")),
+        "float32": replace(base, pipeline=replace(base.pipeline, torch_dtype="float32")),
+        "few_shot": replace(base, promter_name="few_shot"),
+        "draft": replace(base, pipeline=replace(base.pipeline, draft_model_name="draft")),
+    }
+    groups = [[name for name, _ in group] for group in group_experiments(experiments)]
+    assert groups == [["zero_shot", "ranked_gene_engine", "few_shot"], ["other_model"], ["float32"], ["draft"]]
+
+
+def test_sweep_loads_the_model_once(tmp_path, tiny_model_path, monkeypatch):
+    json_path = write_json_dataset(tmp_path / "data.json", ["T cell", "B cell", "monocyte", "NK cell", "T cell"])
+    pipeline_config = PipelineConfig(
+        model_custom_id="tiny",
+        model_name=tiny_model_path,
+        torch_dtype="float32",
+        device_map="cpu",
+        tokenizer_kwargs={"padding_side": "left"},
+        batch_size=2,
+    )
+    base = make_config(
+        tmp_path,
+        promter_name="zero_shot",
+        dataset=JSONDatasetConfig(json_path=json_path),
+        generation=GenerationConfig(max_new_tokens=4, do_sample=False),
+        pipeline=pipeline_config,
+        slurm=SlurmConfig(mode="run", partition="local", output_folder=str(tmp_path / "slurm")),
+    )
+    experiments = {
+        "zero_shot": replace(base, output_folder=str(tmp_path / "zero_shot")),
+        "ranked_gene_engine": replace(
+            base,
+            promter_name="ranked_gene",
+            pipeline=replace(pipeline_config, batch_size=3, engine="continuous"),
+            output_folder=str(tmp_path / "ranked_gene_engine"),
+        ),
+    }
+
+    loads = []
+    prepare_model_and_tokenizer = CellTypeAnnotationPipeline.prepare_model_and_tokenizer
+
+    def counting_prepare_model_and_tokenizer(self, config):
+        loads.append(config.model_name)
+        return prepare_model_and_tokenizer(self, config)
+
+    monkeypatch.setattr(CellTypeAnnotationPipeline, "prepare_model_and_tokenizer", counting_prepare_model_and_tokenizer)
+    start_sweep(experiments, output_folder=str(tmp_path))
+    assert loads == [tiny_model_path]
+    with open(tmp_path / "sweep.json") as f:
+        assert json.load(f)["num_models"] == 1
+
+    # the experiment run on the resident weights answers like a run loading them itself
+    config = replace(experiments["ranked_gene_engine"], output_folder=str(tmp_path / "alone"))
+    CellTypeAnnotationTask(config).run()
+    swept, alone = read_answers(tmp_path / "ranked_gene_engine"), read_answers(tmp_path / "alone")
+    assert len(swept) == 5
+    assert swept == alone
+
+
+def test_sweep_rejects_sharded_experiments(tmp_path):
+    base = make_config(tmp_path)
+    experiments = {"zero_shot": base, "sharded": replace(base, num_shards=4)}
+    with pytest.raises(ValueError, match="does not shard experiments, run sharded"):
+        start_sweep(experiments, output_folder=str(tmp_path))
+
+
+def test_sweep_reuses_the_draft_model_and_label_trie(tmp_path, tiny_model_path, monkeypatch):
+    json_path = write_json_dataset(tmp_path / "data.json", ["T cell", "B cell", "monocyte"])
+    ontology_path = tmp_path / "labels.txt"
+    ontology_path.write_text("T cell\nB cell\nmonocyte\n")
+    pipeline_config = PipelineConfig(
+        model_custom_id="tiny",
+        model_name=tiny_model_path,
+        torch_dtype="float32",
+        device_map="cpu",
+        tokenizer_kwargs={"padding_side": "left"},
+        engine="continuous",
+        draft_model_name=tiny_model_path,
+        ontology_path=str(ontology_path),
+        ontology_cache_dir=str(tmp_path / "ontology"),
+    )
+    base = make_config(
+        tmp_path,
+        promter_name="zero_shot",
+        dataset=JSONDatasetConfig(json_path=json_path),
+        generation=GenerationConfig(max_new_tokens=4, do_sample=False),
+        pipeline=pipeline_config,
+        slurm=SlurmConfig(mode="run", partition="local", output_folder=str(tmp_path / "slurm")),
+    )
+    experiments = {
+        "zero_shot": replace(base, output_folder=str(tmp_path / "zero_shot")),
+        "ranked_gene": replace(base, promter_name="ranked_gene", output_folder=str(tmp_path / "ranked_gene")),
+    }
+
+    loads, tries = [], []
+    load_pretrained = CellTypeAnnotationPipeline.load_pretrained
+    prepare_label_trie = CellTypeAnnotationPipeline.prepare_label_trie
+
+    def counting_load_pretrained(self, config, model_name, local_ckpt_path, load_tokenizer=True):
+        loads.append(load_tokenizer)
+        return load_pretrained(self, config, model_name, local_ckpt_path, load_tokenizer)
+
+    def counting_prepare_label_trie(self, config):
+        tries.append(config.ontology_path)
+        return prepare_label_trie(self, config)
+
+    monkeypatch.setattr(CellTypeAnnotationPipeline, "load_pretrained", counting_load_pretrained)
+    monkeypatch.setattr(CellTypeAnnotationPipeline, "prepare_label_trie", counting_prepare_label_trie)
+    start_sweep(experiments, output_folder=str(tmp_path))
+    # the target with its tokenizer and the draft model without one, then nothing for the second experiment
+    assert loads == [True, False]
+    assert tries == [str(ontology_path)]
+    assert len(read_answers(tmp_path / "ranked_gene")) == 3
@@ -0,0 +1,155 @@
+import json
+import pytest
+
+from dataclasses import replace
+from nntool.slurm import SlurmConfig
+
+from soar_benchmark.cascade import CascadeTierConfig
+from soar_benchmark.dataset import JSONDataset, JSONDatasetConfig
+from soar_benchmark.pipeline import CellTypeAnnotationPipeline, GenerationConfig, PipelineConfig
+from soar_benchmark.task import CellTypeAnnotationTask, CellTypeAnnotationTaskConfig
+from soar_benchmark.utils.checkpoint import JSONLWriter, read_jsonl
+
+
+def make_config(tmp_path, **kwargs) -> CellTypeAnnotationTaskConfig:
+    kwargs.setdefault("pipeline", PipelineConfig(model_custom_id="tiny", model_name="tiny"))
+    kwargs.setdefault("slurm", SlurmConfig(mode="local", partition="local", output_folder=str(tmp_path / "slurm")))
+    return CellTypeAnnotationTaskConfig(output_folder=str(tmp_path), **kwargs)
+
+
+def write_json_dataset(path, labels: list) -> str:
+    rows = [
+        {
+            "subset": "ds",
+            "tissue": "blood",
+            "gene list": f"GENE{i}, GENE{i + 1}",
+            "annotation": label,
+            "cl_name": "",
+            "cl_id": "",
+            "broadtype": "",
+        }
+        for i, label in enumerate(labels)
+    ]
+    with open(path, "w") as f:
+        json.dump(rows, f)
+    return str(path)
+
+
+def test_only_the_launcher_writes_the_config(tmp_path):
+    config = make_config(tmp_path, num_shards=4)
+    for shard_index in range(4):
+        CellTypeAnnotationTask(replace(config, shard_index=shard_index))
+    assert not (tmp_path / "config.json").exists()
+
+    CellTypeAnnotationTask(config)
+    with open(tmp_path / "config.json") as f:
+        assert json.load(f)["shard_index"] == -1
+
+
+def test_candidate_labels_skip_missing_labels(tmp_path, monkeypatch):
+    json_path = write_json_dataset(tmp_path / "data.json", ["T cell", None, "", "B cell", " ", "T cell", "monocyte"])
+    # the labels are read without building the samples of the dataset, and from every shard
+    monkeypatch.setattr(JSONDataset, "get_sample", lambda self, index: pytest.fail("built a sample"))
+    task = CellTypeAnnotationTask(
+        make_config(tmp_path, num_shards=2, shard_index=1, dataset=JSONDatasetConfig(json_path=json_path))
+    )
+    assert task.prepare_candidate_labels(task.prepare_dataset()) == ["B cell", "T cell", "monocyte"]
+
+
+def test_read_jsonl_drops_a_record_without_its_newline(tmp_path):
+    path = tmp_path / "results.jsonl"
+    # the run was killed after writing the JSON of sample 2 but before its newline
+    with open(path, "w") as f:
+        f.write('{"index": 0}\n{"index": 1}\n{"index": 2}')
+
+    assert read_jsonl(path) == [{"index": 0}, {"index": 1}]
+    writer = JSONLWriter(path, append=True)
+    writer.write([{"index": 2}, {"index": 3}])
+    writer.close()
+    assert [record["index"] for record in read_jsonl(path)] == [0, 1, 2, 3]
+
+
+# a run can be killed inside the JSON of a record, or after its JSON but before its newline
+@pytest.mark.parametrize("tail_length", [10, None])
+def test_resume_writes_every_index_once(tmp_path, tiny_model_path, tail_length):
+    json_path = write_json_dataset(tmp_path / "data.json", ["T cell", "B cell", "monocyte", "T cell", "B cell", "NK"])
+    config = make_config(
+        tmp_path / "run",
+        promter_name="zero_shot",
+        dataset=JSONDatasetConfig(json_path=json_path),
+        generation=GenerationConfig(max_new_tokens=4, do_sample=False),
+        pipeline=PipelineConfig(
+            model_custom_id="tiny",
+            model_name=tiny_model_path,
+            torch_dtype="float32",
+            device_map="cpu",
+            tokenizer_kwargs={"padding_side": "left"},
+            batch_size=2,
+        ),
+        resume=True,
+    )
+    task = CellTypeAnnotationTask(config)
+    pipeline = CellTypeAnnotationPipeline(config.pipeline)
+
+    # an interrupted run finished samples 0 and 3 and was killed while writing sample 4
+    finished = [{"index": 0, "finished": True}, {"index": 3, "finished": True}]
+    results_path = tmp_path / "run" / "tiny.jsonl"
+    with open(results_path, "w") as f:
+        f.writelines(json.dumps(record) + "\n" for record in finished)
+        f.write(json.dumps({"index": 4, "finished": True})[:tail_length])
+
+    task.run(pipeline)
+    records = read_jsonl(results_path)
+    assert records[:2] == finished
+    assert sorted(record["index"] for record in records) == list(range(6))
+    assert all("messages" in record for record in records[2:])
+    with open(tmp_path / "run" / "tiny.json") as f:
+        assert [record["index"] for record in json.load(f)] == list(range(6))
+    assert pipeline.stats.get("task/resumed_samples") == 2
+
+
+@pytest.mark.parametrize(
+    "generation", [GenerationConfig(num_samples=1), GenerationConfig(num_samples=4, do_sample=False)]
+)
+def test_agreement_tier_needs_several_sampled_answers(tmp_path, generation):
+    cascade = [CascadeTierConfig(confidence="agreement", generation=generation), CascadeTierConfig()]
+    with pytest.raises(ValueError, match="Tier 0 rates answers by agreement"):
+        CellTypeAnnotationTask(make_config(tmp_path, cascade=cascade))
+    # a tier without generation settings samples like the task
+    cascade[0] = CascadeTierConfig(confidence="agreement")
+    with pytest.raises(ValueError, match="Tier 0 rates answers by agreement"):
+        CellTypeAnnotationTask(make_config(tmp_path, cascade=cascade, generation=generation))
+    CellTypeAnnotationTask(make_config(tmp_path, cascade=cascade, generation=GenerationConfig(num_samples=4)))
+
+
+@pytest.mark.parametrize(
+    "num_shards, generation, seeded",
+    [
+        (4, GenerationConfig(do_sample=True), True),
+        (4, GenerationConfig(do_sample=False), False),
+        (1, GenerationConfig(), False),
+    ],
+)
+def test_sharded_sampling_seeds_every_sample(tmp_path, num_shards, generation, seeded):
+    config = make_config(tmp_path, num_shards=num_shards, generation=generation)
+    for shard_index in range(-1, num_shards):
+        task = CellTypeAnnotationTask(replace(config, shard_index=shard_index))
+        assert task.config.per_sample_seeding == seeded
+    # the launcher records the seeding the shards ran with
+    with open(tmp_path / "config.json") as f:
+        assert json.load(f)["per_sample_seeding"] == seeded
+
+
+@pytest.mark.parametrize("engine, warns", [("pipeline", True), ("continuous", False)])
+def test_warns_when_seeded_sampling_runs_one_prompt_at_a_time(tmp_path, tiny_model_path, capsys, engine, warns):
+    pipeline_config = PipelineConfig(
+        model_custom_id="tiny",
+        model_name=tiny_model_path,
+        torch_dtype="float32",
+        device_map="cpu",
+        batch_size=4,
+        engine=engine,
+    )
+    task = CellTypeAnnotationTask(make_config(tmp_path, pipeline=pipeline_config, per_sample_seeding=True))
+    task.prepare_pipeline(pipeline_config)
+    assert ("samples seeded prompts one at a time" in capsys.readouterr().out) == warns